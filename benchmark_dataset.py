@@ -1,4 +1,5 @@
 #benchmark dataset:
+import glob
 import itertools
 import os
 import time
@@ -8,14 +9,14 @@ import numpy as np
 from pydub import AudioSegment
 from model import SpeakerNet
 from tqdm import tqdm
-from utils import cosine_simialrity
+from utils import cosine_similarity, read_config
 import csv
 
 def all_pairs(lst):
     return list(itertools.combinations(lst, 2))
 
 def check_matching(ref_emb, com_emb, threshold=0.5):
-    score = cosine_simialrity(ref_emb, com_emb)
+    score = cosine_similarity(ref_emb, com_emb)
     ratio = threshold / 0.5
     result = (score / ratio) if (score / ratio) < 1 else 1
     matching = result > 0.5
@@ -81,13 +82,9 @@ def benchmark_dataset_by_model(model_path=str(Path('backup/Raw_ECAPA/model/best_
     #     filepaths = list(set(filepaths).difference(set(blist)))
 
         pairs = all_pairs(filepaths)
-        files_emb_dict = {}
         imposters = {}
 
-        for fn in filepaths:
-            emb = model.embed_utterance(fn, eval_frames=100, num_eval=20, normalize=True)
-            if fn not in files_emb_dict:
-                files_emb_dict[fn] = emb
+        files_emb_dict = model.embed_files(filepaths, max_frames=100, num_eval=20, normalize=True)
 
         for pair in pairs:
             match, score = check_matching(files_emb_dict[pair[0]], files_emb_dict[pair[1]], threshold)
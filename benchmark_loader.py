@@ -0,0 +1,75 @@
+#benchmark training loader: utterances/sec of the whole-file decode vs the seek-based crop read and the packed shards
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from dataloader import Loader
+from processing.shards import pack_shards
+
+
+def make_dataset(root, n_files, minutes, sample_rate=8000, n_speakers=10):
+    '''Long int16 recordings and their train list (speaker path per line)'''
+    rng = np.random.RandomState(0)
+    list_path = os.path.join(root, 'train_list.txt')
+    with open(list_path, 'w') as wf:
+        for i in range(n_files):
+            path = os.path.join(root, f"call_{i}.wav")
+            sf.write(path, (rng.randn(int(minutes * 60 * sample_rate)) * 3000).astype(np.int16), sample_rate)
+            wf.write(f"spk{i % n_speakers} {path}\n")
+        # a file shorter than a crop, wrap-padded by both paths
+        path = os.path.join(root, 'short.wav')
+        sf.write(path, (rng.randn(sample_rate // 2) * 3000).astype(np.int16), sample_rate)
+        wf.write(f"spk0 {path}\n")
+    return list_path
+
+
+def throughput(loader, n_items, seed=0):
+    random.seed(seed)
+    t0 = time.perf_counter()
+    crops = [loader[[index % len(loader)]][0].numpy() for index in range(n_items)]
+    return n_items / (time.perf_counter() - t0), crops
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BenchmarkLoader")
+    parser.add_argument('--train_list', type=str, default=None, help='train list to read, synthetic calls if not set')
+    parser.add_argument('--n_files', type=int, default=20)
+    parser.add_argument('--minutes', type=float, default=3, help='length of the synthetic calls')
+    parser.add_argument('--n_items', type=int, default=200)
+    parser.add_argument('--max_frames', type=int, default=200)
+    parser.add_argument('--sample_rate', type=int, default=8000)
+    parser.add_argument('--shard_size', type=int, default=64, help='MB per shard')
+    parser.add_argument('--time_domain', action='store_true', default=False,
+                        help='with speed / pitch / volume augmentation: pydub vs array time_domain_mode')
+    args = parser.parse_args()
+
+    train_list = args.train_list or make_dataset(tempfile.mkdtemp(), args.n_files, args.minutes, args.sample_rate)
+    shard_dir = tempfile.mkdtemp()
+    t0 = time.perf_counter()
+    n_shards = pack_shards(train_list, shard_dir, shard_size=args.shard_size, sample_rate=args.sample_rate)
+    print(f"packed {n_shards} shards in {time.perf_counter() - t0:.1f}s")
+
+    if args.time_domain:
+        for read_mode, time_domain_mode in (('pydub', 'pydub'), ('pydub', 'array'), ('seek', 'array'), ('shards', 'array')):
+            loader = Loader(train_list, augment=True, musan_path=None, rir_path=None, max_frames=args.max_frames,
+                            n_mels=80, sample_rate=args.sample_rate, augment_chain=['time_domain'], train_read_mode=read_mode,
+                            train_shards=shard_dir, time_domain_mode=time_domain_mode)
+            print(f"{read_mode:<6} {time_domain_mode:<6} {throughput(loader, args.n_items)[0]:>10.1f} utterances/sec")
+        raise SystemExit
+
+    results = {}
+    for read_mode in ('pydub', 'sf', 'seek', 'shards'):
+        loader = Loader(train_list, augment=False, musan_path=None, rir_path=None, max_frames=args.max_frames,
+                        n_mels=80, sample_rate=args.sample_rate, augment_chain=[], train_read_mode=read_mode,
+                        train_shards=shard_dir)
+        results[read_mode] = throughput(loader, args.n_items)
+        print(f"{read_mode:<6} {results[read_mode][0]:>10.1f} utterances/sec")
+
+    for read_mode in ('seek', 'shards'):
+        same = all(np.array_equal(a, b) for a, b in zip(results['pydub'][1], results[read_mode][1]))
+        print(f"{read_mode} speedup x{results[read_mode][0] / results['pydub'][0]:.1f} over pydub, same crops: {same}")
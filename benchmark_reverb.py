@@ -0,0 +1,56 @@
+#benchmark reverberation of AugmentWAV: direct scipy convolution vs the product with cached RIR spectra
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from processing.audio_loader import AugmentWAV
+
+
+def make_rirs(root, seconds, n_rirs, sample_rate=8000):
+    '''Exponentially decaying noise RIRs in the simulated_rirs layout'''
+    rng = np.random.RandomState(0)
+    n_samples = int(seconds * sample_rate)
+    for i in range(n_rirs):
+        os.makedirs(os.path.join(root, 'smallroom', f"Room{i:03d}"))
+        rir = rng.randn(n_samples) * np.exp(-np.arange(n_samples) / (0.1 * sample_rate)) * 20000
+        sf.write(os.path.join(root, 'smallroom', f"Room{i:03d}", 'r.wav'), rir.astype(np.int16), sample_rate)
+    return root
+
+
+def per_call(engine, audio, n_calls, seed=0):
+    random.seed(seed)
+    t0 = time.perf_counter()
+    outs = [engine.reverberate(audio) for _ in range(n_calls)]
+    return (time.perf_counter() - t0) / n_calls * 1000, outs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BenchmarkReverb")
+    parser.add_argument('--rir_seconds', type=float, nargs='+', default=[0.25, 0.5, 1, 2])
+    parser.add_argument('--n_rirs', type=int, default=20)
+    parser.add_argument('--n_calls', type=int, default=200)
+    parser.add_argument('--max_frames', type=int, default=200)
+    parser.add_argument('--sample_rate', type=int, default=8000)
+    args = parser.parse_args()
+
+    audio = np.random.RandomState(1).randn(1, int(args.max_frames * 10e-3 * args.sample_rate + 15e-3 * args.sample_rate)) * 0.1
+    print(f"{'rir (s)':>8}{'direct (ms)':>13}{'fft cold (ms)':>15}{'fft cached (ms)':>17}{'speedup':>9}{'max diff':>10}")
+    for seconds in args.rir_seconds:
+        root = tempfile.mkdtemp()
+        rir_path = make_rirs(os.path.join(root, 'rirs'), seconds, args.n_rirs, args.sample_rate)
+        engines = {reverb_mode: AugmentWAV(os.path.join(root, 'musan'), rir_path, args.max_frames, sample_rate=args.sample_rate,
+                                           bank_dir=os.path.join(root, 'bank'), reverb_mode=reverb_mode)
+                   for reverb_mode in ('direct', 'fft')}
+        direct, ref = per_call(engines['direct'], audio, args.n_calls)
+        # first call of each RIR computes its spectrum
+        cold, _ = per_call(engines['fft'], audio, args.n_rirs)
+        cached, out = per_call(engines['fft'], audio, args.n_calls)
+        diff = max(np.abs(a - b).max() for a, b in zip(ref, out))
+        print(f"{seconds:>8.2f}{direct:>13.3f}{cold:>15.3f}{cached:>17.3f}{direct / cached:>9.1f}{diff:>10.1e}")
+        # the RIR truncated to max_audio leaves the kept samples exact: sample n only uses RIR samples up to n
+        assert diff <= 1e-9 * max(np.abs(a).max() for a in ref), f"fft reverberation differs from direct by {diff:.1e}"
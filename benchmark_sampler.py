@@ -0,0 +1,87 @@
+#benchmark epoch setup of the training Sampler on synthetic lists: list-scan sampler vs array plan
+import argparse
+import time
+import types
+
+import numpy as np
+
+from dataloader import Sampler
+from utils import round_down
+
+
+def legacy_iter(label_dict, nPerSpeaker, max_seg_per_spk, batch_size):
+    '''Epoch of the previous Sampler: a scan of the current batch for every group'''
+    dictkeys = sorted(label_dict.keys())
+    flattened_list = []
+    flattened_label = []
+    for findex, key in enumerate(dictkeys):
+        data = label_dict[key]
+        numSeg = round_down(min(len(data), max_seg_per_spk), nPerSpeaker)
+        rp = np.random.permutation(len(data))[:numSeg].reshape(-1, nPerSpeaker)
+        flattened_label.extend([findex] * len(rp))
+        for indices in rp:
+            flattened_list.append([data[i] for i in indices])
+
+    mixid = np.random.permutation(len(flattened_label))
+    mixlabel = []
+    mixmap = []
+    for ii in mixid:
+        startbatch = len(mixlabel) - len(mixlabel) % batch_size
+        if flattened_label[ii] not in mixlabel[startbatch:]:
+            mixlabel.append(flattened_label[ii])
+            mixmap.append(ii)
+    return [flattened_list[i] for i in mixmap]
+
+
+def synthetic_source(n_utterances, n_speakers, seed=0):
+    '''Dataset stand-in: speaker sizes of a long-tailed distribution'''
+    rng = np.random.RandomState(seed)
+    weights = rng.pareto(1.5, n_speakers) + 1
+    labels = rng.choice(n_speakers, size=n_utterances, p=weights / weights.sum())
+    label_dict = {}
+    for index, label in enumerate(labels.tolist()):
+        label_dict.setdefault(label, []).append(index)
+    return types.SimpleNamespace(data_label=labels, label_dict=label_dict)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BenchmarkSampler")
+    parser.add_argument('--n_utterances', type=int, nargs='+', default=[100000, 1000000, 5000000])
+    parser.add_argument('--utterances_per_speaker', type=int, default=300)
+    parser.add_argument('--legacy_max', type=int, default=1000000, help='largest list timed with the previous sampler')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--nPerSpeaker', type=int, default=2)
+    parser.add_argument('--max_seg_per_spk', type=int, default=100)
+    parser.add_argument('--world_size', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'utterances':>11}{'speakers':>10}{'previous (s)':>14}{'dropped':>9}{'plan (s)':>10}{'dropped':>9}{'batches':>9}")
+    for n_utterances in args.n_utterances:
+        n_speakers = max(n_utterances // args.utterances_per_speaker, args.batch_size)
+        source = synthetic_source(n_utterances, n_speakers)
+        n_groups = int((np.minimum(np.bincount(source.data_label), args.max_seg_per_spk) // args.nPerSpeaker).sum())
+
+        previous, previous_dropped = float('nan'), '-'
+        if n_utterances <= args.legacy_max:
+            t0 = time.perf_counter()
+            kept = len(legacy_iter(source.label_dict, args.nPerSpeaker, args.max_seg_per_spk, args.batch_size))
+            previous = time.perf_counter() - t0
+            # groups after the last full batch of the DataLoader are dropped as well
+            previous_dropped = n_groups - round_down(kept, args.batch_size)
+
+        t0 = time.perf_counter()
+        plans = [Sampler(source, args.nPerSpeaker, args.max_seg_per_spk, args.batch_size,
+                         sampler_seed=0, rank=rank, world_size=args.world_size) for rank in range(args.world_size)]
+        n_batches = [len(sampler) // args.batch_size for sampler in plans[:1]]
+        plan = time.perf_counter() - t0
+
+        # every rank: same number of batches of distinct speakers, no utterance on two ranks
+        batches = [np.array(list(iter(sampler))).reshape(-1, args.batch_size, args.nPerSpeaker) for sampler in plans]
+        speakers = np.sort(source.data_label[np.concatenate(batches)[:, :, 0]], axis=1)
+        assert len(set(len(rank_batches) for rank_batches in batches)) == 1
+        assert not (speakers[:, 1:] == speakers[:, :-1]).any()
+        assert len(np.unique(np.concatenate(batches))) == np.concatenate(batches).size
+        plan_dropped = n_groups - sum(len(rank_batches) for rank_batches in batches) * args.batch_size
+
+        print(f"{n_utterances:>11}{n_speakers:>10}{previous:>14.2f}{previous_dropped:>9}{plan:>10.2f}{plan_dropped:>9}"
+              f"{n_batches[0]:>9}")
@@ -0,0 +1,90 @@
+# Bytes on the wire and server side decode time of the JSON/base64 and binary audio transports
+import argparse
+import base64
+import io
+import json
+import time
+
+import numpy as np
+import soundfile as sf
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from server_utils import decode_audio, decode_audio_bytes
+
+
+def json_payload(clips):
+    # same encoding as test-client-matching.py: float64 -> base64 -> json string -> json body
+    data = {'callId': 'benchmark',
+            'phone': 'benchmark',
+            'refSpeech': [base64.b64encode(clip.astype(np.float64)).decode('utf-8') for clip in clips[:1]],
+            'comSpeech': [base64.b64encode(clip.astype(np.float64)).decode('utf-8') for clip in clips[1:]]}
+    return json.dumps(json.dumps(data)).encode('utf-8'), 'application/json'
+
+
+def wav_bytes(clip, sr):
+    buf = io.BytesIO()
+    sf.write(buf, clip, sr, format='WAV', subtype='PCM_16')
+    return buf.getvalue()
+
+
+def multipart_payload(clips, sr, fmt='wav'):
+    files = []
+    for i, clip in enumerate(clips):
+        if fmt == 'wav':
+            part = (io.BytesIO(wav_bytes(clip, sr)), f'{i}.wav', 'audio/wav')
+        else:
+            part = (io.BytesIO((clip * 32767).astype('<i2').tobytes()), f'{i}.pcm', 'audio/L16')
+        files.append(('refSpeech' if i == 0 else 'comSpeech', part))
+    builder = EnvironBuilder(method='POST', data={'callId': 'benchmark', 'phone': 'benchmark'},
+                             content_type='multipart/form-data')
+    for name, part in files:
+        builder.files.add_file(name, *part)
+    environ = builder.get_environ()
+    body = environ['wsgi.input'].read()
+    return body, environ['CONTENT_TYPE']
+
+
+def make_request(body, content_type):
+    builder = EnvironBuilder(method='POST', data=body, content_type=content_type)
+    return Request(builder.get_environ())
+
+
+def decode_json(body, content_type, sr):
+    # server side of /isMatched
+    json_data = make_request(body, content_type).get_json()
+    data_json = json.loads(json_data)
+    return [decode_audio(audio_data, sr, np.float64) for audio_data in data_json['refSpeech'] + data_json['comSpeech']]
+
+
+def decode_multipart(body, content_type, sr):
+    # server side of /isMatched/binary
+    request = make_request(body, content_type)
+    parts = request.files.getlist('refSpeech') + request.files.getlist('comSpeech')
+    return [decode_audio_bytes(part.read(), sr, part.mimetype) for part in parts]
+
+
+def benchmark(name, payload, decode_fn, sr, n_runs=20):
+    body, content_type = payload
+    decode_fn(body, content_type, sr)
+    t0 = time.perf_counter()
+    for _ in range(n_runs):
+        clips = decode_fn(body, content_type, sr)
+    decode_time = (time.perf_counter() - t0) / n_runs
+    print(f"{name:<22} {len(body) / 1024:>10.1f} KB {decode_time * 1000:>10.2f} ms  -> {clips[0].dtype}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="BenchmarkTransport")
+    parser.add_argument('--n_clips', type=int, default=4, help='clips per request (1 ref + n - 1 com)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per clip')
+    parser.add_argument('--sr', type=int, default=8000)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    clips = [np.clip(rng.randn(int(args.duration * args.sr)) * 0.1, -1, 1) for _ in range(args.n_clips)]
+    print(f"{args.n_clips} clips of {args.duration}s at {args.sr}Hz, raw int16 size {args.n_clips * args.duration * args.sr * 2 / 1024:.1f} KB")
+    print(f"{'transport':<22} {'on the wire':>13} {'decode':>13}")
+    benchmark('json/base64 float64', json_payload(clips), decode_json, args.sr)
+    benchmark('multipart wav int16', multipart_payload(clips, args.sr, 'wav'), decode_multipart, args.sr)
+    benchmark('multipart pcm int16', multipart_payload(clips, args.sr, 'pcm'), decode_multipart, args.sr)
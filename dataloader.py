@@ -8,7 +8,9 @@ import torch
 from torch.utils.data import DataLoader, Dataset
 from tqdm.auto import tqdm
 
-from processing.audio_loader import loadWAV, AugmentWAV
+from processing.audio_loader import loadWAV, AugmentWAV, augment_bank_dir, augment_crop
+from processing.batch_augment import AUGTYPES, AUGTYPE_P, NOISE_MODES, NOISE_MODE_P, time_domain_frames
+from processing.shards import ShardReader
 from processing.vad_tool import VAD
 from utils import round_down, worker_init_fn
 
@@ -21,20 +23,40 @@ class Loader(Dataset):
         self.n_mels = n_mels
         self.kwargs = kwargs
         self.sr = kwargs['sample_rate']
+        # pydub (default) / sf: loadWAV of the whole file, opt-in faster paths:
+        # seek: read only the training crop of wav files (see processing.audio_loader.read_crop)
+        # shards: slice it from the memory-mapped shards of dataprep.py --pack_shards
+        self.read_mode = kwargs.get('train_read_mode', 'pydub')
 
         # augmented folder files
         self.aug_folder = aug_folder
         self.musan_path = musan_path
         self.rir_path = rir_path
         self.augment_chain = kwargs['augment_chain'] if 'augment_chain' in kwargs else ['env_corrupt', 'time_domain']
+        # env_corrupt of the whole batch in SpeakerNet.fit instead of the workers
+        self.batch_env_corrupt = kwargs.get('batch_env_corrupt', False)
+        # time_domain: pydub (default, AudioSegment of the whole recording), opt-in array (resampling of the
+        # crop only, factors on a 1/200 grid) or batch (in SpeakerNet.fit on the device, the workers load
+        # longer crops for it to resample)
+        self.time_domain_mode = kwargs.get('time_domain_mode', 'pydub')
+        self.max_audio = int(max_frames * 10e-3 * self.sr + (25e-3 * self.sr - 10e-3 * self.sr))
+        self.load_frames = max_frames
+        self.load_chain = self.augment_chain
+        if self.augment and ('time_domain' in self.augment_chain) and self.time_domain_mode == 'batch':
+            if 'env_corrupt' in self.augment_chain and not self.batch_env_corrupt:
+                raise ValueError("time_domain_mode batch comes before env_corrupt, set batch_env_corrupt too")
+            self.load_frames = time_domain_frames(max_frames)
+            self.load_chain = [aug for aug in self.augment_chain if aug != 'time_domain']
         
-        if self.augment and ('env_corrupt' in self.augment_chain):
+        if self.augment and ('env_corrupt' in self.augment_chain) and not self.batch_env_corrupt:
             if all(os.path.exists(path) for path in [self.musan_path, self.rir_path]):
                 self.augment_engine = AugmentWAV(musan_path=musan_path,
                                                  rir_path=rir_path,
                                                  max_frames=max_frames,
                                                  sample_rate=self.sr, 
-                                                 target_db=None)
+                                                 target_db=None,
+                                                 bank_dir=augment_bank_dir(**dict(kwargs, musan_path=musan_path)),
+                                                 reverb_mode=kwargs.get('reverb_mode', 'direct'))
             else:
                 self.augment_engine = None
 
@@ -62,6 +84,10 @@ class Loader(Dataset):
             self.data_label.append(speaker_label)
             self.data_list.append(data[1])
 
+        if self.read_mode == 'shards':
+            self.shards = ShardReader(kwargs['train_shards'], sample_rate=self.sr)
+            self.shard_entries = self.shards.lookup(self.data_list)
+
     def __getitem__(self, indices):
         feat = []
 
@@ -69,32 +95,42 @@ class Loader(Dataset):
             # Load audio
             audio_file = self.data_list[index]
                     
-            # time domain augment
-            audio = loadWAV(audio_file, self.max_frames, 
-                            evalmode=False, 
-                            augment=self.augment, 
-                            sample_rate=self.sr, 
-                            augment_chain=self.augment_chain)
+            time_domain = self.augment and ('time_domain' in self.load_chain)
+            if self.read_mode == 'shards' and not (time_domain and self.time_domain_mode == 'pydub'):
+                entry = self.shard_entries[index]
+                if time_domain:
+                    audio = augment_crop(lambda n_samples: self.shards.crop(entry, self.max_frames, n_samples), self.max_audio)
+                else:
+                    audio = self.shards.crop(entry, self.load_frames)
+            else:
+                # time domain augment
+                audio = loadWAV(audio_file, self.load_frames, 
+                                evalmode=False, 
+                                augment=self.augment, 
+                                sample_rate=self.sr, 
+                                augment_chain=self.load_chain,
+                                read_mode=self.read_mode,
+                                time_domain_mode=self.time_domain_mode)
             
             #env corrupt augment
-            if self.augment and ('env_corrupt' in self.augment_chain) and (self.aug_folder == 'online'):  
+            if self.augment and ('env_corrupt' in self.augment_chain) and (self.aug_folder == 'online') and not self.batch_env_corrupt:
                 # if exists augmented folder(30GB) separately
                 # env corruption adding from musan, revberation
-                augtype = np.random.choice(['rev', 'noise', 'both', 'none'], p=[0.2, 0.4, 0.2, 0.2])
+                augtype = np.random.choice(AUGTYPES, p=AUGTYPE_P)
                 if augtype == 'rev':
                     audio = self.augment_engine.reverberate(audio)
                 elif augtype == 'noise':
-                    mode = np.random.choice(['noise', 'speech', 'music', 'noise_vad', 'noise_rirs'], p=[0.25, 0.25, 0.25, 0, 0.25])
+                    mode = np.random.choice(NOISE_MODES, p=NOISE_MODE_P)
                     audio = self.augment_engine.additive_noise(mode, audio)
                 elif augtype == 'both':
                     # combined reverb and noise
                     order = np.random.choice(['noise_first', 'rev_first'], p=[0.5, 0.5])
                     if order == 'rev_first':
                         audio = self.augment_engine.reverberate(audio)
-                        mode = np.random.choice(['noise', 'speech', 'music', 'noise_vad', 'noise_rirs'], p=[0.25, 0.25, 0.25, 0, 0.25])
+                        mode = np.random.choice(NOISE_MODES, p=NOISE_MODE_P)
                         audio = self.augment_engine.additive_noise(mode, audio)
                     else:
-                        mode = np.random.choice(['noise', 'speech', 'music', 'noise_vad', 'noise_rirs'], p=[0.25, 0.25, 0.25, 0, 0.25])
+                        mode = np.random.choice(NOISE_MODES, p=NOISE_MODE_P)
                         audio = self.augment_engine.additive_noise(mode, audio)   
                         audio = self.augment_engine.reverberate(audio)
                 else:
@@ -112,51 +148,107 @@ class Loader(Dataset):
 
 
 class Sampler(torch.utils.data.Sampler):
+    """Groups of nPerSpeaker utterances of a speaker, batch_size groups of distinct speakers per batch
+
+    The epoch plan is built with array operations: the utterances of each speaker are shuffled and
+    cut into groups (at most max_seg_per_spk utterances per speaker). The number of batches is the
+    largest n such that the groups of the speakers, at most n per speaker, fill n batches: no plan of
+    batches of distinct speakers keeps more groups. The groups of each speaker are laid out one after
+    the other, speakers in random order, and dealt in turn to the n batches, so the groups of a speaker
+    go to different batches. Groups beyond n of a speaker and the last n * batch_size are not used.
+
+    The plan is drawn from `seed` and the epoch (set_epoch), the same on every process: each rank
+    iterates over its own batches of it, the same number on every rank (n is rounded down to a
+    multiple of world_size, which drops up to world_size - 1 more batches).
+
+    Args:
+        data_source (Loader): dataset with data_label
+        nPerSpeaker (int): utterances per speaker in a batch
+        max_seg_per_spk (int): max utterances per speaker per epoch
+        batch_size (int): groups per batch (batch_size of the DataLoader, per rank)
+        sampler_seed (int, optional): seed of the plans, drawn at random if None (single process only)
+        rank, world_size (int, optional): process of the distributed training, from torch.distributed if None
+    """
     def __init__(self, data_source, nPerSpeaker, max_seg_per_spk, batch_size, **kwargs):
         self.data_source = data_source
-        self.label_dict = data_source.label_dict
+        self.labels = np.asarray(data_source.data_label, dtype=np.int64)
         self.nPerSpeaker = nPerSpeaker
         self.max_seg_per_spk = max_seg_per_spk
         self.batch_size = batch_size
 
-    def __iter__(self):
-        dictkeys = list(self.label_dict.keys())
-        dictkeys.sort()
-
-        def lol(lst, sz): return [lst[i:i + sz]
-                                  for i in range(0, len(lst), sz)]
-
-        flattened_list = []
-        flattened_label = []
-
-        # Data for each class
-        for findex, key in enumerate(dictkeys):
-            data = self.label_dict[key]
-            numSeg = round_down(min(len(data), self.max_seg_per_spk),
-                                self.nPerSpeaker)
-
-            rp = lol(
-                np.random.permutation(len(data))[:numSeg], self.nPerSpeaker)
-            flattened_label.extend([findex] * (len(rp)))
-            for indices in rp:
-                flattened_list.append([data[i] for i in indices])
-
-        # Data in random order
-        mixid = np.random.permutation(len(flattened_label))
-        mixlabel = []
-        mixmap = []
-
-        # Prevent two pairs of the same speaker in the same batch
-        for ii in mixid:
-            startbatch = len(mixlabel) - len(mixlabel) % self.batch_size
-            if flattened_label[ii] not in mixlabel[startbatch:]:
-                mixlabel.append(flattened_label[ii])
-                mixmap.append(ii)
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = kwargs.get('rank') if kwargs.get('rank') is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = kwargs.get('world_size') or (torch.distributed.get_world_size() if distributed else 1)
+        self.seed = kwargs.get('sampler_seed')
+        if self.seed is None:
+            if self.world_size > 1:
+                raise ValueError("sampler_seed is required to share the batches between the processes")
+            self.seed = int(np.random.randint(2 ** 31))
+
+        self.epoch = 0
+        self.plan = None
+
+    def set_epoch(self, epoch):
+        '''Plan of the given epoch for the next iteration (the epoch is incremented after each iteration)'''
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.plan = None
+
+    def speaker_groups(self, rng):
+        '''Groups (n_groups, nPerSpeaker) of utterance indices, their speaker and rank within the speaker'''
+        # utterances of a speaker contiguous, in random order
+        order = rng.permutation(len(self.labels))
+        order = order[np.argsort(self.labels[order], kind='stable')]
+        speaker = self.labels[order]
+        counts = np.bincount(speaker)
+        position = np.arange(len(order)) - (np.cumsum(counts) - counts)[speaker]
+        n_groups = np.minimum(counts, self.max_seg_per_spk) // self.nPerSpeaker
+        keep = position < (n_groups * self.nPerSpeaker)[speaker]
+        groups = order[keep].reshape(-1, self.nPerSpeaker)
+        return groups, speaker[keep][::self.nPerSpeaker], position[keep][::self.nPerSpeaker] // self.nPerSpeaker
+
+    def max_batches(self, counts):
+        '''Largest number of batches n of distinct speakers: sum(min(counts, n)) >= n * batch_size'''
+        counts = np.sort(counts)
+        cumsum = np.concatenate([[0], np.cumsum(counts)])
+        low, high = 0, int(cumsum[-1]) // self.batch_size
+        # the groups per batch sum(min(counts, n)) / n only decrease with n
+        while low < high:
+            n = (low + high + 1) // 2
+            below = np.searchsorted(counts, n)
+            if cumsum[below] + n * (len(counts) - below) >= n * self.batch_size:
+                low = n
+            else:
+                high = n - 1
+        return low
+
+    def build_plan(self):
+        '''Batches (n_batches, batch_size, nPerSpeaker) of this rank for the current epoch'''
+        rng = np.random.default_rng([self.seed, self.epoch])
+        groups, speaker, group_rank = self.speaker_groups(rng)
+        n_batches = self.max_batches(np.bincount(speaker)) // self.world_size * self.world_size
+
+        # speakers in random order, at most n_batches groups each, dealt in turn to the batches
+        sequence = np.flatnonzero(group_rank < n_batches)
+        speaker_order = rng.permutation(speaker.max() + 1 if len(speaker) else 0)
+        sequence = sequence[np.argsort(speaker_order[speaker[sequence]], kind='stable')][:n_batches * self.batch_size]
+        batches = groups[sequence].reshape(self.batch_size, n_batches, self.nPerSpeaker).transpose(1, 0, 2)
+        # random order of the groups within each batch
+        batches = np.take_along_axis(batches, np.argsort(rng.random(batches.shape[:2]), axis=1)[:, :, None], axis=1)
+        # same order of the batches on every rank, each takes one in world_size
+        return batches[rng.permutation(n_batches)][self.rank::self.world_size]
 
-        return iter([flattened_list[i] for i in mixmap])
+    def __iter__(self):
+        if self.plan is None:
+            self.plan = self.build_plan()
+        plan, self.plan = self.plan, None
+        self.epoch += 1
+        return iter(plan.reshape(-1, self.nPerSpeaker).tolist())
 
     def __len__(self):
-        return len(self.data_source)
+        if self.plan is None:
+            self.plan = self.build_plan()
+        return len(self.plan) * self.batch_size
 
 
 def get_data_loader(dataset_file_name, batch_size, augment, musan_path,
@@ -21,6 +21,7 @@ from tqdm.auto import tqdm
 from processing.audio_loader import AugmentWAV, loadWAV
 from processing.vad_tool import VAD
 from processing.dataset import get_audio_properties, read_blacklist
+from processing.shards import pack_shards
 import contextlib
 
 
@@ -179,7 +180,8 @@ def augmentation(args, audio_paths, mode='train', max_frames=200, step_save=5, *
     augment_engine = AugmentWAV(musan_path=musan_path,
                                 rir_path=rir_path,
                                 max_frames=max_frames,
-                                sample_rate=8000,target_db=None)
+                                sample_rate=8000,target_db=None,
+                                reverb_mode=args.reverb_mode)
     list_audios = []
 
     for idx, fpath in enumerate(tqdm(augment_audio_paths, unit='files', desc=f"Augmented process")):
@@ -505,6 +507,26 @@ if __name__ == '__main__':
                         default=False,
                         action='store_true',
                         help='Restore dataset to origin(del augment and vad)')
+    parser.add_argument('--pack_shards',
+                        default=False,
+                        action='store_true',
+                        help='Pack the train list into int16 shards for --train_read_mode shards')
+    parser.add_argument('--train_list',
+                        type=str,
+                        default="dataset/train.def.txt",
+                        help='Train list to pack')
+    parser.add_argument('--shard_dir',
+                        type=str,
+                        default="dataset/train_shards",
+                        help='Directory of the shards and their index')
+    parser.add_argument('--shard_size',
+                        type=int,
+                        default=1024,
+                        help='Max size of a shard in MB')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=8000,
+                        help='Sample rate of the packed recordings')
     # augmentation
     parser.add_argument('--augment',
                         default=False,
@@ -522,6 +544,10 @@ if __name__ == '__main__':
                         type=float,
                         default=0.5,
                         help='')
+    parser.add_argument('--reverb_mode',
+                        type=str,
+                        default='direct',
+                        help='Reverberation: direct (default, scipy convolve) or fft (cached RIR spectra)')
 
 
     args = parser.parse_args()
@@ -539,4 +565,7 @@ if __name__ == '__main__':
     if args.transform:
         data_generator.transform()
     if args.restore:
-        restore_dataset(args.raw_dataset)
\ No newline at end of file
+        restore_dataset(args.raw_dataset)
+    if args.pack_shards:
+        n_shards = pack_shards(args.train_list, args.shard_dir, shard_size=args.shard_size, sample_rate=args.sample_rate)
+        print(f"Packed {args.train_list} into {n_shards} shards in {args.shard_dir}")
\ No newline at end of file
@@ -0,0 +1,180 @@
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from graph_fusion import fuse_conv_bn, set_module
+from models.RepVGG import repvgg_model_convert
+
+
+class CachedSincConv(nn.Module):
+
+    ## SincConv_fast of the RawNet2 models with its filter bank computed once: a plain conv1d
+
+    def __init__(self, sinc_conv):
+        super(CachedSincConv, self).__init__()
+        self.stride = sinc_conv.stride
+        self.padding = sinc_conv.padding
+        self.dilation = sinc_conv.dilation
+        # the forward of SincConv_fast builds filters_map from the learnt band edges
+        with torch.no_grad():
+            sinc_conv(torch.zeros(1, 1, sinc_conv.kernel_size, device=sinc_conv.low_hz_.device))
+        self.register_buffer('filters', sinc_conv.filters_map.detach().clone())
+
+    def forward(self, waveforms):
+        return F.conv1d(waveforms, self.filters, stride=self.stride,
+                        padding=self.padding, dilation=self.dilation)
+
+
+def cache_sinc_filters(model):
+    """Compute the filter banks of the sinc convolutions once, in place
+
+    SincConv_fast (RawNet2 family) is replaced by CachedSincConv, SincConv (ECAPA_utils)
+    keeps its padding logic and gets a `_get_sinc_filters` returning the cached bank.
+
+    Returns:
+        int: number of sinc convolutions cached
+    """
+    n_cached = 0
+    for name, module in list(model.named_modules()):
+        class_name = type(module).__name__
+        if class_name == 'SincConv_fast':
+            set_module(model, name, CachedSincConv(module))
+            n_cached += 1
+        elif class_name == 'SincConv' and hasattr(module, '_get_sinc_filters'):
+            module.device = module.low_hz_.device
+            with torch.no_grad():
+                module.register_buffer('cached_filters', module._get_sinc_filters().detach().clone())
+            module._get_sinc_filters = lambda module=module: module.cached_filters
+            n_cached += 1
+    return n_cached
+
+
+def reparameterize(model):
+    '''Merge the train-time branches of the RepVGG blocks into one conv, in place'''
+    n_blocks = sum(hasattr(module, 'switch_to_deploy') for module in model.modules())
+    if n_blocks:
+        repvgg_model_convert(model, do_copy=False)
+    return n_blocks
+
+
+def freeze_torchscript(model, example_input, check_inputs=(), tolerance=1e-4):
+    """Trace the model to TorchScript and freeze it (weights inlined as constants)
+
+    The traced graph is checked on `check_inputs` (other batch / time sizes), None is
+    returned when its output differs, e.g. because a shape was recorded as a constant.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input, check_trace=False)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+        for inp in (example_input,) + tuple(check_inputs):
+            try:
+                ref = model(inp)
+            except RuntimeError:
+                # the eager model itself only takes some shapes (e.g. fixed-length layer norms)
+                continue
+            out = frozen(inp)
+            if ref.shape != out.shape or (ref - out).abs().max().item() > tolerance * max(1.0, ref.abs().max().item()):
+                return None
+    return frozen
+
+
+def deploy_model(model, n_samples=8120, fuse=True, reparam=True, cache_sinc=True, script=True, verbose=True,
+                 check_lengths=None):
+    """Inference-only graph of a SpeakerNet in eval mode, replaces `model.__S__`
+
+    RepVGG blocks are re-parameterized, sinc filter banks cached, BatchNorm layers fed by
+    a conv folded into it, then the model is frozen to TorchScript. Every step keeps the
+    output of the model (checked on random inputs), the model can not be trained afterwards.
+
+    Args:
+        model (SpeakerNet): model with its weights loaded
+        n_samples (int, optional): crop length of the example inputs. Defaults to 8120.
+        fuse, reparam, cache_sinc, script (bool, optional): steps to apply. Defaults to True.
+        check_lengths (tuple, optional): input lengths (samples) on which the TorchScript graph must match
+            the eager model, whole utterances have any length. Defaults to 0.5x to 8x n_samples, odd lengths included.
+
+    Returns:
+        dict: what was applied
+    """
+    model.eval()
+    S = model.__S__
+
+    def example(n_crops, length):
+        inp = torch.randn(n_crops, length, device=model.device) * 0.1
+        with torch.no_grad():
+            return model.compute_features(inp) if model.compute_features is not None else inp
+
+    example_input = example(2, n_samples)
+    with torch.no_grad():
+        ref = S(example_input)
+
+    report = {'reparam': reparameterize(S) if reparam else 0,
+              'sinc': cache_sinc_filters(S) if cache_sinc else 0,
+              'fused': len(fuse_conv_bn(S, example_input, verbose=False)) if fuse else 0,
+              'torchscript': False}
+    with torch.no_grad():
+        diff = (S(example_input) - ref).abs().max().item()
+
+    if script:
+        if check_lengths is None:
+            check_lengths = (n_samples // 2 + 1, n_samples + 13, n_samples * 2 - 120, n_samples * 3 + 37, n_samples * 8 + 11)
+        check_inputs = tuple(example(1, length) for length in check_lengths) + (example(3, n_samples * 2 + 1),)
+        frozen = freeze_torchscript(S, example_input, check_inputs=check_inputs)
+        if frozen is not None:
+            model.__S__ = frozen
+            report['torchscript'] = True
+        elif verbose:
+            print("TorchScript trace does not generalize to other input shapes, keeping the eager model")
+
+    model.inference_backend = None
+    model.shared_crop_embedder = None
+    if verbose:
+        print(f"Deploy: {report['reparam']} RepVGG blocks, {report['sinc']} sinc convs, "
+              f"{report['fused']} conv+bn fused, TorchScript: {report['torchscript']} (max abs diff {diff:.2e})")
+    return report
+
+
+if __name__ == '__main__':
+    # latency of freshly initialized models before and after the deploy transform
+    import argparse
+    import tempfile
+    import warnings
+
+    from model import SpeakerNet
+
+    parser = argparse.ArgumentParser(description="Deploy")
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['Raw_ECAPA', 'ECAPA_TDNN:melspectrogram', 'RawNet2v2', 'RawNet2'],
+                        help='model[:features]')
+    parser.add_argument('--n_crops', type=int, default=10)
+    parser.add_argument('--n_samples', type=int, default=8120)
+    parser.add_argument('--n_runs', type=int, default=10)
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    def latency(model, inp):
+        model.forward_crops(inp)
+        t0 = time.perf_counter()
+        for _ in range(args.n_runs):
+            out = model.forward_crops(inp)
+        return (time.perf_counter() - t0) / args.n_runs * 1000, out
+
+    rows = []
+    for name in args.models:
+        model_name, _, features = name.partition(':')
+        model = SpeakerNet(save_path=tempfile.mkdtemp(), model=model_name, features=features or 'raw',
+                           criterion='ARmSoftmax', device='cpu', nOut=512, nClasses=2, sample_rate=8000,
+                           n_mels=80, max_frames=100, lr=0.001, weight_decay=0, step_size=5, lr_decay=0.95,
+                           margin=0.1, scale=30, augment=False, augment_chain=None)
+        model.eval()
+        inp = torch.randn(args.n_crops, args.n_samples) * 0.1
+        before, ref = latency(model, inp)
+        deploy_model(model, n_samples=args.n_samples)
+        after, out = latency(model, inp)
+        rows.append((name, before, after, (out - ref).abs().max().item()))
+
+    print(f"\n{'model':<26}{'eager (ms)':>12}{'deploy (ms)':>13}{'speedup':>9}{'max diff':>10}")
+    for name, before, after, diff in rows:
+        print(f"{name:<26}{before:>12.1f}{after:>13.1f}{before / after:>9.2f}{diff:>10.1e}")
@@ -0,0 +1,212 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+LOCK_FILE = 'lock'
+KEY_SIZE = 20
+
+
+class CacheLockedError(RuntimeError):
+    '''Raised by EmbeddingCache when another process holds the namespace'''
+    pass
+
+
+def _lock(path):
+    '''File descriptor holding an exclusive lock on `path`, None if another process holds it'''
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def key_digest(key):
+    return np.frombuffer(hashlib.sha1(key.encode('utf-8')).digest(), dtype=np.uint8)
+
+
+def file_fingerprint(path, key_mode='stat', block_size=1 << 20):
+    """Identify the content of a file
+
+    Args:
+        path (str): path to the file
+        key_mode (str, optional): 'stat' for path + mtime + size, 'content' for the sha1 of the bytes. Defaults to 'stat'.
+
+    Returns:
+        str: fingerprint
+    """
+    if key_mode == 'content':
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    elif key_mode == 'stat':
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+    else:
+        raise ValueError(f"Invalid cache key mode {key_mode}, available: stat, content")
+
+
+def get_folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(folder) for f in files)
+
+
+class EmbeddingCache(object):
+    """Persistent, size-bounded store of utterance embeddings
+
+    One cache holds the embeddings extracted by one checkpoint with one set of extraction
+    parameters, in the sub folder `root/<namespace>` where the namespace is a hash of both:
+        embeds.f32 - memory-mapped float32 array of slots (n_slots, *shape)
+        keys.u8    - sha1 of the audio key of each slot, checked by `get`
+        index.json - shape and least-recently-used ordered (audio key, slot) pairs
+        lock       - held (flock) by the process using the namespace
+    When the cache reaches `max_size_mb`, the least recently used slot is overwritten: its key
+    is cleared before the new embedding is written, so an index.json not flushed since then
+    (crash, kill) can not return the embedding of another file.
+    Namespaces of other checkpoints are removed (oldest first) to keep the whole root
+    under the same bound, except the ones in use.
+    One process per namespace: CacheLockedError is raised when another process holds it.
+
+    Args:
+        root (str): cache folder
+        checkpoint (str): fingerprint of the model weights
+        params (dict): extraction parameters (json serializable)
+        max_size_mb (int, optional): bound of the cache size. Defaults to 2048.
+        key_mode (str, optional): audio key, see file_fingerprint. Defaults to 'stat'.
+    """
+    def __init__(self, root, checkpoint, params, max_size_mb=2048, key_mode='stat'):
+        self.root = root
+        self.key_mode = key_mode
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+        description = json.dumps({'checkpoint': checkpoint, 'params': params}, sort_keys=True)
+        self.namespace = hashlib.sha1(description.encode('utf-8')).hexdigest()
+        self.path = os.path.join(root, self.namespace)
+        self.data_path = os.path.join(self.path, 'embeds.f32')
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.keys_path = os.path.join(self.path, 'keys.u8')
+
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = _lock(os.path.join(self.path, LOCK_FILE))
+        if self.lock is None:
+            raise CacheLockedError(f"Embedding cache {self.path} is used by another process")
+        self.prune(keep=self.namespace)
+
+        self.shape = None
+        self.entries = OrderedDict()
+        self.n_slots = 0
+        self.data = None
+        self.keys = None
+        self.dirty = False
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.shape = tuple(index['shape'])
+            self.entries = OrderedDict((key, slot) for key, slot in index['entries'])
+            self._open(index['n_slots'])
+        else:
+            with open(os.path.join(self.path, 'description.json'), 'w') as f:
+                f.write(description)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def key(self, path):
+        return file_fingerprint(path, key_mode=self.key_mode)
+
+    @property
+    def capacity(self):
+        return max(1, self.max_size // (int(np.prod(self.shape)) * 4))
+
+    def _open(self, n_slots):
+        if n_slots == 0:
+            return
+        # grow the data file then map it again
+        with open(self.data_path, 'ab') as f:
+            f.truncate(n_slots * int(np.prod(self.shape)) * 4)
+        with open(self.keys_path, 'ab') as f:
+            f.truncate(n_slots * KEY_SIZE)
+        self.data = np.memmap(self.data_path, dtype=np.float32, mode='r+', shape=(n_slots, *self.shape))
+        self.keys = np.memmap(self.keys_path, dtype=np.uint8, mode='r+', shape=(n_slots, KEY_SIZE))
+        self.n_slots = n_slots
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        slot = self.entries[key]
+        if not np.array_equal(self.keys[slot], key_digest(key)):
+            # the slot was reused after the last flush of the index
+            del self.entries[key]
+            self.dirty = True
+            return None
+        self.entries.move_to_end(key)
+        self.dirty = True
+        return np.array(self.data[slot])
+
+    def put(self, key, embed):
+        embed = np.asarray(embed, dtype=np.float32)
+        if self.shape is None:
+            self.shape = embed.shape
+        if embed.shape != self.shape:
+            raise ValueError(f"Embedding shape {embed.shape} does not match the cache {self.shape}")
+
+        if key in self.entries:
+            slot = self.entries[key]
+            self.entries.move_to_end(key)
+        elif len(self.entries) < self.capacity:
+            slot = len(self.entries)
+            if slot >= self.n_slots:
+                self._open(min(self.capacity, max(slot + 1, 2 * self.n_slots, 1024)))
+            self.entries[key] = slot
+        else:
+            # evict the least recently used embedding
+            _, slot = self.entries.popitem(last=False)
+            self.entries[key] = slot
+
+        # the slot no longer holds its previous key while it is written
+        self.keys[slot] = 0
+        self.data[slot] = embed
+        self.keys[slot] = key_digest(key)
+        self.dirty = True
+
+    def flush(self):
+        if not self.dirty or self.shape is None:
+            return
+        self.data.flush()
+        self.keys.flush()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'shape': list(self.shape),
+                       'n_slots': self.n_slots,
+                       'entries': list(self.entries.items())}, f)
+        os.replace(tmp_path, self.index_path)
+        self.dirty = False
+
+    def prune(self, keep=None):
+        """Remove the least recently modified namespaces until the root fits in max_size"""
+        namespaces = [os.path.join(self.root, name) for name in os.listdir(self.root) if name != keep]
+        namespaces = [path for path in namespaces if os.path.isdir(path)]
+        namespaces.sort(key=os.path.getmtime)
+
+        total_size = get_folder_size(self.root)
+        for path in namespaces:
+            if total_size <= self.max_size:
+                break
+            lock = _lock(os.path.join(path, LOCK_FILE))
+            if lock is None:
+                # used by another process
+                continue
+            total_size -= get_folder_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+            os.close(lock)
@@ -0,0 +1,251 @@
+import json
+import os
+
+import numpy as np
+
+
+def check_speaker_id(speaker):
+    '''Speaker id as stored in the journal, ValueError for an empty id or one with whitespace'''
+    speaker = str(speaker)
+    if not speaker or any(c.isspace() for c in speaker):
+        raise ValueError(f"Invalid speaker id '{speaker}'")
+    return speaker
+
+
+class EnrollmentDB(object):
+    """Append-only, memory-mapped store of speaker voiceprints
+
+    Layout of the folder:
+        meta.json    - embedding dimension and number of crops of a voiceprint
+        vectors.f32  - float32 voiceprints (n_crops, dim), only ever appended
+        journal.log  - one line per operation: "enroll <row> <count> <speaker_id>" or "delete <speaker_id>",
+                       "compact <generation>" first after a compaction
+        snapshot.npz - speaker_id -> (row, count) up to a byte offset of the journal
+    A voiceprint is, for each crop index, the mean of the enrolled crop embeddings of a speaker
+    (as the per-crop voiceprints of embeds.pt), `count` is the number of utterances it averages.
+    Enrolling or updating a speaker appends a new row and a journal line, deleting only appends
+    a journal line, the rows left behind are dropped by `compact`.
+    Opening only maps the vectors, the speaker index is loaded from the snapshot on first use and
+    only the journal lines written after it are replayed.
+
+    Args:
+        path (str): folder of the store
+        dim (int, optional): embedding dimension, required to create a new store. Defaults to None.
+        n_crops (int, optional): crops of a voiceprint (num_eval), used to create a new store. Defaults to 1.
+        snapshot_interval (int, optional): journal lines after which the snapshot is written again. Defaults to 10000.
+    """
+    def __init__(self, path, dim=None, n_crops=None, snapshot_interval=10000):
+        self.path = str(path)
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        self.vectors_path = os.path.join(self.path, 'vectors.f32')
+        self.journal_path = os.path.join(self.path, 'journal.log')
+        self.snapshot_path = os.path.join(self.path, 'snapshot.npz')
+        self.snapshot_interval = snapshot_interval
+
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.n_crops = meta.get('n_crops', 1)
+            if dim is not None and dim != self.dim:
+                raise ValueError(f"Dimension {dim} does not match the enrollment store {self.dim}")
+            if n_crops is not None and n_crops != self.n_crops:
+                raise ValueError(f"Number of crops {n_crops} does not match the enrollment store {self.n_crops}")
+        else:
+            if dim is None:
+                raise ValueError(f"No enrollment store in {self.path}, provide the dimension to create one")
+            self.dim = int(dim)
+            self.n_crops = int(n_crops or 1)
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': self.dim, 'n_crops': self.n_crops}, f)
+            open(self.vectors_path, 'ab').close()
+            open(self.journal_path, 'a').close()
+
+        self._vectors = None
+        self._index = None
+        # journal lines not covered by the snapshot
+        self._tail = 0
+
+    # ------------------------------------------------------------------ index
+    def _generation(self):
+        '''number of compactions of the journal, from its first line'''
+        with open(self.journal_path) as f:
+            op, _, args = f.readline().rstrip('\n').partition(' ')
+        return int(args) if op == 'compact' else 0
+
+    def _load_snapshot(self):
+        '''index and journal offset of the snapshot, empty if missing or of an older journal'''
+        if os.path.isfile(self.snapshot_path):
+            snapshot = np.load(self.snapshot_path)
+            if int(snapshot['generation']) == self._generation():
+                index = dict(zip(snapshot['speakers'].tolist(),
+                                 zip(snapshot['rows'].tolist(), snapshot['counts'].tolist())))
+                return index, int(snapshot['offset'])
+        return {}, 0
+
+    @property
+    def index(self):
+        '''speaker_id -> (row, count), the snapshot and the journal lines after it, on first use'''
+        if self._index is None:
+            index, offset = self._load_snapshot()
+            self._tail = 0
+            with open(self.journal_path) as f:
+                f.seek(offset)
+                for line in f:
+                    op, args = line.rstrip('\n').split(' ', 1)
+                    if op == 'enroll':
+                        row, count, speaker = args.split(' ', 2)
+                        index[speaker] = (int(row), int(count))
+                    elif op == 'delete':
+                        index.pop(args, None)
+                    self._tail += 1
+            self._index = index
+        return self._index
+
+    def version(self):
+        '''[generation, journal size]: changes with every enroll, update, delete and compaction'''
+        return [self._generation(), os.path.getsize(self.journal_path)]
+
+    def save_snapshot(self):
+        """Write the speaker index and the journal size it covers, the next opening replays only later lines"""
+        index = self.index
+        speakers = list(index.keys())
+        rows_counts = np.array([index[speaker] for speaker in speakers], dtype=np.int64).reshape(-1, 2)
+        tmp_path = self.snapshot_path + '.tmp.npz'
+        np.savez(tmp_path, speakers=np.array(speakers, dtype=str), rows=rows_counts[:, 0], counts=rows_counts[:, 1],
+                 offset=os.path.getsize(self.journal_path), generation=self._generation())
+        os.replace(tmp_path, self.snapshot_path)
+        self._tail = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, speaker):
+        return str(speaker) in self.index
+
+    def speakers(self):
+        return list(self.index.keys())
+
+    @property
+    def n_rows(self):
+        return os.path.getsize(self.vectors_path) // (4 * self.n_crops * self.dim)
+
+    @property
+    def vectors(self):
+        '''memory-mapped voiceprints (n_rows, n_crops, dim), mapped again after appends'''
+        n_rows = self.n_rows
+        if self._vectors is None or self._vectors.shape[0] != n_rows:
+            if n_rows == 0:
+                return np.zeros((0, self.n_crops, self.dim), dtype=np.float32)
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                      shape=(n_rows, self.n_crops, self.dim))
+        return self._vectors
+
+    # ------------------------------------------------------------------ operations
+    def _log(self, line):
+        with open(self.journal_path, 'a') as f:
+            f.write(line)
+        self._tail += 1
+        if self._tail >= self.snapshot_interval:
+            self.save_snapshot()
+
+    def _append(self, speaker, vector, count):
+        vector = np.asarray(vector, dtype=np.float32).reshape(self.n_crops, self.dim)
+        row = self.n_rows
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vector.tobytes())
+        self.index[speaker] = (row, count)
+        self._log(f"enroll {row} {count} {speaker}\n")
+
+    def _crop_embeds(self, embeds):
+        '''utterance embeddings as (n_utterances, n_crops, dim)'''
+        return np.asarray(embeds, dtype=np.float32).reshape(-1, self.n_crops, self.dim)
+
+    def enroll(self, speaker, embeds):
+        """Add utterance embeddings (n, n_crops, dim) or (n_crops, dim) to a speaker, averaged with the ones already enrolled"""
+        speaker = check_speaker_id(speaker)
+        embeds = self._crop_embeds(embeds)
+        vector = embeds.mean(axis=0)
+        count = embeds.shape[0]
+        if speaker in self.index:
+            row, old_count = self.index[speaker]
+            vector = (self.vectors[row] * old_count + vector * count) / (old_count + count)
+            count += old_count
+        self._append(speaker, vector, count)
+
+    def update(self, speaker, embeds):
+        """Replace the voiceprint of a speaker by the mean of the given utterance embeddings"""
+        speaker = check_speaker_id(speaker)
+        embeds = self._crop_embeds(embeds)
+        self._append(speaker, embeds.mean(axis=0), embeds.shape[0])
+
+    def delete(self, speaker):
+        speaker = str(speaker)
+        if speaker not in self.index:
+            raise KeyError(speaker)
+        del self.index[speaker]
+        self._log(f"delete {speaker}\n")
+
+    def get(self, speaker):
+        '''voiceprint (n_crops, dim) of a speaker'''
+        row, _ = self.index[str(speaker)]
+        return np.array(self.vectors[row])
+
+    def matrix(self):
+        """Enrolled speakers and their voiceprints averaged over the crops (n_speakers, dim)"""
+        speakers = self.speakers()
+        rows = np.array([self.index[speaker][0] for speaker in speakers], dtype=np.int64)
+        return speakers, np.asarray(self.vectors[rows]).mean(axis=1) if len(rows) else np.zeros((0, self.dim), dtype=np.float32)
+
+    def scores(self, embeds, speakers=None, chunk_size=4096):
+        """Scores of an utterance against voiceprints: 1 - d ** 2 / 2, d the distance between
+        aligned crop embeddings (F.pairwise_distance) averaged over the crops
+
+        Args:
+            embeds (np.ndarray): crop embeddings of the utterance (n_crops, dim), any number of crops
+                for a store of one crop voiceprints
+            speakers (list, optional): speakers to score, all the enrolled ones if None. Defaults to None.
+
+        Returns:
+            tuple: speaker ids and their scores
+        """
+        embeds = np.asarray(embeds, dtype=np.float32).reshape(-1, self.dim)
+        if self.n_crops != 1 and embeds.shape[0] != self.n_crops:
+            raise ValueError(f"{embeds.shape[0]} crops, the voiceprints have {self.n_crops} (num_eval of the enrollment)")
+        speakers = self.speakers() if speakers is None else [str(speaker) for speaker in speakers]
+        rows = np.array([self.index[speaker][0] for speaker in speakers], dtype=np.int64)
+        dist = np.zeros(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), chunk_size):
+            voiceprints = np.asarray(self.vectors[rows[start:start + chunk_size]])
+            # eps of F.pairwise_distance
+            dist[start:start + chunk_size] = np.linalg.norm(embeds[None] - voiceprints + 1e-6, axis=2).mean(axis=1)
+        return speakers, 1 - dist ** 2 / 2
+
+    @property
+    def dead_ratio(self):
+        '''fraction of rows no longer referenced, compact when it gets large'''
+        n_rows = self.n_rows
+        return 1 - len(self.index) / n_rows if n_rows else 0.0
+
+    def compact(self):
+        """Rewrite the store with only the live voiceprints"""
+        speakers = self.speakers()
+        rows = np.array([self.index[speaker][0] for speaker in speakers], dtype=np.int64)
+        counts = [self.index[speaker][1] for speaker in speakers]
+        generation = self._generation() + 1
+
+        with open(self.vectors_path + '.tmp', 'wb') as f:
+            for start in range(0, len(rows), 4096):
+                f.write(np.ascontiguousarray(self.vectors[rows[start:start + 4096]], dtype=np.float32).tobytes())
+        with open(self.journal_path + '.tmp', 'w') as f:
+            # a snapshot of an older generation is not used with this journal
+            f.write(f"compact {generation}\n")
+            for row, (speaker, count) in enumerate(zip(speakers, counts)):
+                f.write(f"enroll {row} {count} {speaker}\n")
+
+        self._vectors = None
+        os.replace(self.vectors_path + '.tmp', self.vectors_path)
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self._index = {speaker: (row, count) for row, (speaker, count) in enumerate(zip(speakers, counts))}
+        self.save_snapshot()
@@ -0,0 +1,315 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def _sorted_trials(scores, labels):
+    '''Scores sorted ascending, target / non-target indicators in the same order'''
+    scores = np.nan_to_num(np.asarray(scores, dtype=np.float64).reshape(-1))
+    labels = np.nan_to_num(np.asarray(labels, dtype=np.float64).reshape(-1)) > 0
+    order = np.argsort(scores, kind='stable')
+    return scores[order], labels[order]
+
+
+def _curve(sorted_scores, target_counts, nontarget_counts):
+    """Miss / false alarm rates at every distinct score of a sorted trial list
+
+    A trial is accepted when its score >= threshold, the last threshold (+inf) rejects
+    every trial. Counts can be weights (bootstrap replicates, histogram bins).
+    """
+    first = np.ones(len(sorted_scores), dtype=bool)
+    first[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    # trials strictly below each distinct score
+    targets_below = np.concatenate([[0], np.cumsum(target_counts, dtype=np.float64)])
+    nontargets_below = np.concatenate([[0], np.cumsum(nontarget_counts, dtype=np.float64)])
+    index = np.concatenate([np.flatnonzero(first), [len(sorted_scores)]])
+    n_target, n_nontarget = targets_below[-1], nontargets_below[-1]
+    fnr = targets_below[index] / max(n_target, 1)
+    fpr = 1 - nontargets_below[index] / max(n_nontarget, 1)
+    thresholds = np.concatenate([sorted_scores[first], [np.inf]])
+    return fnr, fpr, thresholds
+
+
+def error_rates(scores, labels):
+    """Miss and false alarm rates of a trial list at every threshold, one sort + cumulative sums
+
+    Args:
+        scores (array-like): score of each trial
+        labels (array-like): 1 for target trials, 0 for non-target trials
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): fnr (increasing), fpr (decreasing), thresholds (increasing)
+    """
+    sorted_scores, sorted_labels = _sorted_trials(scores, labels)
+    return _curve(sorted_scores, sorted_labels, ~sorted_labels)
+
+
+def eer(fnr, fpr, thresholds):
+    '''EER (%) and its threshold: point of the curve where fnr and fpr are the closest'''
+    idx = np.nanargmin(np.abs(fnr - fpr))
+    return (fnr[idx] + fpr[idx]) / 2 * 100, thresholds[idx]
+
+
+def min_dcf(fnr, fpr, thresholds, p_target=0.05, c_miss=1, c_fa=1):
+    """Minimum of the normalized detection cost (NIST SRE 2016 plan, section 3)
+
+    Returns:
+        (float, float): min DCF and its threshold
+    """
+    c_det = c_miss * p_target * fnr + c_fa * (1 - p_target) * fpr
+    idx = np.argmin(c_det)
+    c_def = min(c_miss * p_target, c_fa * (1 - p_target))
+    return c_det[idx] / c_def, thresholds[idx]
+
+
+def tune_thresholds(fnr, fpr, thresholds, target_fa=(), target_fr=()):
+    """Thresholds closest to target false alarm / miss rates (%)
+
+    Returns:
+        list: [threshold, fpr (%), fnr (%)] for each target_fr then each target_fa
+    """
+    tuned = []
+    # fnr increases and fpr decreases with the threshold, -fpr is searched instead
+    for targets, rates, sign in ((target_fr, fnr, 1), (target_fa, fpr, -1)):
+        rates = sign * rates * 100
+        targets = sign * np.asarray(targets, dtype=np.float64)
+        # the closest point is a neighbour of the insertion point, the first one of equal rates
+        idx = np.clip(np.searchsorted(rates, targets), 1, len(rates) - 1)
+        idx = np.where(np.abs(rates[idx - 1] - targets) <= np.abs(rates[idx] - targets), idx - 1, idx)
+        idx = np.searchsorted(rates, rates[idx])
+        tuned.extend([thresholds[i], fpr[i] * 100, fnr[i] * 100] for i in idx)
+    return tuned
+
+
+def auc(fnr, fpr):
+    '''Area under the ROC curve (tpr against fpr)'''
+    tpr = 1 - fnr
+    # trapezoids, fpr decreases along the curve
+    return float(np.sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2))
+
+
+def summarize(fnr, fpr, thresholds, p_targets=(0.01, 0.05), c_miss=1, c_fa=1, target_fa=(), target_fr=()):
+    """EER, minDCF at several operating points, AUC and tuned thresholds of an error curve
+
+    Returns:
+        dict: eer (%), eer_threshold, min_dcf {p_target: (min DCF, threshold)}, auc, tuned
+    """
+    eer_value, eer_threshold = eer(fnr, fpr, thresholds)
+    return {'eer': eer_value,
+            'eer_threshold': eer_threshold,
+            'min_dcf': {p: min_dcf(fnr, fpr, thresholds, p, c_miss, c_fa) for p in np.atleast_1d(p_targets)},
+            'auc': auc(fnr, fpr),
+            'tuned': tune_thresholds(fnr, fpr, thresholds, target_fa, target_fr)}
+
+
+def evaluate(scores, labels, **kwargs):
+    '''summarize() of the error curve of a trial list, kwargs: p_targets, c_miss, c_fa, target_fa, target_fr'''
+    return summarize(*error_rates(scores, labels), **kwargs)
+
+
+class ScoreHistogram(object):
+    """Target / non-target score counts on fixed bins, for trial lists that do not fit in memory
+
+    Chunks of scores are added with `update` (histograms of several workers with `merge`),
+    the error curve is then evaluated at the bin edges: exact at those thresholds, the EER
+    and min DCF are within one bin of the exact ones.
+
+    Args:
+        low (float, optional): lower edge of the first bin, lower scores are counted in it. Defaults to -1.
+        high (float, optional): upper edge of the last bin, higher scores are counted in it. Defaults to 1.
+        n_bins (int, optional): number of bins. Defaults to 100000.
+    """
+    def __init__(self, low=-1.0, high=1.0, n_bins=100000):
+        self.low = low
+        self.high = high
+        self.n_bins = n_bins
+        self.targets = np.zeros(n_bins, dtype=np.int64)
+        self.nontargets = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, scores, labels):
+        scores = np.nan_to_num(np.asarray(scores, dtype=np.float64).reshape(-1))
+        labels = np.nan_to_num(np.asarray(labels, dtype=np.float64).reshape(-1)) > 0
+        bins = np.clip(((scores - self.low) / (self.high - self.low) * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        self.targets += np.bincount(bins[labels], minlength=self.n_bins)
+        self.nontargets += np.bincount(bins[~labels], minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        if (other.low, other.high, other.n_bins) != (self.low, self.high, self.n_bins):
+            raise ValueError("Histograms with different bins can not be merged")
+        self.targets += other.targets
+        self.nontargets += other.nontargets
+        return self
+
+    def __len__(self):
+        return int(self.targets.sum() + self.nontargets.sum())
+
+    def error_rates(self):
+        '''fnr, fpr, thresholds at the lower edges of the bins (+inf last)'''
+        edges = self.low + (self.high - self.low) * np.arange(self.n_bins) / self.n_bins
+        return _curve(edges, self.targets, self.nontargets)
+
+    def evaluate(self, **kwargs):
+        return summarize(*self.error_rates(), **kwargs)
+
+
+# trials of the bootstrap workers, set once per process
+_bootstrap_trials = None
+
+
+def _init_bootstrap(sorted_scores, sorted_labels):
+    global _bootstrap_trials
+    _bootstrap_trials = (sorted_scores, sorted_labels)
+
+
+def _bootstrap_replicates(seeds, p_target, c_miss, c_fa):
+    sorted_scores, sorted_labels = _bootstrap_trials
+    n_trials = len(sorted_scores)
+    results = []
+    for seed in seeds:
+        # resampling with replacement: number of draws of each trial
+        counts = np.bincount(np.random.default_rng(seed).integers(0, n_trials, n_trials), minlength=n_trials)
+        curve = _curve(sorted_scores, counts * sorted_labels, counts * ~sorted_labels)
+        results.append((eer(*curve)[0], min_dcf(*curve, p_target, c_miss, c_fa)[0]))
+    return results
+
+
+def bootstrap(scores, labels, n_boot=1000, p_target=0.05, c_miss=1, c_fa=1, confidence=0.95, n_jobs=None, seed=0):
+    """Confidence intervals of the EER and min DCF by resampling the trials with replacement
+
+    The trials are sorted once, a replicate only draws counts per trial and recomputes
+    the cumulative sums. Replicates are spread over `n_jobs` processes.
+
+    Args:
+        n_boot (int, optional): number of replicates. Defaults to 1000.
+        confidence (float, optional): level of the percentile intervals. Defaults to 0.95.
+        n_jobs (int, optional): worker processes, None for the number of cpus, 1 to run inline.
+        seed (int, optional): seed of the replicates, results do not depend on n_jobs. Defaults to 0.
+
+    Returns:
+        dict: eer and min_dcf as (value on the full list, lower bound, upper bound)
+    """
+    sorted_scores, sorted_labels = _sorted_trials(scores, labels)
+    seeds = np.random.SeedSequence(seed).spawn(n_boot)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, n_boot)
+
+    if n_jobs <= 1:
+        _init_bootstrap(sorted_scores, sorted_labels)
+        replicates = _bootstrap_replicates(seeds, p_target, c_miss, c_fa)
+    else:
+        chunks = [seeds[i::n_jobs] for i in range(n_jobs)]
+        with ProcessPoolExecutor(n_jobs, initializer=_init_bootstrap, initargs=(sorted_scores, sorted_labels)) as pool:
+            results = list(pool.map(_bootstrap_replicates, chunks, *([arg] * n_jobs for arg in (p_target, c_miss, c_fa))))
+        # back to the order of the seeds
+        replicates = [None] * n_boot
+        for i, chunk in enumerate(results):
+            replicates[i::n_jobs] = chunk
+
+    replicates = np.asarray(replicates)
+    curve = _curve(sorted_scores, sorted_labels, ~sorted_labels)
+    full = (eer(*curve)[0], min_dcf(*curve, p_target, c_miss, c_fa)[0])
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(replicates, [tail, 100 - tail], axis=0)
+    return {'eer': (full[0], low[0], high[0]), 'min_dcf': (full[1], low[1], high[1])}
+
+
+def _reference_error_rates(scores, labels):
+    '''Loop implementation of the previous utils.ComputeErrorRates, reference of the checks below'''
+    from operator import itemgetter
+    sorted_indexes, thresholds = zip(*sorted(
+        [(index, threshold) for index, threshold in enumerate(scores)],
+        key=itemgetter(1)))
+    labels = [labels[i] for i in sorted_indexes]
+    fnrs = []
+    fprs = []
+    for i in range(0, len(labels)):
+        if i == 0:
+            fnrs.append(labels[i])
+            fprs.append(1 - labels[i])
+        else:
+            fnrs.append(fnrs[i-1] + labels[i])
+            fprs.append(fprs[i-1] + 1 - labels[i])
+    fnrs_norm = sum(labels)
+    fprs_norm = len(labels) - fnrs_norm
+    fnrs = [x / float(fnrs_norm) for x in fnrs]
+    fprs = [1 - x / float(fprs_norm) for x in fprs]
+    return fnrs, fprs, thresholds
+
+
+def _reference_min_dcf(fnrs, fprs, thresholds, p_target, c_miss, c_fa):
+    '''Loop implementation of the previous utils.ComputeMinDcf'''
+    min_c_det = float("inf")
+    min_c_det_threshold = thresholds[0]
+    for i in range(0, len(fnrs)):
+        c_det = c_miss * fnrs[i] * p_target + c_fa * fprs[i] * (1 - p_target)
+        if c_det < min_c_det:
+            min_c_det = c_det
+            min_c_det_threshold = thresholds[i]
+    c_def = min(c_miss * p_target, c_fa * (1 - p_target))
+    return min_c_det / c_def, min_c_det_threshold
+
+
+if __name__ == '__main__':
+    # exactness against the previous loop implementations and sklearn, timings on a synthetic trial list
+    import argparse
+    import time
+
+    from sklearn.metrics import roc_curve
+
+    from utils import ComputeErrorRates, ComputeMinDcf
+
+    parser = argparse.ArgumentParser(description="EvalMetrics")
+    parser.add_argument('--n_trials', type=int, default=10_000_000)
+    parser.add_argument('--n_boot', type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    labels = rng.random(args.n_trials) < 0.1
+    scores = np.where(labels, rng.normal(0.6, 0.15, args.n_trials), rng.normal(0.1, 0.15, args.n_trials)).round(4)
+
+    t0 = time.perf_counter()
+    result = evaluate(scores, labels, p_targets=(0.01, 0.05), target_fa=np.linspace(5, 0, num=50))
+    print(f"{args.n_trials} trials: EER {result['eer']:.4f}%, minDCF(0.05) {result['min_dcf'][0.05][0]:.5f}, "
+          f"AUC {result['auc']:.5f} in {time.perf_counter() - t0:.2f}s")
+
+    histogram = ScoreHistogram(low=-1, high=2)
+    t0 = time.perf_counter()
+    for start in range(0, args.n_trials, 1_000_000):
+        histogram.update(scores[start:start + 1_000_000], labels[start:start + 1_000_000])
+    streamed = histogram.evaluate(p_targets=(0.05,))
+    print(f"histogram: EER {streamed['eer']:.4f}%, minDCF(0.05) {streamed['min_dcf'][0.05][0]:.5f} "
+          f"in {time.perf_counter() - t0:.2f}s")
+
+    n_small = 200_000
+    small_scores, small_labels = scores[:n_small], labels[:n_small]
+    # tied scores (rounded) for the curve against sklearn, distinct scores for the per-trial loops
+    fpr_ref, tpr_ref, thresholds_ref = roc_curve(small_labels, small_scores, drop_intermediate=False)
+    fnr, fpr, thresholds = error_rates(small_scores, small_labels)
+    same_curve = (np.allclose(fpr[::-1], fpr_ref, rtol=0, atol=1e-12) and np.allclose(1 - fnr[::-1], tpr_ref, rtol=0, atol=1e-12)
+                  and np.array_equal(thresholds[-2::-1], thresholds_ref[1:]))
+    print(f"{n_small} tied trials, curve same as sklearn roc_curve: {same_curve}")
+
+    distinct_scores = small_scores + rng.normal(0, 1e-6, n_small)
+    t0 = time.perf_counter()
+    reference_curve = _reference_error_rates(list(distinct_scores), list(small_labels.astype(int)))
+    reference = _reference_min_dcf(*reference_curve, 0.05, 1, 1)
+    t1 = time.perf_counter()
+    vectorized = min_dcf(*error_rates(distinct_scores, small_labels), 0.05)
+    t2 = time.perf_counter()
+    print(f"{n_small} trials, minDCF loops {reference[0]:.6f} at {reference[1]:.6f} ({t1 - t0:.2f}s) "
+          f"vs vectorized {vectorized[0]:.6f} at {vectorized[1]:.6f} ({t2 - t1:.3f}s)")
+
+    # utils keeps the per-trial lists of the loops
+    utils_curve = ComputeErrorRates(list(small_scores), list(small_labels.astype(int)))
+    reference_curve = _reference_error_rates(list(small_scores), list(small_labels.astype(int)))
+    same_utils = (all(np.allclose(a, b, rtol=0, atol=1e-12) for a, b in zip(utils_curve[:2], reference_curve[:2]))
+                  and utils_curve[2] == reference_curve[2] and isinstance(utils_curve[0], list)
+                  and ComputeMinDcf(*utils_curve, 0.05, 1, 1) == _reference_min_dcf(*reference_curve, 0.05, 1, 1))
+    print(f"utils.ComputeErrorRates / ComputeMinDcf same as the loops: {same_utils}")
+
+    t0 = time.perf_counter()
+    intervals = bootstrap(scores[:1_000_000], labels[:1_000_000], n_boot=args.n_boot)
+    print(f"bootstrap ({args.n_boot} x 1M trials) in {time.perf_counter() - t0:.1f}s: "
+          f"EER {intervals['eer'][0]:.3f}% [{intervals['eer'][1]:.3f}, {intervals['eer'][2]:.3f}], "
+          f"minDCF {intervals['min_dcf'][0]:.4f} [{intervals['min_dcf'][1]:.4f}, {intervals['min_dcf'][2]:.4f}]")
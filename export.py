@@ -1,3 +1,4 @@
+import glob
 import os
 import sys
 import time
@@ -10,7 +11,8 @@ import argparse
 
 def export_model(args, check=True):
     model = SpeakerNet(**vars(args))
-    
+    model_save_path = os.path.join(args.save_path, f"{args.model}/{args.criterion}/model")
+
     # priority: define weight -> best weight -> last weight
     if args.initial_model_infer:
         chosen_model_state = args.initial_model_infer
@@ -22,5 +24,5 @@ def export_model(args, check=True):
         chosen_model_state = model_files[-1]
     print("Export from ", chosen_model_state)
     
-    model.export_onnx(chosen_model_state, check=check)
+    return model.export_onnx(chosen_model_state, check=check, save_path=args.onnx_path)
     
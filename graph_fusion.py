@@ -0,0 +1,126 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+CONV_TYPES = (nn.Conv1d, nn.Conv2d)
+BN_TYPES = (nn.BatchNorm1d, nn.BatchNorm2d)
+
+
+def get_module(root, name):
+    module = root
+    for attr in name.split('.'):
+        module = getattr(module, attr)
+    return module
+
+
+def set_module(root, name, new_module):
+    parent_name, _, attr = name.rpartition('.')
+    parent = get_module(root, parent_name) if parent_name else root
+    setattr(parent, attr, new_module)
+
+
+def find_conv_bn_pairs(model, example_input):
+    """Find the BatchNorm layers that directly normalize the output of a convolution
+
+    A forward pass records the output tensor of every conv, a BN whose input is that
+    very tensor is paired with it. The module structure is not enough since the blocks
+    of models/ apply activations and transposes between their conv and BN members.
+
+    Args:
+        model (nn.Module): model in eval mode
+        example_input (torch.Tensor): input of the forward pass
+
+    Returns:
+        list: (conv name, bn name)
+    """
+    conv_outputs = {}
+    pairs = []
+    handles = []
+
+    def conv_hook(name):
+        def hook(module, inputs, output):
+            conv_outputs[id(output)] = (name, output)
+        return hook
+
+    def bn_hook(name):
+        def hook(module, inputs):
+            found = conv_outputs.get(id(inputs[0]))
+            if found is not None and found[1] is inputs[0]:
+                conv = get_module(model, found[0])
+                if conv.out_channels == module.num_features and (found[0], name) not in pairs:
+                    pairs.append((found[0], name))
+        return hook
+
+    for name, module in model.named_modules():
+        if isinstance(module, CONV_TYPES):
+            handles.append(module.register_forward_hook(conv_hook(name)))
+        elif isinstance(module, BN_TYPES) and module.track_running_stats:
+            handles.append(module.register_forward_pre_hook(bn_hook(name)))
+    try:
+        with torch.no_grad():
+            model(example_input)
+    finally:
+        for handle in handles:
+            handle.remove()
+    # a conv reused with several BN (or the other way around) can not be folded
+    convs = [conv for conv, _ in pairs]
+    bns = [bn for _, bn in pairs]
+    return [(conv, bn) for conv, bn in pairs if convs.count(conv) == 1 and bns.count(bn) == 1]
+
+
+def fuse_pairs(model, pairs):
+    '''Fold each BN into its conv (eval statistics) and replace the BN by an identity'''
+    for conv_name, bn_name in pairs:
+        conv, bn = get_module(model, conv_name), get_module(model, bn_name)
+        set_module(model, conv_name, fuse_conv_bn_eval(conv, bn))
+        set_module(model, bn_name, nn.Identity())
+    return model
+
+
+def fuse_conv_bn(model, example_input, tolerance=1e-4, verbose=True):
+    """Fold the BatchNorm layers that follow a convolution into it, in place
+
+    The fused model is checked against the original on `example_input`, if a conv output
+    is also used outside of its BN (e.g. a residual) the pairs are checked one by one
+    and only those keeping the output are fused.
+
+    Args:
+        model (nn.Module): model in eval mode
+        example_input (torch.Tensor): input of the forward passes
+        tolerance (float, optional): max abs difference allowed, relative to the output scale. Defaults to 1e-4.
+
+    Returns:
+        list: fused (conv name, bn name)
+    """
+    model.eval()
+    pairs = find_conv_bn_pairs(model, example_input)
+    if not pairs:
+        return []
+    with torch.no_grad():
+        ref = model(example_input)
+    scale = max(1.0, ref.abs().max().item())
+
+    def matches(candidate):
+        with torch.no_grad():
+            out = candidate(example_input)
+        return out.shape == ref.shape and (out - ref).abs().max().item() <= tolerance * scale
+
+    originals = {name: get_module(model, name) for pair in pairs for name in pair}
+    fuse_pairs(model, pairs)
+    if matches(model):
+        fused = pairs
+    else:
+        # restore and keep the pairs that do not change the output
+        for name, module in originals.items():
+            set_module(model, name, module)
+        fused = []
+        for pair in pairs:
+            fuse_pairs(model, [pair])
+            if matches(model):
+                fused.append(pair)
+            else:
+                for name in pair:
+                    set_module(model, name, originals[name])
+    if verbose:
+        print(f"Fused {len(fused)}/{len(pairs)} conv + batchnorm pairs")
+    return fused
@@ -11,11 +11,14 @@ from pathlib import Path
 import numpy as np
 import torch
 import torch.nn.functional as F
+from enrollment import EnrollmentDB
 from model import SpeakerNet
+from speaker_index import load_index
 from sklearn.metrics import (accuracy_score, classification_report,
                              confusion_matrix, fbeta_score, roc_curve)
 from tqdm import tqdm
-from utils import ComputeErrorRates, ComputeMinDcf, tuneThresholdfromScore
+from eval_metrics import bootstrap, error_rates, min_dcf
+from utils import tuneThresholdfromScore
 
 # ---------------------------------//
 
@@ -62,11 +65,14 @@ def inference(args):
     print(f'Loading model from {chosen_model_state}')
     model.loadParameters(chosen_model_state)
     model.eval()
+    if args.deploy:
+        model.deploy()
     
     # set defalut threshold
     threshold = args.test_threshold
     scoring_mode = args.scoring_mode
     num_eval = args.num_eval
+    enrollment_path = args.enrollment_path or os.path.join(args.save_path, 'enrollment')
 
     ############################################## Evaluation from list
     if args.eval is True:
@@ -83,11 +89,12 @@ def inference(args):
         # results['roc'] = [tunedThreshold, eer, metrics.auc(fpr, tpr), optimal_threshold]
         # results['prec_recall'] = [precision, recall, fscore[ixPR], thresholds_[ixPR]]
 
-        result = tuneThresholdfromScore(sc, lab, target_fa) 
+        # one sort of the scores for every metric
+        curve = error_rates(sc, lab)
+        result = tuneThresholdfromScore(sc, lab, target_fa, curve=curve)
         
         ####
-        fnrs, fprs, thresholds = ComputeErrorRates(sc, lab)
-        mindcf, threshold = ComputeMinDcf(fnrs, fprs, thresholds, args.dcf_p_target, args.dcf_c_miss, args.dcf_c_fa)
+        mindcf, threshold = min_dcf(*curve, args.dcf_p_target, args.dcf_c_miss, args.dcf_c_fa)
         ####
 
         # print('tfa [thre, fpr, fnr]')
@@ -112,6 +119,14 @@ def inference(args):
              f" EER {result['roc'][1]}% at threshold {result['roc'][-1]}\nAUC {result['roc'][2]}\n",
              f"Gmean result:\n",
              f"EER: {(1 - result['gmean'][1]) * 100}% at threshold {result['gmean'][2]}\n>>> ACC: {result['gmean'][1] * 100}%\n=================>\n"])
+        if args.eval_bootstrap > 0:
+            intervals = bootstrap(sc, lab, n_boot=args.eval_bootstrap,
+                                  p_target=args.dcf_p_target, c_miss=args.dcf_c_miss, c_fa=args.dcf_c_fa)
+            ci = (f"95% CI ({args.eval_bootstrap} bootstrap replicates): "
+                  f"EER [{intervals['eer'][1]:.4f}, {intervals['eer'][2]:.4f}]%, "
+                  f"min-DCF [{intervals['min_dcf'][1]:.5f}, {intervals['min_dcf'][2]:.5f}]\n")
+            print(">>", ci)
+            score_file.write(ci)
         score_file.close()
         
         # write to file
@@ -169,7 +184,7 @@ def inference(args):
     if args.prepare is True:
         model.prepare(eval_frames=args.eval_frames,
                       source=args.train_list,
-                      save_path=args.cohorts_path,
+                      save_path=enrollment_path if args.prepare_type == 'embed' else args.cohorts_path,
                       num_eval=num_eval,
                       prepare_type=args.prepare_type)
         sys.exit(1)
@@ -179,10 +194,14 @@ def inference(args):
         """
         Predict new utterance based on distance between its embedding and saved embeddings.
         """
-        embeds_path = Path(args.save_path, 'embeds.pt')
-        classes_path = Path(args.save_path, 'classes.npy')
-        embeds = torch.load(embeds_path).to(torch.device(args.device))
-        classes = np.load(str(classes_path), allow_pickle=True).item()
+        # prebuilt search index (main.py --do_index) for a shortlist, or every enrolled speaker
+        db = EnrollmentDB(enrollment_path)
+        index_path = args.index_path or os.path.join(args.save_path, 'speaker_index')
+        index = load_index(index_path) if os.path.isfile(os.path.join(index_path, 'meta.json')) else None
+        if index is not None and index.enrollment_version != db.version():
+            # speakers enrolled or deleted since the index was built: it would miss or return them
+            print(f"{index_path} is older than {enrollment_path}, scoring every speaker (run --do_index again)")
+            index = None
         
         if args.test_list.endswith('.txt'):
             files = []
@@ -211,22 +230,28 @@ def inference(args):
                                           eval_frames=args.eval_frames,
                                           num_eval=num_eval,
                                           normalize=model.__L__.test_normalize)
-            embed = embed.unsqueeze(-1)
-            dist = F.pairwise_distance(embed, embeds).detach().cpu().numpy()
-            dist = np.mean(dist, axis=0)
-            score = 1 - np.min(dist) ** 2 / 2
-            if classes[np.argmin(dist)] == f.parent.stem:
+            embed = embed.detach().cpu().numpy()
+            if index is not None:
+                # the index ranks by cosine to the crop-averaged voiceprints, its shortlist is rescored
+                _, candidates = index.search(embed.mean(axis=0), k=max(3, args.index_shortlist))
+                classes, scores = db.scores(embed, [speaker for speaker in candidates[0] if speaker in db])
+            else:
+                classes, scores = db.scores(embed)
+            # top-3 of 1 - dist ** 2 / 2, dist between aligned crops averaged over the crops
+            order = np.argsort(-scores, kind='stable')[:3]
+            scores, classes = scores[order], [classes[i] for i in order]
+            score = scores[0]
+            if classes[0] == f.parent.stem:
                 if score < same_smallest_score:
                     same_smallest_score = score
-                indexes = np.argsort(dist)[:2]
-                if fabs((1 - dist[indexes[0]] ** 2 / 2) - (1 - dist[indexes[1]] ** 2 / 2)) < 0.001:
-                    for i, idx in enumerate(indexes):
-                        score = 1 - dist[idx] ** 2 / 2
+                if len(classes) > 1 and fabs(scores[0] - scores[1]) < 0.001:
+                    for i in range(2):
+                        score = scores[i]
                         if i == 0:
-                            tqdm.write(f'+ {f}, {score} - {classes[idx]}',
+                            tqdm.write(f'+ {f}, {score} - {classes[i]}',
                                        end='; ')
                         else:
-                            tqdm.write(f'{score} - {classes[idx]}', end='; ')
+                            tqdm.write(f'{score} - {classes[i]}', end='; ')
                     tqdm.write('***')
                 else:
                     tqdm.write(f'+ {f}, {score}', end='')
@@ -237,14 +262,13 @@ def inference(args):
                 if score > diff_biggest_score:
                     diff_biggest_score = score
                 if score > args.test_threshold:
-                    indexes = np.argsort(dist)[:3]
-                    for i, idx in enumerate(indexes):
-                        score = 1 - dist[idx] ** 2 / 2
+                    for i in range(len(classes)):
+                        score = scores[i]
                         if i == 0:
-                            tqdm.write(f'- {f}, {score} - {classes[idx]}',
+                            tqdm.write(f'- {f}, {score} - {classes[i]}',
                                        end='; ')
                         else:
-                            tqdm.write(f'{score} - {classes[idx]}', end='; ')
+                            tqdm.write(f'{score} - {classes[i]}', end='; ')
                     tqdm.write('***')
         print(f'same_smallest_score: {same_smallest_score}')
         print(f'diff_biggest_score: {diff_biggest_score}')
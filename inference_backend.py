@@ -0,0 +1,180 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+BACKENDS = ('torch', 'onnx')
+
+GRAPH_OPTIMIZATION_LEVELS = {'disable': 'ORT_DISABLE_ALL',
+                             'basic': 'ORT_ENABLE_BASIC',
+                             'extended': 'ORT_ENABLE_EXTENDED',
+                             'all': 'ORT_ENABLE_ALL'}
+
+
+class TorchBackend(object):
+    """Run the crops through the PyTorch front-end and model
+
+    Args:
+        model (SpeakerNet): model with `__S__`, `compute_features` and `device`
+    """
+    name = 'torch'
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, inp):
+        with torch.no_grad():
+            inp = inp.to(self.model.device)
+            if self.model.compute_features is not None:
+                inp = self.model.compute_features(inp)
+            embed = self.model.__S__.forward(inp).detach().cpu()
+        return embed
+
+    def fingerprint(self):
+        return self.name
+
+
+class OnnxBackend(object):
+    """Run the crops through an exported ONNX graph with ONNX Runtime
+
+    Sessions are built once with tuned SessionOptions and kept in a pool, a call takes
+    a free session, so up to `pool_size` threads run the graph concurrently.
+
+    Args:
+        onnx_path (str): exported graph, input (n_crops, ...) -> output (n_crops, nOut)
+        intra_op_threads (int, optional): threads used inside an op, 0 lets ORT decide. Defaults to 0.
+        inter_op_threads (int, optional): threads used between ops, 0 lets ORT decide. Defaults to 0.
+        graph_optimization (str, optional): disable / basic / extended / all. Defaults to 'all'.
+        pool_size (int, optional): number of sessions. Defaults to 1.
+        providers (list, optional): execution providers. Defaults to ['CPUExecutionProvider'].
+        preprocess (callable, optional): torch front-end run before the graph
+            (e.g. `compute_features` of mfcc/melspectrogram models), skipped when
+            the graph was exported with the front-end included. Defaults to None.
+    """
+    name = 'onnx'
+
+    def __init__(self, onnx_path, intra_op_threads=0, inter_op_threads=0, graph_optimization='all',
+                 pool_size=1, providers=None, preprocess=None):
+        import onnxruntime as onnxrt
+
+        if not os.path.isfile(onnx_path):
+            raise FileNotFoundError(f"ONNX model not found: {onnx_path}")
+        if graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Invalid graph optimization {graph_optimization}, "
+                             f"available: {', '.join(GRAPH_OPTIMIZATION_LEVELS)}")
+
+        self.onnx_path = onnx_path
+
+        options = onnxrt.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxrt.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1 \
+            else onnxrt.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = getattr(onnxrt.GraphOptimizationLevel,
+                                                   GRAPH_OPTIMIZATION_LEVELS[graph_optimization])
+        providers = providers or ['CPUExecutionProvider']
+
+        self.sessions = queue.Queue()
+        for _ in range(max(1, pool_size)):
+            self.sessions.put(onnxrt.InferenceSession(onnx_path, sess_options=options, providers=providers))
+        session = self.sessions.queue[0]
+        self.input_name = session.get_inputs()[0].name
+        self.output_name = session.get_outputs()[0].name
+        self.front_end_included = session.get_modelmeta().custom_metadata_map.get('front_end') == 'included'
+        self.preprocess = None if self.front_end_included else preprocess
+        self.n_runs = 0
+        self._lock = threading.Lock()
+
+    def run(self, inp):
+        '''numpy float32 input -> numpy output'''
+        session = self.sessions.get()
+        try:
+            output = session.run([self.output_name], {self.input_name: inp})[0]
+        finally:
+            self.sessions.put(session)
+        with self._lock:
+            self.n_runs += 1
+        return output
+
+    def __call__(self, inp):
+        if not torch.is_tensor(inp):
+            inp = torch.FloatTensor(inp)
+        if self.preprocess is not None:
+            with torch.no_grad():
+                inp = self.preprocess(inp)
+        inp = np.ascontiguousarray(inp.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.run(inp))
+
+    def fingerprint(self):
+        stat = os.stat(self.onnx_path)
+        return f"{self.name}:{os.path.abspath(self.onnx_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def create_backend(model, backend='torch', onnx_path=None, **kwargs):
+    """Create the inference backend of a SpeakerNet
+
+    Args:
+        model (SpeakerNet): model, the torch backend and the front-end of the onnx backend
+        backend (str, optional): torch / onnx. Defaults to 'torch'.
+        onnx_path (str, optional): exported graph of the onnx backend. Defaults to None.
+        kwargs: OnnxBackend options (intra_op_threads, inter_op_threads, graph_optimization, pool_size)
+
+    Returns:
+        TorchBackend or OnnxBackend
+    """
+    if backend == 'torch':
+        return TorchBackend(model)
+    elif backend == 'onnx':
+        if onnx_path is None:
+            raise ValueError("The onnx backend needs onnx_path")
+        preprocess = None
+        if model.compute_features is not None:
+            # the graph exported by export_onnx starts after compute_features
+            def preprocess(inp):
+                return model.compute_features(inp.to(model.device))
+        return OnnxBackend(onnx_path, preprocess=preprocess, **kwargs)
+    raise ValueError(f"Invalid inference backend {backend}, available: {', '.join(BACKENDS)}")
+
+
+if __name__ == '__main__':
+    # parity and CPU latency of the torch and onnx backends on a freshly initialized model
+    import argparse
+    import tempfile
+    import time
+
+    from model import SpeakerNet
+
+    parser = argparse.ArgumentParser(description="InferenceBackend")
+    parser.add_argument('--model', type=str, default='Raw_ECAPA')
+    parser.add_argument('--features', type=str, default='raw')
+    parser.add_argument('--criterion', type=str, default='ARmSoftmax')
+    parser.add_argument('--nOut', type=int, default=192)
+    parser.add_argument('--n_crops', type=int, default=10)
+    parser.add_argument('--n_samples', type=int, default=8120)
+    parser.add_argument('--n_runs', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = SpeakerNet(save_path=tempfile.mkdtemp(), model=args.model, features=args.features,
+                       criterion=args.criterion, device='cpu', nOut=args.nOut, nClasses=2, sample_rate=8000,
+                       n_mels=80, max_frames=100, lr=0.001, weight_decay=0, step_size=5, lr_decay=0.95,
+                       margin=0.1, scale=30, augment=False, augment_chain=None)
+    model.eval()
+    inp = torch.randn(args.n_crops, args.n_samples)
+    onnx_path = model.export_onnx(save_path=os.path.join(model.save_path, 'model.onnx'), check=False)
+
+    backends = {'torch': create_backend(model, 'torch'),
+                'onnx': create_backend(model, 'onnx', onnx_path=onnx_path,
+                                       intra_op_threads=args.threads, graph_optimization='all')}
+    outputs = {}
+    print(f"{args.n_crops} crops x {args.n_samples} samples, {args.threads} threads")
+    for name, backend in backends.items():
+        outputs[name] = backend(inp)
+        t0 = time.perf_counter()
+        for _ in range(args.n_runs):
+            backend(inp)
+        print(f"{name:<6} {(time.perf_counter() - t0) / args.n_runs * 1000:>8.1f} ms / batch")
+    print(f"max abs diff: {(outputs['torch'] - outputs['onnx']).abs().max().item():.2e}")
@@ -6,6 +6,8 @@ import torch.distributed as dist
 import torch.multiprocessing as mp
 from export import *
 from inference import inference
+from quantization import quantize_checkpoint
+from speaker_index import build_speaker_index
 from trainer import train
 from utils import read_config
 
@@ -28,8 +30,12 @@ def main(args):
         inference(args)
     elif args.do_export:
         export_model(args, check=True)
+    elif args.do_index:
+        build_speaker_index(args)
+    elif args.do_quantize:
+        quantize_checkpoint(args)
     else:
-        raise 'Wrong main mode, available: do_train, do_infer, do_export'
+        raise 'Wrong main mode, available: do_train, do_infer, do_export, do_index, do_quantize'
 
 #--------------------------------------------------------------------------------------#
 parser = argparse.ArgumentParser(description="SpeakerNet")
@@ -41,6 +47,8 @@ if __name__ == '__main__':
     parser.add_argument('--do_train', action='store_true', default=False)
     parser.add_argument('--do_infer', action='store_true', default=False)
     parser.add_argument('--do_export', action='store_true', default=False)
+    parser.add_argument('--do_quantize', action='store_true', default=False)
+    parser.add_argument('--do_index', action='store_true', default=False)
     
     # Infer mode
     parser.add_argument('--eval',
@@ -101,16 +109,48 @@ if __name__ == '__main__':
                         type=int,
                         default=2,
                         help='# of loader threads')    
+    parser.add_argument('--train_read_mode',
+                        type=str,
+                        default='pydub',
+                        help='Audio reading of the training crops: pydub or sf (whole file, default pydub as loadWAV), seek (header + crop only, wav) or shards (see --train_shards)')
+    parser.add_argument('--train_shards',
+                        type=str,
+                        default=None,
+                        help='Shards of the train list packed by dataprep.py --pack_shards, for --train_read_mode shards')
     parser.add_argument('--nPerSpeaker',
                         type=int,
                         default=2,
                         help='# of utterances per speaker per batch a.k.a sub centers')   
+    parser.add_argument('--sampler_seed',
+                        type=int,
+                        default=None,
+                        help='Seed of the batches of the sampler (required with several processes), random if not set')
     
     # Augmentation
     parser.add_argument('--augment',
                         action='store_true',
                         default=False,
                         help='Augment input')
+    parser.add_argument('--augment_bank_dir',
+                        type=str,
+                        default=None,
+                        help='Folder of the --augment_bank (default: augment_bank_<sample_rate> under save_path)')
+    parser.add_argument('--augment_bank',
+                        action='store_true',
+                        default=False,
+                        help='Pack the noise and RIR files once into a memory-mapped bank instead of decoding them on every sample')
+    parser.add_argument('--time_domain_mode',
+                        type=str,
+                        default='pydub',
+                        help='Speed / pitch / volume of time_domain: pydub (default, as loadWAV), array (resampling of the crop with cached polyphase filters, factors on a 1/200 grid) or batch (whole batch on the training device)')
+    parser.add_argument('--reverb_mode',
+                        type=str,
+                        default='direct',
+                        help='Reverberation of env_corrupt: direct (default, scipy convolve) or fft (cached RIR spectra, same kept samples up to float rounding)')
+    parser.add_argument('--batch_env_corrupt',
+                        action='store_true',
+                        default=False,
+                        help='Reverb and noise of env_corrupt applied to the whole batch on the training device instead of the data workers')
     parser.add_argument('--augment_chain',
                         nargs='+',
                         default=None,
@@ -277,6 +317,10 @@ if __name__ == '__main__':
     parser.add_argument('--dcf_c_fa',       
                         type=float, default=1,      
                         help='Cost of a spurious detection');
+    parser.add_argument('--eval_bootstrap',
+                        type=int,
+                        default=0,
+                        help='Number of bootstrap replicates of the EER / min-DCF confidence intervals, 0 to skip')
 
 
     # For test only
@@ -288,6 +332,78 @@ if __name__ == '__main__':
                         type=int,
                         default=10,
                         help='number of evaluation sample per audio')
+    parser.add_argument('--eval_crops_per_batch',
+                        type=int,
+                        default=200,
+                        help='Max number of evaluation crops (from many files) per forward batch, 0 for one file per batch')
+    parser.add_argument('--shared_crop_frames',
+                        action='store_true',
+                        default=False,
+                        help='Run the frame-level encoder once per utterance and pool the evaluation crops from it (ECAPA_TDNN, RawNet2v2, Raw_ECAPA)')
+    parser.add_argument('--num_decode_workers',
+                        type=int,
+                        default=2,
+                        help='Number of background audio decoders for evaluation, 0 to decode in the main thread')
+    parser.add_argument('--prefetch_depth',
+                        type=int,
+                        default=16,
+                        help='Max number of files decoded ahead of the model')
+    parser.add_argument('--decode_backend',
+                        type=str,
+                        default='thread',
+                        help='Pool of the audio decoders: thread or process')
+    parser.add_argument('--deploy',
+                        action='store_true',
+                        default=False,
+                        help='Fuse conv+bn, re-parameterize RepVGG, cache sinc filters and freeze to TorchScript for inference')
+    parser.add_argument('--inference_backend',
+                        type=str,
+                        default='torch',
+                        help='Backend of the embedding extraction: torch or onnx')
+    parser.add_argument('--onnx_path',
+                        type=str,
+                        default=None,
+                        help='ONNX graph of the onnx backend, default: the one written by --do_export')
+    parser.add_argument('--onnx_intra_op_threads',
+                        type=int,
+                        default=0,
+                        help='ONNX Runtime threads inside an op, 0: decided by ORT')
+    parser.add_argument('--onnx_inter_op_threads',
+                        type=int,
+                        default=0,
+                        help='ONNX Runtime threads between ops, 0: decided by ORT')
+    parser.add_argument('--onnx_graph_optimization',
+                        type=str,
+                        default='all',
+                        help='ONNX Runtime graph optimization: disable, basic, extended or all')
+    parser.add_argument('--onnx_session_pool',
+                        type=int,
+                        default=1,
+                        help='Number of ONNX Runtime sessions for concurrent callers')
+    parser.add_argument('--quantize_calibration_files',
+                        type=int,
+                        default=200,
+                        help='Number of train list files used to calibrate the int8 convolutions')
+    parser.add_argument('--quantize_eer_tolerance',
+                        type=float,
+                        default=0.2,
+                        help='Max EER increase (%% points) on the eval list, beyond it the int8 model is not saved')
+    parser.add_argument('--quantize_output',
+                        type=str,
+                        default=None,
+                        help='Path of the int8 checkpoint, default: <checkpoint>_int8.pt')
+    parser.add_argument('--embedding_cache',
+                        type=str,
+                        default=None,
+                        help='Folder of the persistent embedding cache, None to disable')
+    parser.add_argument('--embedding_cache_size_mb',
+                        type=int,
+                        default=2048,
+                        help='Max size of the embedding cache folder')
+    parser.add_argument('--embedding_cache_key',
+                        type=str,
+                        default='stat',
+                        help='Identify cached audio by path + mtime + size (stat) or by the file hash (content)')
     parser.add_argument('--prepare',
                         dest='prepare',
                         action='store_true',
@@ -305,6 +421,34 @@ if __name__ == '__main__':
                         type=str,
                         default=None,
                         help='Cohorts path')
+    parser.add_argument('--enrollment_path',
+                        type=str,
+                        default=None,
+                        help='Folder of the speaker enrollment store, default to <save_path>/enrollment')
+    parser.add_argument('--index_path',
+                        type=str,
+                        default=None,
+                        help='Folder of the speaker search index, default to <save_path>/speaker_index')
+    parser.add_argument('--index_type',
+                        type=str,
+                        default='flat',
+                        help='flat (exact) / ivf / faiss speaker search index')
+    parser.add_argument('--index_nlist',
+                        type=int,
+                        default=256,
+                        help='Number of clusters of the ivf index')
+    parser.add_argument('--index_nprobe',
+                        type=int,
+                        default=8,
+                        help='Number of clusters searched per query by the ivf index')
+    parser.add_argument('--index_shortlist',
+                        type=int,
+                        default=50,
+                        help='Speakers of the search index rescored with the crop-aligned voiceprints in predict')
+    parser.add_argument('--benchmark_index',
+                        action='store_true',
+                        default=False,
+                        help='Report recall@10 and latency of the built index against brute force')
     parser.add_argument('--test_threshold',
                         type=float,
                         default=0.5,
@@ -313,6 +457,10 @@ if __name__ == '__main__':
                         type=str,
                         default='cosine',
                         help='norm or cosine for scoring')
+    parser.add_argument('--scoring_chunk_size',
+                        type=int,
+                        default=None,
+                        help='Number of trials scored per batched operation, by default bounded by memory')
     parser.add_argument('--ref', '-r',
                        type=str,
                        default='dataset/test_callbot_raw/test_cb_v1.txt')
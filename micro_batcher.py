@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(RuntimeError):
+    '''Raised by MicroBatcher.submit when the request queue stays full (backpressure)'''
+    pass
+
+
+class MicroBatcher(object):
+    """Group items submitted by concurrent callers into batches for one `process_fn` call
+
+    A worker thread takes the first waiting item, then keeps collecting until the batch
+    has `max_batch_size` items or `max_wait_ms` passed since that first item, runs
+    `process_fn` on the batch and resolves the future of every item.
+
+    Args:
+        process_fn (callable): list of items -> list of results in the same order
+        max_batch_size (int, optional): max number of items per batch. Defaults to 32.
+        max_wait_ms (float, optional): max time the first item of a batch waits for others. Defaults to 5.
+        max_queue_size (int, optional): max number of waiting items, more are rejected. Defaults to 256.
+    """
+    def __init__(self, process_fn, max_batch_size=32, max_wait_ms=5, max_queue_size=256):
+        self.process_fn = process_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.n_batches = 0
+        self.n_items = 0
+        self.n_rejected = 0
+
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item, timeout=None):
+        """Queue an item
+
+        Args:
+            item: input of process_fn
+            timeout (float, optional): seconds to wait for a free place, None rejects at once. Defaults to None.
+
+        Returns:
+            Future: resolved with the result of the item
+        """
+        if self._closed.is_set():
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        try:
+            if timeout is None:
+                self.queue.put_nowait((item, future))
+            else:
+                self.queue.put((item, future), timeout=timeout)
+        except queue.Full:
+            self.n_rejected += 1
+            raise QueueFullError(f"Batcher queue is full ({self.queue.maxsize} items waiting)")
+        return future
+
+    def map(self, items, timeout=None):
+        '''Submit all items and wait for their results'''
+        futures = [self.submit(item, timeout=timeout) for item in items]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._closed.is_set() and self.queue.empty()):
+            batch = self._collect()
+            # skip items whose caller gave up
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = list(self.process_fn([item for item, _ in batch]))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"process_fn returned {len(results)} results for {len(batch)} items")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                # every caller gets an answer, the ones already resolved keep their result
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.n_batches += 1
+            self.n_items += len(batch)
+
+    def close(self, wait=True):
+        '''Stop accepting items, the waiting ones are still processed'''
+        self._closed.set()
+        if wait:
+            self._worker.join()
+
+    def stats(self):
+        return {'batches': self.n_batches,
+                'items': self.n_items,
+                'mean_batch_size': self.n_items / self.n_batches if self.n_batches else 0.0,
+                'queued': self.queue.qsize(),
+                'rejected': self.n_rejected}
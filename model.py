@@ -1,21 +1,34 @@
 import os
+import atexit
 import csv
 import importlib
+import inspect
 import random
 import sys
 import time
+import warnings
 from pathlib import Path
 
 import numpy as np
 import onnx
-import onnxruntime as onnxrt
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from functools import partial
 from tqdm.auto import tqdm
-from processing.audio_loader import loadWAV
-from utils import (similarity_measure, cprint)
+from deploy import deploy_model
+from inference_backend import create_backend
+from models.FeatureExtraction.feature import exportable_features
+from quantization import QUANTIZATION_KEY, build_quantized_structure, convert_quantized_structure
+from shared_crops import SharedCropEmbedder
+from processing.audio_loader import AugmentWAV, augment_bank_dir, loadWAV
+from processing.batch_augment import BatchEnvCorrupt, BatchTimeDomain
+from processing.prefetch import AudioPrefetcher
+from embedding_cache import CacheLockedError, EmbeddingCache, file_fingerprint
+from enrollment import EnrollmentDB, check_speaker_id
+from scoring import EmbeddingMatrix, score_trials
+from utils import cprint
 
 
 class WrappedModel(nn.Module):
@@ -30,6 +43,23 @@ class WrappedModel(nn.Module):
         return self.module(x, label)
 
 
+class ExportModule(nn.Module):
+
+    ## Front-end and model in one module: waveform (n_crops, n_samples) -> embeddings (n_crops, nOut)
+
+    def __init__(self, model, compute_features=None):
+        super(ExportModule, self).__init__()
+        self.model = model
+        self.compute_features = compute_features
+
+    def forward(self, x):
+        n_crops = x.shape[0]
+        if self.compute_features is not None:
+            x = self.compute_features(x)
+        # some models squeeze the batch axis of a single crop
+        return self.model(x).reshape(n_crops, -1)
+
+
 class SpeakerNet(nn.Module):
     def __init__(self, save_path, model, features='raw', criterion='Softmax', 
                  optimizer='adam', callbacks='steplr',  device='cuda', max_epoch='500', gpu=0,  **kwargs):
@@ -41,6 +71,22 @@ class SpeakerNet(nn.Module):
         self.max_epoch = max_epoch
         self.kwargs = kwargs
         self.T_max = 0 if 'T_max' not in kwargs else kwargs['T_max']
+        self.features = features
+
+        # checkpoint of the loaded weights, None when they are not from a checkpoint,
+        # its content fingerprint is computed by the first embedding cache only
+        self.checkpoint_path = None
+        self.checkpoint_stat = None
+        self.checkpoint_fingerprint = None
+        self.embedding_caches = {}
+        # torch / onnx backend of forward_crops, created on first use
+        self.inference_backend = None
+        self.onnx_backends = {}
+        # frame-level pass shared by the evaluation crops, created on first use (False if unsupported)
+        self.shared_crop_embedder = None
+        # time_domain / env_corrupt of the training batches on the device, created on first use (False if disabled)
+        self.time_domain = None
+        self.env_corrupt = None
 
         SpeakerNetModel = importlib.import_module(
             'models.' + self.model_name).__getattribute__('MainModel')
@@ -94,6 +140,9 @@ class SpeakerNet(nn.Module):
             tuple: loss and precision
         '''
         self.train()
+        # weights no longer match the loaded checkpoint
+        self.checkpoint_path = None
+        self.checkpoint_fingerprint = None
 
         stepsize = loader.batch_size
 
@@ -104,9 +153,17 @@ class SpeakerNet(nn.Module):
         
         tstart = time.time()
         
+        time_domain = self.get_time_domain()
+        env_corrupt = self.get_env_corrupt()
+
         loader_bar = tqdm(loader, desc=f">EPOCH_{epoch}", unit="it", colour="green")
         for (data, data_label) in loader_bar:
-            data = data.transpose(0, 1).to(self.device)
+            data = data.to(self.device)
+            if time_domain is not None:
+                data = time_domain(data)
+            if env_corrupt is not None:
+                data = env_corrupt(data)
+            data = data.transpose(0, 1)
             self.zero_grad()
             feat = []
             # forward n utterances per speaker and stack the output
@@ -197,59 +254,31 @@ class SpeakerNet(nn.Module):
         print(">>>>Evaluation")
 
         # Save all features to dictionary
-        for idx, filename in enumerate(tqdm(setfiles, desc=">>>>Reading file: ", unit="files", colour="red")):
-            audio = loadWAV(filename, evalmode=True,  **self.kwargs)
-            inp1 = torch.FloatTensor(audio).to(self.device)
+        feats = self.embed_files(setfiles, **self.kwargs)
 
-            with torch.no_grad():
-                if self.compute_features is not None:
-                    inp1 = self.compute_features(inp1)
-                ref_feat = self.__S__.forward(inp1.to(self.device)).detach().cpu()
-                
-            feats[filename] = ref_feat
-
-        all_scores = []
         all_labels = []
         all_trials = []
-        
-        # Read files and compute all scores          
-        for idx, line in enumerate(tqdm(lines, desc=">>>>Computing files", unit="pairs", colour="MAGENTA")):
+        ref_files = []
+        com_files = []
+
+        # Read files and compute all scores
+        for idx, line in enumerate(lines):
             data = line.split()
 
             # Append random label if missing
             if len(data) == 2:
                 data = [random.randint(0, 1)] + data
 
-            ref_feat = feats[data[1]].to(self.device)
-            com_feat = feats[data[2]].to(self.device)
+            all_labels.append(int(data[0]))
+            all_trials.append(data[1] + " " + data[2])
+            ref_files.append(data[1])
+            com_files.append(data[2])
 
-            if self.__L__.test_normalize:
-                ref_feat = F.normalize(ref_feat, p=2, dim=1)
-                com_feat = F.normalize(com_feat, p=2, dim=1)
+        # NOTE: distance(cohort = None) for training, normalized score for evaluating and testing
+        all_scores = self.score_pairs(feats, ref_files, com_files,
+                                      scoring_mode=scoring_mode if cohorts_path is not None else 'distance',
+                                      cohorts=cohorts)
 
-            # NOTE: distance(cohort = None) for training, normalized score for evaluating and testing
-            if cohorts_path is None:
-                dist = F.pairwise_distance(
-                    ref_feat.unsqueeze(-1),
-                    com_feat.unsqueeze(-1).transpose(
-                        0, 2)).detach().cpu().numpy()
-                score = -1 * np.mean(dist)
-            else:
-                if scoring_mode == 'norm':
-                    score = similarity_measure('zt_norm',
-                                               ref_feat,
-                                               com_feat,                                                
-                                               cohorts,
-                                               top=200)
-                elif scoring_mode == 'cosine':
-                    score = similarity_measure('cosine',ref_feat, com_feat)
-                elif scoring_mode == 'pnorm' :
-                    score = similarity_measure('pnorm', ref_feat, com_feat, p = 2)
-
-            all_scores.append(score)
-            all_labels.append(int(data[0]))
-            all_trials.append(data[1] + " " + data[2])             
-            
         return all_scores, all_labels, all_trials
 
     def testFromList(self,
@@ -296,50 +325,41 @@ class SpeakerNet(nn.Module):
         setfiles.sort()
 
         # Save all features to feat dictionary
-        for idx, filename in enumerate(tqdm(setfiles, desc=">>>>Reading file: ", unit="files", colour="red")):
-            audio = loadWAV(filename.replace('\n', ''), evalmode=True, **self.kwargs)
-            
-            inp1 = torch.FloatTensor(audio).to(self.device)
-
-            with torch.no_grad():
-                if self.compute_features is not None:
-                    inp1 = self.compute_features(inp1)
-                ref_feat = self.__S__.forward(inp1.to(self.device)).detach().cpu()
-                
-            feats[filename] = ref_feat
+        embeds = self.embed_files([filename.replace('\n', '') for filename in setfiles], **self.kwargs)
+        feats = {filename: embeds[filename.replace('\n', '')] for filename in setfiles}
 
         # Read files and compute all scores
         with open(write_file, 'w', newline='') as wf:
             spamwriter = csv.writer(wf, delimiter=',')
             spamwriter.writerow(['audio_1', 'audio_2', 'pred_label' , 'score'])
-            for idx, data in enumerate(tqdm(lines, desc=">>>>Computing files", unit="pairs", colour="MAGENTA")):
-                ref_feat = feats[data[0]].to(self.device)
-                com_feat = feats[data[1]].to(self.device)
-
-                if self.__L__.test_normalize:
-                    ref_feat = F.normalize(ref_feat, p=2, dim=1)
-                    com_feat = F.normalize(com_feat, p=2, dim=1)
-
-                if cohorts_path is None:
-                    dist = F.pairwise_distance(
-                        ref_feat.unsqueeze(-1),
-                        com_feat.unsqueeze(-1).transpose(
-                            0, 2)).detach().cpu().numpy()
-                    score = -1 * np.mean(dist)
-                else:
-                    if scoring_mode == 'norm':
-                        score = similarity_measure('zt_norm',ref_feat,
-                                                    com_feat,
-                                                    cohorts,
-                                                    top=200)
-                    elif scoring_mode == 'cosine':
-                        score = similarity_measure('cosine',ref_feat, com_feat)
-                    elif scoring_mode == 'pnorm' :
-                        score = similarity_measure('pnorm', ref_feat, com_feat, p = 2)
-
+            scores = self.score_pairs(feats,
+                                      [data[0] for data in lines],
+                                      [data[1] for data in lines],
+                                      scoring_mode=scoring_mode if cohorts_path is not None else 'distance',
+                                      cohorts=cohorts)
+            for data, score in zip(lines, scores):
                 pred = '1' if score >= thre_score else '0'
                 spamwriter.writerow([data[0], data[1], pred, score])
 
+    def score_pairs(self, feats, ref_files, com_files, scoring_mode='cosine', cohorts=None):
+        '''Score trials (ref_files[i], com_files[i]) from the extracted embeddings
+
+        Args:
+            feats (dict): file -> embedding
+            ref_files (list): first file of each trial
+            com_files (list): second file of each trial
+            scoring_mode (str, optional): cosine, pnorm, norm or distance (no cohorts). Defaults to 'cosine'.
+            cohorts (np.ndarray, optional): cohort embeddings for 'norm' scoring. Defaults to None.
+
+        Returns:
+            list: score of each trial
+        '''
+        matrix = EmbeddingMatrix(feats, normalize=self.__L__.test_normalize, device=self.device)
+
+        return list(score_trials(matrix, ref_files, com_files, scoring_mode=scoring_mode,
+                                 chunk_size=self.kwargs.get('scoring_chunk_size', None),
+                                 cohorts=cohorts, top=200))
+
     def test_each_pair(self, root, thre_score=0.5, 
                        cohorts_path='data/zalo/cohorts.npy',
                        print_interval=1,
@@ -412,25 +432,15 @@ class SpeakerNet(nn.Module):
         ref_feat = self.embed_utterance(path_ref,
                                         eval_frames=eval_frames,
                                         num_eval=num_eval,
-                                        normalize=False).to(self.device)
+                                        normalize=False)
         com_feat = self.embed_utterance(path_com,
                                         eval_frames=eval_frames,
                                         num_eval=num_eval,
-                                        normalize=False).to(self.device)
-
-        if self.__L__.test_normalize:
-            ref_feat = F.normalize(ref_feat, p=2, dim=1)
-            com_feat = F.normalize(com_feat, p=2, dim=1)
-
-        if scoring_mode == 'norm':
-            score = similarity_measure('zt_norm',ref_feat,
-                                        com_feat,
-                                        cohorts,
-                                        top=200)
-        elif scoring_mode == 'cosine':
-            score = similarity_measure('cosine',ref_feat, com_feat)
-        elif scoring_mode == 'pnorm' :
-            score = similarity_measure('pnorm', ref_feat, com_feat, p = 2)
+                                        normalize=False)
+
+        score = self.score_pairs({'ref': ref_feat, 'com': com_feat}, ['ref'], ['com'],
+                                 scoring_mode=scoring_mode,
+                                 cohorts=cohorts)[0]
 
         return score
 
@@ -469,10 +479,11 @@ class SpeakerNet(nn.Module):
                 spkID, path = data[:2]
                 cohort_spk_files.setdefault(spkID, []).append(path)
                 
-            for spkID, paths in tqdm(cohort_spk_files.items(), unit=' speakers', desc='Getting speaker embedding'):
+            cohort_files = [path for paths in cohort_spk_files.values() for path in paths[:n_emb_per_spk]]
+            embeds = self.embed_files(cohort_files, max_frames=eval_frames, num_eval=num_eval, normalize=True)
+            for spkID, paths in cohort_spk_files.items():
                 for path in paths[:n_emb_per_spk]:
-                    emb = self.embed_utterance(path, eval_frames=eval_frames, num_eval=num_eval, normalize=True)
-                    cohort_embedding.setdefault(spkID, []).append(emb)
+                    cohort_embedding.setdefault(spkID, []).append(embeds[path])
 
             cohort_speakers = list(cohort_embedding.keys())
             cohort = np.vstack([np.mean(np.vstack(cohort_embedding[speaker]), axis=0, keepdims=True) 
@@ -487,58 +498,37 @@ class SpeakerNet(nn.Module):
             # load audio from_path (root path)
             # option 1: from root
             if isinstance(source, str):
-                speaker_dirs = [x for x in Path(from_path).iterdir() if x.is_dir()]
-                embeds = None
-                classes = {}
-                # Save mean features
-                for idx, speaker_dir in enumerate(speaker_dirs):
-                    classes[idx] = speaker_dir.stem
-                    files = list(speaker_dir.glob('*.wav'))
-                    mean_embed = None
-                    embed = None
-                    for f in files:
-                        embed = self.embed_utterance(
-                            f,
-                            eval_frames=eval_frames,
-                            num_eval=num_eval,
-                            normalize=self.__L__.test_normalize)
-                        if mean_embed is None:
-                            mean_embed = embed.unsqueeze(0)
-                        else:
-                            mean_embed = torch.cat(
-                                (mean_embed, embed.unsqueeze(0)), 0)
-                    mean_embed = torch.mean(mean_embed, dim=0)
-                    if embeds is None:
-                        embeds = mean_embed.unsqueeze(-1)
+                speaker_dirs = [x for x in Path(source).iterdir() if x.is_dir()]
+                speaker_files = {speaker_dir.stem: [str(f) for f in speaker_dir.glob('*.wav')] for speaker_dir in speaker_dirs}
+                speaker_files = {speaker: files for speaker, files in speaker_files.items() if files}
+                # ids are checked before any write, not halfway through the enrollment
+                for speaker in speaker_files:
+                    check_speaker_id(speaker)
+                files_embeds = self.embed_files([f for files in speaker_files.values() for f in files],
+                                                max_frames=eval_frames,
+                                                num_eval=num_eval,
+                                                normalize=self.__L__.test_normalize)
+                if save_path and files_embeds:
+                    # one voiceprint per speaker: for each crop index, the mean over its files
+                    first = next(iter(files_embeds.values()))
+                    db = EnrollmentDB(save_path, dim=first.shape[-1], n_crops=first.shape[0])
+                    for speaker, files in tqdm(speaker_files.items(), desc='Enrolling...', unit=' speakers'):
+                        db.update(speaker, torch.stack([files_embeds[f] for f in files], dim=0).numpy())
+                    if db.dead_ratio > 0.5:
+                        db.compact()
                     else:
-                        embeds = torch.cat((embeds, mean_embed.unsqueeze(-1)), -1)
-
-                print(embeds.shape)
-                # embeds = rearrange(embeds, 'n_class n_sam feat -> n_sam feat n_class')
-                if save_path:
-                    torch.save(embeds, Path(save_path, 'embeds.pt'))
-                    np.save(str(Path(save_path, 'classes.npy')), classes)
+                        db.save_snapshot()
+                    print(f"Enrolled {len(speaker_files)} speakers into {save_path} ({len(db)} in total)")
                 return True
                 
             elif isinstance(source, list):
                 #option 2: list of audio in numpy format
-                mean_embed = None
-                embed = None
-                for audio_data_np in source:
-                    embed = self.embed_utterance(audio_data_np, 
-                                                 eval_frames=eval_frames, 
-                                                 num_eval=num_eval,
-                                                 normalize=self.__L__.test_normalize,
-                                                 sr=8000)
-                    if mean_embed is None:
-                        mean_embed = embed.unsqueeze(0)
-                    else:
-                        mean_embed = torch.cat(
-                            (mean_embed, embed.unsqueeze(0)), 0)
-                mean_embed = torch.mean(mean_embed, dim=0)
-                
-                if save_path:
-                    torch.save(mean_embed, Path(save_path, 'embeds.pt'))
+                embeds = [self.embed_utterance(audio_data_np,
+                                               eval_frames=eval_frames,
+                                               num_eval=num_eval,
+                                               normalize=self.__L__.test_normalize,
+                                               sr=8000) for audio_data_np in source]
+                mean_embed = torch.mean(torch.stack(embeds, dim=0), dim=0)
                 return mean_embed                
         else:
             raise NotImplementedError
@@ -551,22 +541,244 @@ class SpeakerNet(nn.Module):
         """
         Get embedding from utterance
         """
-        audio = loadWAV(source,
-                        eval_frames,
-                        evalmode=True,
-                        num_eval=num_eval,
-                        sr=sr)
-
-        inp = torch.FloatTensor(audio).to(self.device)
-                    
-        with torch.no_grad():
-            if self.compute_features is not None:
-                inp = self.compute_features(inp)
-            embed = self.__S__.forward(inp.to(self.device)).detach().cpu()
+        cache = self.get_embedding_cache(max_frames=eval_frames, num_eval=num_eval)
+        embed = None
+        if cache is not None and isinstance(source, str):
+            key = cache.key(source)
+            embed = cache.get(key)
+
+        shared = self.get_shared_crop_embedder() if eval_frames > 0 and num_eval > 0 else None
+        if embed is not None:
+            embed = torch.from_numpy(embed)
+        elif shared is not None:
+            audio = loadWAV(source, 0, evalmode=True, sr=sr)
+            sample_rate = sr or self.kwargs.get('sample_rate', 8000)
+            embed = shared(audio, int(eval_frames * 10e-3 * sample_rate + 15e-3 * sample_rate), num_eval)
+            if cache is not None and isinstance(source, str):
+                cache.put(key, embed.numpy())
+        else:
+            audio = loadWAV(source,
+                            eval_frames,
+                            evalmode=True,
+                            num_eval=num_eval,
+                            sr=sr)
+
+            embed = self.forward_crops(torch.FloatTensor(audio))
+            if cache is not None and isinstance(source, str):
+                cache.put(key, embed.numpy())
+
         if normalize:
             embed = F.normalize(embed, p=2, dim=1)
         return embed
 
+    def embed_files(self, sources, crops_per_batch=None, normalize=False, **kwargs):
+        """
+        Get embeddings of many utterances at once.
+        Evaluation crops of consecutive files are packed into forward batches of
+        at most `crops_per_batch` crops and the outputs are scattered back per file,
+        kwargs are passed to loadWAV (max_frames, num_eval, sample_rate, ...).
+        Audio is decoded by `num_decode_workers` background workers (thread or process
+        pool, `decode_backend`), at most `prefetch_depth` files ahead of the model.
+        Embeddings of files found in the embedding cache are not extracted again.
+        With `shared_crop_frames` the whole utterance is decoded and its crops are
+        pooled from one frame-level pass (see shared_crops.py).
+
+        Returns:
+            dict: source -> embedding of shape (num_eval, nOut)
+        """
+        if crops_per_batch is None:
+            crops_per_batch = self.kwargs.get('eval_crops_per_batch', 200)
+
+        feats = {}
+        batch_sources = []
+        batch_audios = []
+        n_crops = 0
+
+        cache = self.get_embedding_cache(**kwargs)
+        cache_keys = {}
+        if cache is not None:
+            cache_keys = {source: cache.key(source) for source in sources if isinstance(source, str)}
+            for source, key in cache_keys.items():
+                embed = cache.get(key)
+                if embed is not None:
+                    embed = torch.from_numpy(embed)
+                    feats[source] = F.normalize(embed, p=2, dim=1) if normalize else embed
+            print(f"Embedding cache: {len(feats)}/{len(sources)} files found")
+            sources = [source for source in sources if source not in feats]
+
+        def store(source, embed):
+            if source in cache_keys:
+                cache.put(cache_keys[source], embed.numpy())
+            feats[source] = F.normalize(embed, p=2, dim=1) if normalize else embed
+
+        def flush():
+            embeds = self.forward_crops(torch.FloatTensor(np.concatenate(batch_audios, axis=0)))
+            embeds = torch.split(embeds, [audio.shape[0] for audio in batch_audios], dim=0)
+            for source, embed in zip(batch_sources, embeds):
+                store(source, embed)
+            batch_sources.clear()
+            batch_audios.clear()
+
+        max_frames, num_eval = kwargs.get('max_frames', 0), kwargs.get('num_eval', 10)
+        shared = self.get_shared_crop_embedder() if max_frames > 0 and num_eval > 0 else None
+        load_kwargs = dict(kwargs, max_frames=0) if shared is not None else kwargs
+        sample_rate = kwargs.get('sample_rate', 8000)
+        max_audio = int(max_frames * 10e-3 * sample_rate + 15e-3 * sample_rate)
+
+        prefetcher = AudioPrefetcher(partial(loadWAV, evalmode=True, **load_kwargs), sources,
+                                     num_workers=self.kwargs.get('num_decode_workers', 2),
+                                     queue_depth=self.kwargs.get('prefetch_depth', 16),
+                                     backend=self.kwargs.get('decode_backend', 'thread'))
+        for source, audio in tqdm(prefetcher, desc=">>>>Reading file: ", unit="files", colour="red"):
+            if shared is not None:
+                store(source, shared(audio, max_audio, num_eval))
+                continue
+            audio = np.atleast_2d(audio)
+            # crops of different length (e.g. whole utterance) can not be stacked together
+            if batch_audios and (n_crops + audio.shape[0] > crops_per_batch or
+                                 audio.shape[1:] != batch_audios[0].shape[1:]):
+                flush()
+                n_crops = 0
+            batch_sources.append(source)
+            batch_audios.append(audio)
+            n_crops += audio.shape[0]
+
+        if batch_audios:
+            flush()
+        if cache is not None:
+            cache.flush()
+
+        stats = prefetcher.stats()
+        print(f"Decode stall: {stats['stall_time']:.2f}s, model: {stats['consume_time']:.2f}s "
+              f"({stats['stall_ratio'] * 100:.1f}% waiting for audio)")
+        return feats
+
+    def get_embedding_cache(self, max_frames=None, num_eval=10, sample_rate=8000, augment=False, **kwargs):
+        '''
+        Persistent embedding cache for the loaded checkpoint and these extraction parameters,
+        None if disabled (`embedding_cache` not set), weights not from a checkpoint or random augmentation
+        '''
+        if not self.kwargs.get('embedding_cache', None) or self.checkpoint_path is None or augment:
+            return None
+        if self.checkpoint_fingerprint is None:
+            # the checkpoint changed on disk since it was loaded: its hash would not be the loaded weights'
+            if file_fingerprint(self.checkpoint_path, key_mode='stat') != self.checkpoint_stat:
+                print(f"{self.checkpoint_path} changed since it was loaded, embedding cache disabled")
+                self.checkpoint_path = None
+                return None
+            self.checkpoint_fingerprint = file_fingerprint(self.checkpoint_path, key_mode='content')
+
+        params = {'model': self.model_name,
+                  'features': self.features,
+                  'max_frames': max_frames,
+                  'num_eval': num_eval,
+                  'sample_rate': sample_rate,
+                  'target_db': kwargs.get('target_db', None),
+                  'read_mode': kwargs.get('read_mode', 'pydub'),
+                  'backend': self.get_inference_backend().fingerprint()}
+        if self.get_shared_crop_embedder() is not None:
+            params['shared_crop_frames'] = True
+        params_key = (self.checkpoint_fingerprint, tuple(sorted(params.items())))
+        if params_key not in self.embedding_caches:
+            try:
+                cache = EmbeddingCache(self.kwargs['embedding_cache'],
+                                       checkpoint=self.checkpoint_fingerprint,
+                                       params=params,
+                                       max_size_mb=self.kwargs.get('embedding_cache_size_mb', 2048),
+                                       key_mode=self.kwargs.get('embedding_cache_key', 'stat'))
+                atexit.register(cache.flush)
+            except CacheLockedError as e:
+                # one process per cache (e.g. rank 0 of a distributed run), the others extract
+                print(f"{e}, embeddings are not cached in this process")
+                cache = None
+            self.embedding_caches[params_key] = cache
+        return self.embedding_caches[params_key]
+
+    def get_shared_crop_embedder(self):
+        '''
+        SharedCropEmbedder of the evaluation crops when `shared_crop_frames` is set,
+        None when disabled or not supported by the model / backend (crops are then forwarded one by one)
+        '''
+        if self.shared_crop_embedder is None:
+            self.shared_crop_embedder = False
+            if self.kwargs.get('shared_crop_frames', False):
+                try:
+                    if self.get_inference_backend().name != 'torch':
+                        raise NotImplementedError(f"{self.get_inference_backend().name} inference backend")
+                    self.shared_crop_embedder = SharedCropEmbedder(self)
+                    print("Evaluation crops: shared frame-level pass")
+                except NotImplementedError as e:
+                    print(f"Evaluation crops: shared frame-level pass not supported ({e}), forwarding the crops")
+        return self.shared_crop_embedder or None
+
+    def get_time_domain(self):
+        '''
+        BatchTimeDomain of the training batches when `time_domain_mode` is batch with the
+        time_domain augmentation (Loader then loads longer crops), None otherwise
+        '''
+        if self.time_domain is None:
+            self.time_domain = False
+            if self.kwargs.get('time_domain_mode') == 'batch' and self.kwargs.get('augment', False) \
+                    and 'time_domain' in (self.kwargs.get('augment_chain') or []):
+                sample_rate = self.kwargs['sample_rate']
+                max_audio = int(self.kwargs['max_frames'] * 10e-3 * sample_rate + (25e-3 * sample_rate - 10e-3 * sample_rate))
+                self.time_domain = BatchTimeDomain(max_audio)
+                print(f"Time-domain augmentation: batched on {self.device}")
+        return self.time_domain or None
+
+    def get_env_corrupt(self):
+        '''
+        BatchEnvCorrupt of the training batches when `batch_env_corrupt` is set with the
+        env_corrupt augmentation (Loader then leaves the crops clean), None otherwise
+        '''
+        if self.env_corrupt is None:
+            self.env_corrupt = False
+            if self.kwargs.get('batch_env_corrupt', False) and self.kwargs.get('augment', False) \
+                    and 'env_corrupt' in (self.kwargs.get('augment_chain') or []):
+                augment_engine = AugmentWAV(musan_path=self.kwargs['musan_path'],
+                                            rir_path=self.kwargs['rir_path'],
+                                            max_frames=self.kwargs['max_frames'],
+                                            sample_rate=self.kwargs['sample_rate'],
+                                            bank_dir=augment_bank_dir(**dict(self.kwargs, save_path=self.save_path)))
+                self.env_corrupt = BatchEnvCorrupt(augment_engine)
+                print(f"Environment corruption: batched on {self.device}")
+        return self.env_corrupt or None
+
+    def onnx_backend_options(self):
+        return {'intra_op_threads': self.kwargs.get('onnx_intra_op_threads', 0),
+                'inter_op_threads': self.kwargs.get('onnx_inter_op_threads', 0),
+                'graph_optimization': self.kwargs.get('onnx_graph_optimization', 'all'),
+                'pool_size': self.kwargs.get('onnx_session_pool', 1)}
+
+    def get_inference_backend(self):
+        '''
+        Backend of forward_crops chosen by `inference_backend` (torch / onnx),
+        the onnx backend runs the graph at `onnx_path`
+        '''
+        if self.inference_backend is None:
+            backend = self.kwargs.get('inference_backend', None) or 'torch'
+            if backend == 'onnx':
+                self.inference_backend = self.get_onnx_backend(self.kwargs.get('onnx_path', None))
+            else:
+                self.inference_backend = create_backend(self, backend)
+            print(f"Inference backend: {self.inference_backend.fingerprint()}")
+        return self.inference_backend
+
+    def get_onnx_backend(self, model_path):
+        '''ONNX Runtime sessions of the graph, built once per path'''
+        if model_path is None:
+            model_path = os.path.join(self.save_path, self.model_name, "model", f"model_eval_{self.model_name}.onnx")
+        if model_path not in self.onnx_backends:
+            self.onnx_backends[model_path] = create_backend(self, 'onnx', onnx_path=model_path,
+                                                            **self.onnx_backend_options())
+        return self.onnx_backends[model_path]
+
+    def forward_crops(self, inp):
+        """
+        Forward a batch of crops (n_crops, n_samples) through the front-end and the model
+        """
+        return self.get_inference_backend()(inp)
+
     def saveParameters(self, path):
         torch.save(self.state_dict(), path)
 
@@ -577,6 +789,13 @@ class SpeakerNet(nn.Module):
         else:
             print(f"Load model in {torch.cuda.device_count()} GPU(s)")
             loaded_state = torch.load(path, map_location=torch.device(self.device))
+
+        quantization = loaded_state.pop(QUANTIZATION_KEY, None)
+        if quantization is not None:
+            self.load_quantized_state(loaded_state, quantization)
+            self.set_checkpoint(path)
+            return
+
         for name, param in loaded_state.items():
             origname = name
             if name not in self_state:
@@ -596,44 +815,136 @@ class SpeakerNet(nn.Module):
 
             self_state[name].copy_(param)
 
-    def export_onnx(self, state_path, check=True):
-        save_root = self.save_path + f"/{self.model_name}/model"
-        save_path = os.path.join(save_root, f"model_eval_{self.model_name}.onnx")
-
-        input_names = ["input"]
-        output_names = ["output"]
-        # NOTE: because using torch.audio -> cant export onnx
-        dummy_input = torch.randn(10, 8120, device="cuda")
-
-        self.loadParameters(state_path)
-        self.__S__.eval()
-
-        torch.onnx.export(self.__S__,
-                          dummy_input,
-                          save_path,
-                          verbose=False,
-                          input_names=input_names,
-                          output_names=output_names,
-                          
-                          export_params=True,
-                          opset_version=11)
-
-        # double check
-        if os.path.exists(save_path) and check:
+        self.set_checkpoint(path)
+
+    def set_checkpoint(self, path):
+        '''Record the checkpoint of the weights, hashed only when an embedding cache is used'''
+        self.checkpoint_path = str(path)
+        self.checkpoint_stat = file_fingerprint(path, key_mode='stat')
+        self.checkpoint_fingerprint = None
+
+    def deploy(self):
+        '''
+        Inference-only graph after loadParameters (see deploy.py): RepVGG re-parameterization,
+        cached sinc filters, conv+bn fusion and TorchScript freezing. The model can not be trained afterwards.
+        '''
+        eval_frames = self.kwargs.get('eval_frames', None) or 100
+        sample_rate = self.kwargs.get('sample_rate', 8000)
+        return deploy_model(self, n_samples=int(eval_frames * 10e-3 * sample_rate + 15e-3 * sample_rate))
+
+    def load_quantized_state(self, loaded_state, quantization):
+        '''
+        Load an int8 checkpoint of quantization.py: the fp32 modules are replaced by the quantized
+        ones listed in the checkpoint config, then their weights and scales are loaded
+        '''
+        if self.device != torch.device('cpu'):
+            raise ValueError("Quantized checkpoints run on cpu, create the model with device='cpu'")
+        self.eval()
+        with warnings.catch_warnings():
+            # observers are not calibrated, the scales come from the checkpoint
+            warnings.simplefilter('ignore')
+            build_quantized_structure(self.__S__, quantization)
+            convert_quantized_structure(self.__S__, quantization)
+        self.inference_backend = None
+        self.shared_crop_embedder = None
+        missing, unexpected = self.load_state_dict(loaded_state, strict=False)
+        if missing or unexpected:
+            print(f"Quantized checkpoint: {len(missing)} missing and {len(unexpected)} unexpected parameters")
+        print(f"Loaded int8 model: {len(quantization['static'])} static Conv1d, dynamic Linear: {quantization['dynamic']}")
+
+    def export_onnx(self, state_path=None, check=True, save_path=None, opset_version=17,
+                    check_lengths=None, check_batch_sizes=(1, 4), tolerance=1e-4):
+        """
+        Export the feature front-end (pre-emphasis, filterbanks) and the model to one ONNX graph
+        with dynamic batch and time axes: waveform (n_crops, n_samples) -> embeddings (n_crops, nOut).
+        Runs on the device of the model, so CPU-only boxes can export.
+
+        Args:
+            state_path (str, optional): checkpoint to load, None exports the current weights. Defaults to None.
+            check (bool, optional): check the graph and its parity with PyTorch. Defaults to True.
+            save_path (str, optional): output file. Defaults to <save_path>/<model>/model/model_eval_<model>.onnx.
+            opset_version (int, optional): ONNX opset. Defaults to 17.
+            check_lengths (tuple, optional): input lengths (samples) of the parity check. Defaults to 1, 2 and 4 s.
+            check_batch_sizes (tuple, optional): number of crops of the parity check.
+            tolerance (float, optional): max abs difference allowed, relative to the embedding scale. Defaults to 1e-4.
+
+        Returns:
+            str: path of the exported graph
+        """
+        if save_path is None:
+            save_path = os.path.join(self.save_path, self.model_name, "model", f"model_eval_{self.model_name}.onnx")
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+
+        if state_path is not None:
+            self.loadParameters(state_path)
+        self.eval()
+        export_module = ExportModule(self.__S__, self.compute_features).eval()
+        # torchaudio spectrograms (complex STFT) are swapped for conv1d ones in the exported copy
+        traced_module = exportable_features(export_module).eval()
+
+        max_frames = self.kwargs.get('eval_frames', None) or 100
+        sample_rate = self.kwargs.get('sample_rate', 8000)
+        dummy_input = torch.randn(2, int(max_frames * 10e-3 * sample_rate + 15e-3 * sample_rate), device=self.device)
+        if check_lengths is None:
+            check_lengths = tuple(int(frames * 10e-3 * sample_rate + 15e-3 * sample_rate) for frames in (100, 200, 400))
+        export_kwargs = {}
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            # the TorchScript exporter supports the nnAudio/torchaudio front-ends
+            export_kwargs['dynamo'] = False
+
+        with torch.no_grad():
+            torch.onnx.export(traced_module,
+                              dummy_input,
+                              save_path,
+                              verbose=False,
+                              input_names=["input"],
+                              output_names=["output"],
+                              dynamic_axes={"input": {0: "n_crops", 1: "n_samples"},
+                                            "output": {0: "n_crops"}},
+                              export_params=True,
+                              do_constant_folding=True,
+                              opset_version=opset_version,
+                              **export_kwargs)
+
+        # tell the onnx backend that the graph starts from the waveform
+        onnx_model = onnx.load(save_path)
+        onnx.helper.set_model_props(onnx_model, {'front_end': 'included',
+                                                 'model': self.model_name,
+                                                 'features': self.features})
+        onnx.save(onnx_model, save_path)
+        print("Exported to", save_path)
+
+        if check:
             print("checking export")
-            model = onnx.load(save_path)
-            onnx.checker.check_model(model)
-            print(onnx.helper.printable_graph(model.graph))
+            onnx.checker.check_model(save_path)
+            self.check_onnx_parity(save_path, export_module, check_lengths, check_batch_sizes, tolerance)
             cprint("Done!!!", 'r')
+        return save_path
+
+    def check_onnx_parity(self, onnx_path, export_module, lengths, batch_sizes, tolerance=1e-4):
+        '''Compare the ONNX Runtime outputs with PyTorch on random inputs of several shapes'''
+        session = create_backend(self, 'onnx', onnx_path=onnx_path)
+        for n_samples in lengths:
+            for n_crops in batch_sizes:
+                inp = torch.randn(n_crops, n_samples) * 0.1
+                with torch.no_grad():
+                    ref = export_module(inp.to(self.device)).cpu()
+                out = session(inp)
+                diff = (out - ref).abs().max().item()
+                scale = max(1.0, ref.abs().max().item())
+                print(f"> Parity {n_crops} x {n_samples}: output {tuple(out.shape)}, max abs diff {diff:.2e}")
+                if tuple(out.shape) != tuple(ref.shape) or diff > tolerance * scale:
+                    raise RuntimeError(f"ONNX output differs from PyTorch for input ({n_crops}, {n_samples}): "
+                                       f"shape {tuple(out.shape)} vs {tuple(ref.shape)}, max abs diff {diff:.2e}")
 
     def onnx_inference(self, model_path, inp):
         def to_numpy(tensor):
             if not torch.is_tensor(tensor):
                 tensor = torch.FloatTensor(tensor)
             return tensor.detach().cpu().numpy() if tensor.requires_grad else tensor.cpu().numpy()
-        
-        onnx_session = onnxrt.InferenceSession(model_path)
-        onnx_inputs = {onnx_session.get_inputs()[0].name: to_numpy(inp)}
-        onnx_output = onnx_session.run(None, onnx_inputs)
-        return onnx_output
+
+        # sessions are reused between calls
+        onnx_backend = self.get_onnx_backend(model_path)
+        onnx_output = onnx_backend.run(np.ascontiguousarray(to_numpy(inp), dtype=np.float32))
+        return [onnx_output]
 ##################################################################################################
\ No newline at end of file
@@ -1519,9 +1519,10 @@ def length_to_mask(length, max_len=None, dtype=None, device=None):
 
     if max_len is None:
         max_len = length.max().long().item()  # using arange to generate mask
+    # broadcast instead of expand(len(length), ...) so that traced graphs keep a dynamic batch size
     mask = torch.arange(
         max_len, device=length.device, dtype=length.dtype
-    ).expand(len(length), max_len) < length.unsqueeze(1)
+    ).unsqueeze(0) < length.unsqueeze(1)
 
     if dtype is None:
         dtype = length.dtype
@@ -1,3 +1,5 @@
+import copy
+
 import torch  # noqa: F401
 import torch.nn as nn
 import torch.nn.functional as F
@@ -92,6 +94,59 @@ def melspectrogram(lib = 'nnaudio',
                                                     norm='slaney',
                                                     mel_scale='slaney')
     return torch.nn.Sequential(PreEmphasis(),feat) if pre_emphasis else feat
-                                                    
 
-    
\ No newline at end of file
+
+class ConvMelSpectrogram(nn.Module):
+    """torchaudio MelSpectrogram computed with a conv1d STFT (window folded into the DFT kernels)
+    and a matmul with the mel filterbank, same output without complex ops so it exports to ONNX"""
+    def __init__(self, mel_spectrogram):
+        super(ConvMelSpectrogram, self).__init__()
+        spec = mel_spectrogram.spectrogram
+        if spec.normalized or spec.power is None or not spec.onesided:
+            raise NotImplementedError("Only un-normalized onesided power spectrograms are supported")
+        self.n_fft = spec.n_fft
+        self.hop_length = spec.hop_length
+        self.pad = spec.pad
+        self.power = spec.power
+        self.center = spec.center
+        self.pad_mode = spec.pad_mode
+
+        # window centered in n_fft as in torch.stft
+        window = spec.window.detach().float().cpu()
+        left = (self.n_fft - window.shape[0]) // 2
+        window = F.pad(window, (left, self.n_fft - window.shape[0] - left))
+        k = torch.arange(self.n_fft // 2 + 1, dtype=torch.float64).unsqueeze(1)
+        n = torch.arange(self.n_fft, dtype=torch.float64).unsqueeze(0)
+        angle = 2 * np.pi * k * n / self.n_fft
+        kernel = torch.cat([torch.cos(angle), -torch.sin(angle)], dim=0).float() * window
+        device = spec.window.device
+        self.register_buffer('kernel', kernel.unsqueeze(1).to(device))
+        self.register_buffer('fb', mel_spectrogram.mel_scale.fb.detach().clone())
+
+    def forward(self, x):
+        if self.pad > 0:
+            x = F.pad(x, (self.pad, self.pad))
+        x = x.unsqueeze(1)
+        if self.center:
+            x = F.pad(x, (self.n_fft // 2, self.n_fft // 2), mode=self.pad_mode)
+        real, imag = F.conv1d(x, self.kernel, stride=self.hop_length).chunk(2, dim=1)
+        spec = real ** 2 + imag ** 2
+        if self.power != 2:
+            spec = spec.pow(self.power / 2)
+        return torch.matmul(spec.transpose(1, 2), self.fb).transpose(1, 2)
+
+
+def exportable_features(compute_features):
+    """Copy of a feature front-end with the torchaudio (complex STFT) mel spectrograms replaced
+    by ConvMelSpectrogram, nnAudio front-ends and pre-emphasis are already convolutions"""
+    if compute_features is None:
+        return None
+    if isinstance(compute_features, torchaudio.transforms.MelSpectrogram):
+        return ConvMelSpectrogram(compute_features)
+
+    compute_features = copy.deepcopy(compute_features)
+    for module in list(compute_features.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, torchaudio.transforms.MelSpectrogram):
+                setattr(module, name, ConvMelSpectrogram(child))
+    return compute_features
@@ -4,6 +4,7 @@ import random
 import sys
 import time
 import wave
+from collections import OrderedDict
 
 import numpy as np
 
@@ -11,9 +12,13 @@ import soundfile as sf
 from pydub import AudioSegment
 
 from scipy import signal
+from scipy.fft import irfft, next_fast_len, rfft
 from scipy.io import wavfile
 
-from .augment import (random_augment_speed, random_augment_pitch_shift, random_augment_volume, gain_target_amplitude)
+from .shards import SHARD_INDEX, SHARD_LIST, ShardReader, build_lock, pack_shards
+from .augment import (random_augment_speed, random_augment_pitch_shift, random_augment_volume, gain_target_amplitude,
+                      random_speed, random_pitch_step, random_volume_gain,
+                      apply_gain, change_rate, change_rate_crop, rate_crop_length)
 from .wav_conversion import segment_to_np, np_to_segment, normalize_audio_amp
 
 
@@ -41,11 +46,75 @@ def random_augment_audio(audio_seg, p=[0, 0.25, 0.25, 0.25, 0.25]):
         
     return audio_seg
 
+
+def random_time_domain_params(p=[0, 0.25, 0.25, 0.25, 0.25]):
+    '''Draws of random_augment_audio for the array implementation: (rate factor, gain in dB),
+    speed and pitch shift are both a change of rate, the factor is their product'''
+    aug_types = ['all', 'speed', 'pitch', 'volume', 'none']
+    aug_type = np.random.choice(aug_types, p=p)
+
+    factor, gain = 1.0, 0.0
+    if aug_type in ['all', 'speed']:
+        factor *= random_speed(0.95, 1.05)
+    if aug_type in ['all', 'pitch']:
+        factor *= 2.0 ** (random_pitch_step(-0.5, 0.5) / 12)
+    if aug_type in ['all', 'volume']:
+        gain = random_volume_gain(volume=6)
+    return factor, gain
+
+
+def augment_crop(read, max_audio):
+    '''One training crop with the array time-domain augmentation (random_time_domain_params)
+
+    Only the samples needed are resampled: `read(n_samples)` returns a random crop of n_samples of
+    the recording (1, n_samples), or None when it can not be read that way (then returns None).
+    '''
+    factor, gain = random_time_domain_params()
+    audio = read(rate_crop_length(max_audio, factor))
+    if audio is None:
+        return None
+    return apply_gain(change_rate_crop(audio, factor, max_audio), gain)
+
 # ================================================Utils============================================
+# wav encodings read by soundfile with the scale of segment_to_np(normalize=True)
+SEEK_SUBTYPES = ('PCM_16', 'PCM_32')
+
+
+def read_crop(audio_path, max_frames, sample_rate=8000, n_samples=None):
+    '''One random training crop of a mono wav file, as loadWAV(evalmode=False) without augmentation
+
+    Only the header is parsed, the crop offset is drawn from the frame count and the file is read
+    from there: the cost does not depend on the length of the recording.
+    n_samples sets the crop length instead of max_frames.
+    Returns None when the file is not a mono PCM wav readable by soundfile (decode it with pydub).
+    '''
+    hoplength = 10e-3 * sample_rate
+    winlength = 25e-3 * sample_rate
+    max_audio = n_samples or int(max_frames * hoplength + (winlength - hoplength))
+    try:
+        with sf.SoundFile(audio_path) as f:
+            if f.channels != 1 or f.subtype not in SEEK_SUBTYPES:
+                return None
+            assert sample_rate == f.samplerate, f"Sample rate is not same as desired value {sample_rate} and {f.samplerate}"
+            audiosize = f.frames
+            if audiosize <= max_audio:
+                audio = np.pad(f.read(dtype='float64'), (0, max_audio - audiosize + 1), 'wrap')
+                audiosize = audio.shape[0]
+            # same draw as loadWAV
+            startframe = int(np.int64(random.random() * (audiosize - max_audio)))
+            if audiosize > f.frames:
+                return audio[None, startframe:startframe + max_audio]
+            f.seek(startframe)
+            return f.read(max_audio, dtype='float64')[None]
+    except RuntimeError:
+        # not a format libsndfile can read (mp3, ...)
+        return None
+
+
 def loadWAV(audio_source, max_frames, 
             evalmode=True, num_eval=10, sample_rate=8000, 
             augment=False, augment_chain=None, target_db=None, 
-            read_mode='pydub', **kwargs):
+            read_mode='pydub', time_domain_mode='pydub', **kwargs):
     '''Load audio form .wav file and return as the np array
 
     Args:
@@ -56,9 +125,24 @@ def loadWAV(audio_source, max_frames,
         sr ([type], optional): [description]. Defaults to None.
         augment([bool]): decide wether apply augment on loading aduio(time domain)
         augment_chain(list, str): chain of augment to apply(if augment == True). available: env_corrupt time_domain spec_domain
+        read_mode(str): pydub, sf or seek (training crop read in place with read_crop, pydub otherwise)
+        time_domain_mode(str): pydub (AudioSegment) or array (cached polyphase resampling of the crop only)
     Returns:
         ([ndarray]): audio_array
     '''
+    time_domain = augment and ('time_domain' in augment_chain)
+    # the array augmentation only resamples the crop, pydub augmentation and gain work on the whole recording
+    array_time_domain = time_domain and time_domain_mode == 'array' and target_db is None
+    if read_mode == 'seek' and isinstance(audio_source, str) and not evalmode and max_frames > 0 \
+            and (array_time_domain or not time_domain) and target_db is None:
+        if array_time_domain:
+            max_audio = int(max_frames * 10e-3 * sample_rate + (25e-3 * sample_rate - 10e-3 * sample_rate))
+            feat = augment_crop(lambda n_samples: read_crop(audio_source, max_frames, sample_rate, n_samples), max_audio)
+        else:
+            feat = read_crop(audio_source, max_frames, sample_rate=sample_rate)
+        if feat is not None:
+            return feat
+
     if isinstance(audio_source, str):
         if read_mode == 'sf': 
             audio, sample_rate = sf.read(audio_source)
@@ -69,7 +153,7 @@ def loadWAV(audio_source, max_frames,
             assert sample_rate == sr, f"Sample rate is not same as desired value {sample_rate} and {sr}"
             sample_rate = sr
 
-            if augment and ('time_domain' in augment_chain):
+            if time_domain and not array_time_domain:
                 audio_seg = random_augment_audio(audio_seg)
             if target_db is not None:
                 audio_seg = gain_target_amplitude(audio_seg, target_db)
@@ -81,6 +165,10 @@ def loadWAV(audio_source, max_frames,
         audio = normalize_audio_amp(audio_source)
     else:
         raise "Invalid format of audio source, available: str, ndarray" 
+
+    if array_time_domain:
+        factor, gain = random_time_domain_params()
+        audio = apply_gain(change_rate(audio, factor), gain)
       
     audiosize = audio.shape[0]
     
@@ -113,15 +201,50 @@ def loadWAV(audio_source, max_frames,
             for asf in startframe:
                 feats.append(audio[int(asf):int(asf) + max_audio])
 
-        feat = np.stack(feats, axis=0).astype(np.float)
+        feat = np.stack(feats, axis=0).astype(np.float64)
 
         return feat
     else:
         return audio
 
+def load_augment_bank(noiselist, rir_files, bank_dir, sample_rate=8000):
+    '''Noise and RIR files packed once into int16 shards at `sample_rate` (see processing.shards)
+
+    The bank is rebuilt only when the files are not those of its list, by one process at a
+    time (build_lock): the other ranks and workers wait for it and open the complete bank.
+    Returns the ShardReader of the bank and the entry of each file path.
+    '''
+    lines = [f"{category} {path}\n" for category, paths in sorted(noiselist.items()) for path in paths]
+    lines += [f"rir {path}\n" for path in rir_files]
+    bank_list = os.path.join(bank_dir, SHARD_LIST)
+    with build_lock(bank_dir):
+        built = os.path.exists(os.path.join(bank_dir, SHARD_INDEX)) and os.path.exists(bank_list)
+        if built:
+            with open(bank_list) as f:
+                built = f.readlines() == lines
+        if not built:
+            sources = os.path.join(bank_dir, 'sources.txt')
+            with open(sources, 'w') as wf:
+                wf.writelines(lines)
+            pack_shards(sources, bank_dir, sample_rate=sample_rate, resample=True)
+        bank = ShardReader(bank_dir, sample_rate=sample_rate)
+    paths = [line.split()[1] for line in lines]
+    return bank, dict(zip(paths, bank.lookup(paths)))
+
+
+def augment_bank_dir(musan_path, sample_rate=8000, augment_bank=False, **kwargs):
+    '''Directory of the noise and RIR bank of the training options (augment_bank_dir, or
+    augment_bank_<sample_rate> under save_path, not next to the dataset), None when disabled'''
+    if not augment_bank:
+        return None
+    return kwargs.get('augment_bank_dir') or \
+        os.path.join(kwargs.get('save_path') or '.', f"augment_bank_{sample_rate}")
+
+
 ## Environment corruption
 class AugmentWAV(object):
-    def __init__(self, musan_path, rir_path, max_frames, sample_rate=8000, target_db=None):
+    def __init__(self, musan_path, rir_path, max_frames, sample_rate=8000, target_db=None, bank_dir=None,
+                 reverb_mode='direct', rir_cache_size=512):
         self.sr = sample_rate
         self.target_db = target_db
         
@@ -161,6 +284,49 @@ class AugmentWAV(object):
         # RIRS_NOISES/simulated_rirs/ + smallroom/Room001/Room001-00001.wav
         self.rir_files = glob.glob(os.path.join(rir_path, '*/*/*.wav'))
 
+        # bank_dir: noise and RIR bank built there once and memory-mapped by every worker, crops are
+        # sliced from RAM instead of decoding files. None decodes the files on every call
+        self.bank = None
+        if bank_dir is not None and target_db is None:
+            self.bank, self.bank_entries = load_augment_bank(self.noiselist, self.rir_files, bank_dir, sample_rate=self.sr)
+
+        # reverb_mode: direct (scipy convolve of the whole RIR) or fft (product with the cached spectrum
+        # of the RIR truncated to max_audio, only the first max_audio samples of the reverb are kept)
+        assert reverb_mode in ['direct', 'fft'], f"Invalid reverb_mode {reverb_mode}, available: direct, fft"
+        self.reverb_mode = reverb_mode
+        self.rir_cache_size = rir_cache_size
+        self.rir_spectra = OrderedDict()
+
+    def noise_crop(self, noise):
+        '''One random crop (1, max_audio) of a noise file'''
+        if self.bank is not None:
+            return self.bank.crop(self.bank_entries[noise], self.max_frames)
+        return loadWAV(noise, self.max_frames, evalmode=False, sample_rate=self.sr, target_db=self.target_db)
+
+    def rir(self, rir_file):
+        '''Impulse response of unit energy, (1, length)'''
+        if self.bank is not None:
+            rir = self.bank.audio(self.bank_entries[rir_file]) / 32768.0
+        else:
+            rir = loadWAV(rir_file, max_frames=-1, evalmode=False, sample_rate=self.sr, target_db=self.target_db)
+        rir = np.expand_dims(rir.astype(np.float64), 0)
+        return rir / np.sqrt(np.sum(rir ** 2))
+
+    def rir_spectrum(self, rir_file):
+        '''
+        rfft of the unit-energy RIR truncated to max_audio samples and its length n_fft (fast length
+        of the linear convolution with a crop), least recently used evicted
+        '''
+        cached = self.rir_spectra.pop(rir_file, None)
+        if cached is None:
+            rir = self.rir(rir_file)[0, :self.max_audio]
+            n_fft = next_fast_len(self.max_audio + rir.shape[0] - 1, real=True)
+            cached = (rfft(rir, n_fft), n_fft)
+            if len(self.rir_spectra) >= self.rir_cache_size:
+                self.rir_spectra.popitem(last=False)
+        self.rir_spectra[rir_file] = cached
+        return cached
+
     def additive_noise(self, noisecat, audio):
 
         clean_db = 10 * np.log10(np.mean(audio ** 2) + 1e-4)
@@ -169,7 +335,7 @@ class AugmentWAV(object):
                                   random.randint(num_noise[0], num_noise[1]))
         noises = []
         for noise in noiselist:
-            noiseaudio = loadWAV(noise, self.max_frames, evalmode=False, sample_rate=self.sr, target_db=self.target_db)
+            noiseaudio = self.noise_crop(noise)
             noise_snr = random.uniform(self.noisesnr[noisecat][0],
                                        self.noisesnr[noisecat][1])
             noise_db = 10 * np.log10(np.mean(noiseaudio[0] ** 2) + 1e-4)
@@ -179,9 +345,11 @@ class AugmentWAV(object):
 
     def reverberate(self, audio):
         rir_file = random.choice(self.rir_files)
-        rir = loadWAV(rir_file, max_frames=-1, evalmode=False, sample_rate=self.sr, target_db=self.target_db)
-        rir = np.expand_dims(rir.astype(np.float), 0)
-        rir = rir / np.sqrt(np.sum(rir ** 2))
+        if self.reverb_mode == 'fft':
+            # no sample after max_audio of the audio or of the RIR reaches the kept output
+            spectrum, n_fft = self.rir_spectrum(rir_file)
+            return irfft(rfft(audio[:, :self.max_audio], n_fft) * spectrum, n_fft)[:, :self.max_audio]
+        rir = self.rir(rir_file)
         aug_audio = signal.convolve(audio, rir, mode='full')[:, :self.max_audio]
         return aug_audio
 
@@ -1,7 +1,9 @@
+import math
 import os
 import random
 import time
 import wave
+from functools import lru_cache
 
 import numpy as np
 import soundfile as sf
@@ -23,7 +25,7 @@ def gain_target_amplitude(sound, target_dBFS=-10):
     return sound.apply_gain(change_in_dBFS)
 
     
-def random_augment_volume(signal, volume=6):
+def random_volume_gain(volume=6):
     states = ['higher', 'lower', 'unchange']
     state = np.random.choice(states, p=[0.5, 0.5, 0])
     
@@ -34,7 +36,11 @@ def random_augment_volume(signal, volume=6):
     else:
         gain = 0 # unchange speed
         
-    return signal.apply_gain(gain)
+    return gain
+
+
+def random_augment_volume(signal, volume=6):
+    return signal.apply_gain(random_volume_gain(volume))
 
 def speed_change(sound, speed=1.0):
     # Manually override the frame_rate. This tells the computer how many
@@ -50,7 +56,7 @@ def speed_change(sound, speed=1.0):
     # know how to play audio at standard frame rate (like 44.1k)
     return sound_with_altered_frame_rate.set_frame_rate(sound.frame_rate)
 
-def random_augment_speed(sound, low=0.95, high=1.05):
+def random_speed(low=0.95, high=1.05):
     states = ['faster', 'slower', 'unchange']
     state = np.random.choice(states, p=[0.5, 0.5, 0])
     
@@ -61,7 +67,11 @@ def random_augment_speed(sound, low=0.95, high=1.05):
     else:
         speed = 1.0 # unchange speed
         
-    return speed_change(sound, speed)
+    return speed
+
+
+def random_augment_speed(sound, low=0.95, high=1.05):
+    return speed_change(sound, random_speed(low, high))
 
 
 def pitch_shift(sound, n_step=0.0, n_octave_bin=12, sr=8000):
@@ -79,7 +89,7 @@ def pitch_shift(sound, n_step=0.0, n_octave_bin=12, sr=8000):
     hipitch_sound = hipitch_sound.set_frame_rate(sr)    
     return hipitch_sound
 
-def random_augment_pitch_shift(x, nstep_low=-0.5, n_step_high=0.5):
+def random_pitch_step(nstep_low=-0.5, n_step_high=0.5):
     states = ['higher', 'lower', 'unchange']
     state = np.random.choice(states, p=[0.5, 0.5, 0])
     
@@ -90,7 +100,65 @@ def random_augment_pitch_shift(x, nstep_low=-0.5, n_step_high=0.5):
     else:
         n_step = 0 # unchange speed
         
-    return pitch_shift(x, n_step)
+    return n_step
+
+
+def random_augment_pitch_shift(x, nstep_low=-0.5, n_step_high=0.5):
+    return pitch_shift(x, random_pitch_step(nstep_low, n_step_high))
+
+
+## Time domain on arrays
+# speed / pitch factors are quantized to 1/RATE_GRID: a small set of polyphase filters, designed once
+RATE_GRID = 200
+
+
+def quantize_rate(factor, grid=RATE_GRID):
+    '''(up, down) of the resampling playing the audio `factor` times faster, factor ~ down / up'''
+    up, down = grid, max(int(round(factor * grid)), 1)
+    gcd = math.gcd(up, down)
+    return up // gcd, down // gcd
+
+
+@lru_cache(maxsize=None)
+def resample_filter(up, down):
+    '''Low-pass FIR of scipy.signal.resample_poly(up, down), read-only'''
+    max_rate = max(up, down)
+    h = signal.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    h.flags.writeable = False
+    return h
+
+
+def change_rate(audio, factor, grid=RATE_GRID):
+    '''Audio (..., time) played `factor` times faster at the same sample rate: speed_change(speed=factor)
+    and pitch_shift(n_step=12 * log2(factor)) of pydub, with a polyphase resampler instead of audioop'''
+    up, down = quantize_rate(factor, grid)
+    if up == down:
+        return audio
+    return signal.resample_poly(audio, up, down, axis=-1, window=resample_filter(up, down))
+
+
+# input samples read on each side of a crop to resample, away from the zero padding of the filter
+RATE_MARGIN = 16
+
+
+def rate_crop_length(n_out, factor, grid=RATE_GRID):
+    '''Input samples of change_rate_crop'''
+    up, down = quantize_rate(factor, grid)
+    return math.ceil(n_out * down / up) + 2 * RATE_MARGIN
+
+
+def change_rate_crop(audio, factor, n_out, grid=RATE_GRID):
+    '''n_out samples of change_rate of a crop of rate_crop_length(n_out, factor) samples, its edges left out'''
+    up, down = quantize_rate(factor, grid)
+    start = math.ceil(RATE_MARGIN * up / down)
+    return change_rate(audio, factor, grid)[..., start:start + n_out]
+
+
+def apply_gain(audio, gain):
+    '''Gain in dB of a normalized audio, clipped to the int16 range as pydub apply_gain'''
+    if gain == 0:
+        return audio
+    return np.clip(audio * 10 ** (gain / 20), -1.0, 32767 / 32768)
     
 
 def random_drop_chunk(sound, lengths,         
@@ -0,0 +1,270 @@
+import random
+
+import numpy as np
+import torch
+from scipy.fft import next_fast_len
+
+from .audio_signal import convolve1d, dB_to_amplitude
+from .audio_loader import random_time_domain_params
+from .augment import RATE_GRID, RATE_MARGIN, quantize_rate, rate_crop_length, resample_filter
+
+# environment corruption mix of the training samples (Loader and BatchEnvCorrupt)
+AUGTYPES = ['rev', 'noise', 'both', 'none']
+AUGTYPE_P = [0.2, 0.4, 0.2, 0.2]
+NOISE_MODES = ['noise', 'speech', 'music', 'noise_vad', 'noise_rirs']
+NOISE_MODE_P = [0.25, 0.25, 0.25, 0, 0.25]
+
+
+class BatchEnvCorrupt(object):
+    """Reverberation and additive noise of a whole training batch on its device
+
+    Same corruption as the env_corrupt of Loader (AugmentWAV.reverberate / additive_noise, same
+    augtype / noise mode mix, each utterance drawn independently), but the data workers only
+    load the clean crops: noise crops and RIRs are sliced from the bank of `augment_engine`,
+    convolution (FFT) and SNR mixing run batched on the device of the data.
+
+    Args:
+        augment_engine (AugmentWAV): noise / RIR lists, SNR ranges and bank
+    """
+    def __init__(self, augment_engine):
+        self.engine = augment_engine
+        # noise modes without files (e.g. no RIRS_NOISES noises) are left out of the mix
+        p = np.array([p if mode in self.engine.noiselist else 0 for mode, p in zip(NOISE_MODES, NOISE_MODE_P)])
+        self.noise_mode_p = p / p.sum()
+
+    def __call__(self, data):
+        """Corrupt a batch
+
+        Args:
+            data (torch.Tensor): (..., max_audio) clean crops, e.g. (batch, nPerSpeaker, max_audio)
+
+        Returns:
+            torch.Tensor: corrupted crops, same shape
+        """
+        assert data.shape[-1] == self.engine.max_audio, \
+            f"Crops of {data.shape[-1]} samples, augmentation of {self.engine.max_audio}"
+        x = data.reshape(-1, data.shape[-1])
+        augtype = np.random.choice(AUGTYPES, size=x.shape[0], p=AUGTYPE_P)
+        noise_first = np.random.rand(x.shape[0]) < 0.5
+
+        x = self.additive_noise(x, np.flatnonzero((augtype == 'noise') | ((augtype == 'both') & noise_first)))
+        x = self.reverberate(x, np.flatnonzero((augtype == 'rev') | (augtype == 'both')))
+        x = self.additive_noise(x, np.flatnonzero((augtype == 'both') & ~noise_first))
+        return x.reshape(data.shape)
+
+    def additive_noise(self, x, rows):
+        '''Noise of a random mode on the given rows of x (n, T), at the SNR ranges of AugmentWAV'''
+        if len(rows) == 0:
+            return x
+        noises, owners, snrs = [], [], []
+        for row, mode in zip(rows, np.random.choice(NOISE_MODES, size=len(rows), p=self.noise_mode_p)):
+            num_noise = self.engine.num_noise[mode]
+            for noise in random.sample(self.engine.noiselist[mode], random.randint(num_noise[0], num_noise[1])):
+                noises.append(self.engine.noise_crop(noise)[0])
+                owners.append(row)
+                snrs.append(random.uniform(self.engine.noisesnr[mode][0], self.engine.noisesnr[mode][1]))
+
+        noises = torch.from_numpy(np.stack(noises)).to(x.device, x.dtype)
+        owners = torch.as_tensor(owners, device=x.device)
+        snrs = torch.tensor(snrs, device=x.device, dtype=x.dtype)
+        clean_db = 10 * torch.log10(torch.mean(x[owners] ** 2, dim=-1) + 1e-4)
+        noise_db = 10 * torch.log10(torch.mean(noises ** 2, dim=-1) + 1e-4)
+        return x.index_add(0, owners, dB_to_amplitude(clean_db - noise_db - snrs).unsqueeze(-1) * noises)
+
+    def reverberate(self, x, rows):
+        '''Random RIR on the given rows of x (n, T): full convolution cut to T samples'''
+        if len(rows) == 0:
+            return x
+        rirs = [self.engine.rir(random.choice(self.engine.rir_files))[0] for _ in rows]
+        kernel = torch.zeros(len(rows), max(rir.shape[0] for rir in rirs), 1, dtype=x.dtype)
+        for ii, rir in enumerate(rirs):
+            kernel[ii, :rir.shape[0], 0] = torch.from_numpy(rir)
+        rows = torch.as_tensor(rows, device=x.device)
+        # zero padding of at least length(rir) - 1: the circular convolution of the FFT is the full one,
+        # up to a length the FFT is fast on
+        n_fft = next_fast_len(x.shape[-1] + kernel.shape[1] - 1, real=True)
+        reverbed = convolve1d(x[rows].unsqueeze(-1), kernel.to(x.device), padding=(0, n_fft - x.shape[-1]), use_fft=True)
+        return x.index_copy(0, rows, reverbed[:, :x.shape[-1], 0])
+
+
+# largest rate of random_time_domain_params: fastest speed and highest pitch
+MAX_RATE = 1.05 * 2.0 ** (0.5 / 12)
+
+
+def time_domain_frames(max_frames):
+    '''Frames of the crops loaded for BatchTimeDomain: the resampled crops keep max_frames'''
+    return int(np.ceil(max_frames * MAX_RATE)) + 1
+
+
+class BatchTimeDomain(object):
+    """Speed / pitch / volume of random_augment_audio on a whole training batch on its device
+
+    Draws of the array time-domain augmentation (random_time_domain_params) for each utterance,
+    the change of rate is the polyphase resampling of scipy.signal.resample_poly with the same
+    cached filters, computed as a gather of the input taps and their weights on the device.
+    The data workers load crops of time_domain_frames(max_frames), every resampled crop is cut
+    to `max_audio` samples.
+
+    Args:
+        max_audio (int): samples of the output crops
+        grid (int, optional): rate quantization, see processing.augment.quantize_rate. Defaults to RATE_GRID.
+    """
+    def __init__(self, max_audio, grid=RATE_GRID):
+        self.max_audio = max_audio
+        self.grid = grid
+        # (up, down, n_in, device) -> input taps and tap weights of the output samples
+        self.taps = {}
+
+    def polyphase_taps(self, up, down, n_in, device):
+        '''Input index (n_taps, max_audio) and weight (n_taps, max_audio) of the taps of the outputs of change_rate_crop'''
+        key = (up, down, n_in, str(device))
+        if key not in self.taps:
+            h = resample_filter(up, down) * up
+            half_len = (h.shape[0] - 1) // 2
+            # output i of resample_poly: sum_j h[i * down - j * up + half_len] x[j]
+            outputs = np.arange(self.max_audio) + int(np.ceil(RATE_MARGIN * up / down))
+            first = -((half_len - outputs * down) // up)
+            n_taps = 2 * half_len // up + 1
+            taps = first[:, None] + np.arange(n_taps)
+            filter_index = outputs[:, None] * down - taps * up + half_len
+            valid = (filter_index >= 0) & (filter_index < h.shape[0])
+            weights = np.where(valid, h[np.clip(filter_index, 0, h.shape[0] - 1)], 0)
+            self.taps[key] = (torch.from_numpy(np.clip(taps, 0, n_in - 1).T.copy()).to(device),
+                              torch.from_numpy(weights.T.copy()).float().to(device))
+        return self.taps[key]
+
+    def __call__(self, data):
+        """Augment a batch
+
+        Args:
+            data (torch.Tensor): (..., T) crops of time_domain_frames(max_frames)
+
+        Returns:
+            torch.Tensor: (..., max_audio) augmented crops
+        """
+        x = data.reshape(-1, data.shape[-1])
+        params = [random_time_domain_params() for _ in range(x.shape[0])]
+        rates = [quantize_rate(factor, self.grid) for factor, _ in params]
+        assert x.shape[-1] >= max(rate_crop_length(self.max_audio, down / up, self.grid) for up, down in rates), \
+            f"Crops of {x.shape[-1]} samples, too short for the rates of {self.max_audio} samples"
+
+        out = torch.empty(x.shape[0], self.max_audio, dtype=x.dtype, device=x.device)
+        for up, down in set(rates):
+            rows = torch.as_tensor([ii for ii, rate in enumerate(rates) if rate == (up, down)], device=x.device)
+            if up == down:
+                out[rows] = x[rows, RATE_MARGIN:RATE_MARGIN + self.max_audio]
+                continue
+            taps, weights = self.polyphase_taps(up, down, x.shape[-1], x.device)
+            weights = weights.to(x.dtype)
+            group = x[rows]
+            # one gather per tap, no (rows, max_audio, n_taps) intermediate
+            acc = torch.zeros(len(rows), self.max_audio, dtype=x.dtype, device=x.device)
+            for k in range(taps.shape[0]):
+                acc.addcmul_(group.index_select(1, taps[k]), weights[k])
+            out[rows] = acc
+
+        gains = torch.tensor([gain for _, gain in params], dtype=x.dtype, device=x.device)
+        out = torch.where((gains != 0).unsqueeze(-1),
+                          (out * dB_to_amplitude(gains).unsqueeze(-1)).clamp(-1.0, 32767 / 32768), out)
+        return out.reshape(data.shape[:-1] + (self.max_audio,))
+
+
+if __name__ == '__main__':
+    # per-sample AugmentWAV (data workers) vs the batched stage on a synthetic noise / RIR bank
+    import argparse
+    import os
+    import tempfile
+    import time
+
+    import soundfile as sf
+
+    from .audio_loader import AugmentWAV
+
+    parser = argparse.ArgumentParser(description="BatchEnvCorrupt")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--nPerSpeaker', type=int, default=2)
+    parser.add_argument('--max_frames', type=int, default=200)
+    parser.add_argument('--sample_rate', type=int, default=8000)
+    parser.add_argument('--rir_seconds', type=float, default=0.5)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    sr = args.sample_rate
+    root = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    for category in ['noise', 'speech', 'music']:
+        for i in range(20):
+            os.makedirs(f"{root}/musan_split/{category}/src/f{i}")
+            sf.write(f"{root}/musan_split/{category}/src/f{i}/00000.wav", (rng.randn(5 * sr) * 2000).astype(np.int16), sr)
+    n_rir = int(args.rir_seconds * sr)
+    for i in range(20):
+        os.makedirs(f"{root}/rirs/smallroom/Room{i:03d}")
+        rir = rng.randn(n_rir) * np.exp(-np.arange(n_rir) / (0.05 * sr)) * 20000
+        sf.write(f"{root}/rirs/smallroom/Room{i:03d}/r.wav", rir.astype(np.int16), sr)
+    engine = AugmentWAV(f"{root}/musan_split", f"{root}/rirs", args.max_frames, sample_rate=sr, bank_dir=f"{root}/bank")
+    batched = BatchEnvCorrupt(engine)
+
+    clean = rng.randn(args.batch_size, args.nPerSpeaker, engine.max_audio) * 0.1
+
+    # one RIR / noise through both paths
+    random.seed(0)
+    ref = engine.reverberate(clean[0, :1])
+    random.seed(0)
+    out = batched.reverberate(torch.from_numpy(clean[0, :1]), np.array([0]))
+    diff = np.abs(out.numpy() - ref).max()
+    print(f"reverberate max diff {diff:.1e}")
+    assert diff <= 1e-9 * np.abs(ref).max(), "batched reverberate differs from AugmentWAV"
+    random.seed(0)
+    np.random.seed(0)
+    ref = engine.additive_noise('speech', clean[0, :1])
+    random.seed(0)
+    speech = BatchEnvCorrupt(engine)
+    speech.noise_mode_p = np.array([mode == 'speech' for mode in NOISE_MODES], dtype=np.float64)
+    out = speech.additive_noise(torch.from_numpy(clean[0, :1]), np.array([0]))
+    diff = np.abs(out.numpy() - ref).max()
+    print(f"additive_noise (speech) max diff {diff:.1e}")
+    assert diff <= 1e-9 * np.abs(ref).max(), "batched additive_noise differs from AugmentWAV"
+
+    t0 = time.perf_counter()
+    for utterances in clean:
+        for audio in utterances:
+            augtype = np.random.choice(AUGTYPES, p=AUGTYPE_P)
+            audio = audio[None]
+            if augtype in ['noise', 'both']:
+                audio = engine.additive_noise(np.random.choice(NOISE_MODES, p=batched.noise_mode_p), audio)
+            if augtype in ['rev', 'both']:
+                audio = engine.reverberate(audio)
+    per_sample = time.perf_counter() - t0
+
+    data = torch.from_numpy(clean).float().to(args.device)
+    batched(data)
+    t0 = time.perf_counter()
+    out = batched(data)
+    if data.is_cuda:
+        torch.cuda.synchronize()
+    batch = time.perf_counter() - t0
+    print(f"{args.batch_size}x{args.nPerSpeaker} crops, rir {args.rir_seconds}s: per sample {per_sample * 1000:.0f} ms, "
+          f"batched ({args.device}) {batch * 1000:.0f} ms, x{per_sample / batch:.1f}")
+
+    # time domain: array augmentation of each crop vs the batch
+    from .audio_loader import augment_crop
+
+    long = rng.randn(args.batch_size, args.nPerSpeaker, int(time_domain_frames(args.max_frames) * 10e-3 * sr + 15e-3 * sr)) * 0.1
+    t0 = time.perf_counter()
+    for utterances in long:
+        for audio in utterances:
+            augment_crop(lambda n_samples: audio[None, :n_samples], engine.max_audio)
+    per_sample = time.perf_counter() - t0
+
+    time_domain = BatchTimeDomain(engine.max_audio)
+    data = torch.from_numpy(long).float().to(args.device)
+    # taps of the quantized rates are built on their first draw
+    for _ in range(10):
+        time_domain(data)
+    t0 = time.perf_counter()
+    out = time_domain(data)
+    if data.is_cuda:
+        torch.cuda.synchronize()
+    batch = time.perf_counter() - t0
+    print(f"time domain {args.batch_size}x{args.nPerSpeaker} crops: per sample {per_sample * 1000:.0f} ms, "
+          f"batched ({args.device}) {batch * 1000:.0f} ms, x{per_sample / batch:.1f}")
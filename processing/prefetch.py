@@ -0,0 +1,83 @@
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class AudioPrefetcher(object):
+    """Decode audio sources in background workers while the caller runs the model.
+
+    At most `queue_depth` sources are decoded ahead of the consumer, items are
+    yielded in the same order as `sources`.
+
+    Args:
+        load_fn (callable): source -> decoded audio (must be picklable for 'process' backend)
+        sources (list): audio sources (paths or arrays)
+        num_workers (int, optional): number of decoders, 0 decodes in the calling thread. Defaults to 2.
+        queue_depth (int, optional): max number of decoded/in-flight items ahead of the consumer. Defaults to 16.
+        backend (str, optional): 'thread' or 'process' pool. Defaults to 'thread'.
+    """
+    def __init__(self, load_fn, sources, num_workers=2, queue_depth=16, backend='thread'):
+        self.load_fn = load_fn
+        self.sources = list(sources)
+        self.num_workers = num_workers
+        self.queue_depth = max(queue_depth, 1)
+        self.backend = backend
+
+        # time the consumer waited for decoded audio (decode bound)
+        self.stall_time = 0.0
+        # time spent by the consumer between two items (model bound)
+        self.consume_time = 0.0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __iter__(self):
+        self.stall_time = 0.0
+        self.consume_time = 0.0
+
+        if self.num_workers <= 0:
+            for source in self.sources:
+                t0 = time.time()
+                audio = self.load_fn(source)
+                self.stall_time += time.time() - t0
+                t0 = time.time()
+                yield source, audio
+                self.consume_time += time.time() - t0
+            return
+
+        if self.backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        elif self.backend == 'thread':
+            executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        else:
+            raise ValueError(f"Invalid decode backend {self.backend}, available: thread, process")
+
+        pending = deque()
+        next_index = 0
+        try:
+            while next_index < len(self.sources) or pending:
+                # keep the queue filled
+                while next_index < len(self.sources) and len(pending) < self.queue_depth:
+                    source = self.sources[next_index]
+                    pending.append((source, executor.submit(self.load_fn, source)))
+                    next_index += 1
+
+                source, future = pending.popleft()
+                t0 = time.time()
+                audio = future.result()
+                self.stall_time += time.time() - t0
+
+                t0 = time.time()
+                yield source, audio
+                self.consume_time += time.time() - t0
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        """Stall report: a high stall ratio means decoding is the bottleneck, a low one the model"""
+        total = self.stall_time + self.consume_time
+        return {'stall_time': self.stall_time,
+                'consume_time': self.consume_time,
+                'stall_ratio': self.stall_time / total if total > 0 else 0.0}
@@ -0,0 +1,147 @@
+import fcntl
+import os
+import random
+from contextlib import contextmanager
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+from tqdm.auto import tqdm
+
+SHARD_INDEX = 'index.npz'
+SHARD_LIST = 'list.txt'
+
+
+def shard_name(shard):
+    return f"shard_{shard:05d}.pcm"
+
+
+@contextmanager
+def build_lock(path):
+    '''Exclusive lock (flock on <path>/build.lock) while shards are checked or packed in `path`:
+    processes that need the same shards (DataLoader workers, distributed ranks) build them once,
+    the others wait and find them complete'''
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'build.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def pack_shards(train_list, out_dir, shard_size=1024, sample_rate=8000, resample=False):
+    """Pack the recordings of a train list into a few large contiguous int16 shard files
+
+    The shards are the raw samples of the recordings one after the other (no header), the
+    index `index.npz` gives for each line of the list its speaker id, shard, offset and length
+    in samples, `list.txt` is the packed train list (same lines, same order).
+
+    Args:
+        train_list (str): train list, `speaker path` per line
+        out_dir (str): directory of the shards
+        shard_size (int, optional): max size of a shard in MB. Defaults to 1024.
+        sample_rate (int, optional): expected sample rate of the recordings. Defaults to 8000.
+        resample (bool, optional): resample the recordings to `sample_rate` instead of
+            asserting it. Defaults to False.
+
+    Returns:
+        int: number of shards written
+    """
+    with open(train_list) as f:
+        lines = [line.split() for line in f if line.strip()]
+    speakers = sorted(set(line[0] for line in lines))
+    speaker_ids = {speaker: ii for ii, speaker in enumerate(speakers)}
+
+    os.makedirs(out_dir, exist_ok=True)
+    max_samples = shard_size * 2 ** 20 // 2
+    speaker = np.zeros(len(lines), dtype=np.int32)
+    shard = np.zeros(len(lines), dtype=np.int32)
+    offset = np.zeros(len(lines), dtype=np.int64)
+    length = np.zeros(len(lines), dtype=np.int64)
+
+    n_shards, position = 0, 0
+    wf = open(os.path.join(out_dir, shard_name(0)), 'wb')
+    for ii, (speaker_name, path) in enumerate(tqdm(lines, desc="Packing shards")):
+        audio, sr = sf.read(path, dtype='int16', always_2d=True)
+        audio = audio[:, 0]
+        if sr != sample_rate:
+            assert resample, f"Sample rate is not same as desired value {sample_rate} and {sr}"
+            gcd = np.gcd(sr, sample_rate)
+            audio = resample_poly(audio.astype(np.float64), sample_rate // gcd, sr // gcd)
+            audio = np.clip(np.round(audio), -32768, 32767).astype(np.int16)
+        if position > 0 and position + audio.shape[0] > max_samples:
+            wf.close()
+            n_shards, position = n_shards + 1, 0
+            wf = open(os.path.join(out_dir, shard_name(n_shards)), 'wb')
+        wf.write(audio.tobytes())
+        speaker[ii], shard[ii], offset[ii], length[ii] = speaker_ids[speaker_name], n_shards, position, audio.shape[0]
+        position += audio.shape[0]
+    wf.close()
+
+    np.savez(os.path.join(out_dir, SHARD_INDEX), speakers=np.array(speakers), speaker=speaker,
+             shard=shard, offset=offset, length=length, sample_rate=sample_rate)
+    with open(os.path.join(out_dir, SHARD_LIST), 'w') as wf:
+        wf.writelines(f"{speaker_name} {path}\n" for speaker_name, path in lines)
+    return n_shards + 1
+
+
+class ShardReader(object):
+    """Random training crops sliced from memory-mapped shards (see pack_shards)
+
+    A shard is mapped on its first read in each process, so DataLoader workers read the
+    same pages of the OS page cache instead of opening and decoding one file per crop.
+
+    Args:
+        shard_dir (str): directory written by pack_shards
+        sample_rate (int, optional): expected sample rate of the shards. Defaults to 8000.
+    """
+    def __init__(self, shard_dir, sample_rate=8000):
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, SHARD_INDEX))
+        assert int(index['sample_rate']) == sample_rate, \
+            f"Sample rate is not same as desired value {sample_rate} and {int(index['sample_rate'])}"
+        self.speakers = index['speakers']
+        self.speaker = index['speaker']
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.length = index['length']
+        self.sr = sample_rate
+        self.maps = {}
+
+    def __getstate__(self):
+        # maps are not sent to the workers, each one maps the shards it reads
+        state = dict(self.__dict__)
+        state['maps'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.length)
+
+    def lookup(self, paths):
+        '''Entries of the index of the given paths (KeyError for a path not packed)'''
+        with open(os.path.join(self.shard_dir, SHARD_LIST)) as f:
+            entries = {line.split()[1]: ii for ii, line in enumerate(f) if line.strip()}
+        return np.array([entries[path] for path in paths], dtype=np.int64)
+
+    def audio(self, entry):
+        '''int16 samples of a recording, a view of the shard'''
+        shard = int(self.shard[entry])
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(os.path.join(self.shard_dir, shard_name(shard)), dtype=np.int16, mode='r')
+        offset = int(self.offset[entry])
+        return self.maps[shard][offset:offset + int(self.length[entry])]
+
+    def crop(self, entry, max_frames, n_samples=None):
+        '''One random crop of a recording, as loadWAV(evalmode=False) without augmentation (n_samples: crop length instead of max_frames)'''
+        hoplength = 10e-3 * self.sr
+        winlength = 25e-3 * self.sr
+        max_audio = n_samples or int(max_frames * hoplength + (winlength - hoplength))
+        audio = self.audio(entry)
+        audiosize = audio.shape[0]
+        if audiosize <= max_audio:
+            audio = np.pad(audio, (0, max_audio - audiosize + 1), 'wrap')
+            audiosize = audio.shape[0]
+        # same draw and scale as loadWAV
+        startframe = int(np.int64(random.random() * (audiosize - max_audio)))
+        return audio[None, startframe:startframe + max_audio] / 32768.0
@@ -0,0 +1,201 @@
+import copy
+import os
+import random
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+from tqdm.auto import tqdm
+
+from graph_fusion import fuse_conv_bn, fuse_pairs, get_module, set_module
+from processing.audio_loader import loadWAV
+from eval_metrics import eer, error_rates, min_dcf
+from utils import cprint
+
+# key of the quantization config in a quantized checkpoint, read by SpeakerNet.loadParameters
+QUANTIZATION_KEY = '__quantization__'
+
+
+class QuantizedBlock(nn.Sequential):
+
+    ## Quantize the input, run the int8 module and dequantize, the rest of the model stays in fp32
+
+    def __init__(self, module):
+        super(QuantizedBlock, self).__init__(QuantStub(), module, DeQuantStub())
+
+
+def static_conv_names(model, skip=('compute_features',)):
+    '''Conv1d layers that can run in int8: zero padding, not in the feature front-end'''
+    names = []
+    for name, module in model.named_modules():
+        if any(part in skip for part in name.split('.')):
+            continue
+        if isinstance(module, nn.Conv1d) and module.padding_mode == 'zeros':
+            names.append(name)
+    return names
+
+
+def build_quantized_structure(model, config):
+    """Turn the fp32 modules of `model` into their quantized counterparts, in place
+
+    Args:
+        model (nn.Module): fp32 model in eval mode
+        config (dict): fused pairs, static conv names, engine and dynamic flag, see quantize_model
+
+    Returns:
+        nn.Module: prepared model, observers of the static convs are waiting for calibration
+    """
+    torch.backends.quantized.engine = config['engine']
+    fuse_pairs(model, config['fused'])
+    qconfig = get_default_qconfig(config['engine'])
+    for name in config['static']:
+        block = QuantizedBlock(get_module(model, name))
+        block.qconfig = qconfig
+        set_module(model, name, block)
+    return prepare(model, inplace=True)
+
+
+def convert_quantized_structure(model, config):
+    '''Quantize the calibrated static blocks and the Linear layers (dynamic), in place'''
+    convert(model, inplace=True)
+    if config['dynamic']:
+        quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def quantize_model(model, calibration_files, eval_frames=100, num_eval=10, engine=None,
+                   static=True, dynamic=True, skip=('compute_features',), **kwargs):
+    """Post-training int8 quantization of a SpeakerNet for CPU inference
+
+    The BatchNorm layers following a conv are folded into it, the Conv1d layers are
+    quantized statically (activation ranges calibrated on `calibration_files`) and the
+    Linear layers dynamically (weights int8, activations quantized on the fly).
+
+    Args:
+        model (SpeakerNet): fp32 model on cpu, left untouched
+        calibration_files (list): audio files for the calibration of the static convs
+        eval_frames (int, optional): crop length of the calibration. Defaults to 100.
+        num_eval (int, optional): crops per calibration file. Defaults to 10.
+        engine (str, optional): quantized backend, x86 / fbgemm / qnnpack, None for the default one.
+        static (bool, optional): quantize the Conv1d layers. Defaults to True.
+        dynamic (bool, optional): quantize the Linear layers. Defaults to True.
+        skip (tuple, optional): names of submodules kept in fp32. Defaults to ('compute_features',).
+
+    Returns:
+        (SpeakerNet, dict): quantized copy of the model, quantization config
+    """
+    if model.device != torch.device('cpu'):
+        raise ValueError("Quantized models run on cpu, create the model with device='cpu'")
+    engine = engine or torch.backends.quantized.engine
+    if engine == 'none':
+        engine = torch.backends.quantized.supported_engines[-1]
+
+    qmodel = copy.deepcopy(model)
+    qmodel.inference_backend = None
+    qmodel.shared_crop_embedder = None
+    qmodel.embedding_caches = {}
+    qmodel.checkpoint_path = None
+    qmodel.checkpoint_fingerprint = None
+    qmodel.eval()
+
+    example = torch.FloatTensor(loadWAV(calibration_files[0], eval_frames, evalmode=True, num_eval=2, **kwargs))
+    fused = fuse_conv_bn(qmodel.__S__, qmodel.compute_features(example) if qmodel.compute_features is not None else example)
+    config = {'engine': engine,
+              'fused': [list(pair) for pair in fused],
+              'static': static_conv_names(qmodel.__S__, skip=skip) if static else [],
+              'dynamic': dynamic}
+    # pairs are already fused in qmodel
+    build_quantized_structure(qmodel.__S__, dict(config, fused=[]))
+
+    if config['static']:
+        for path in tqdm(calibration_files, desc=">>>>Calibration: ", unit="files"):
+            audio = loadWAV(path, eval_frames, evalmode=True, num_eval=num_eval, **kwargs)
+            qmodel.forward_crops(torch.FloatTensor(audio))
+    convert_quantized_structure(qmodel.__S__, config)
+    n_linear = sum(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in qmodel.__S__.modules())
+    print(f"Quantized {len(config['static'])} Conv1d (static) and {n_linear} Linear (dynamic) layers")
+    return qmodel, config
+
+
+def save_quantized(model, config, path):
+    '''Checkpoint loadable by SpeakerNet.loadParameters'''
+    state = model.state_dict()
+    state[QUANTIZATION_KEY] = config
+    torch.save(state, path)
+
+
+def sample_calibration_files(train_list, n_files=200, seed=0):
+    '''Random sample of the audio files of a train list (speaker path per line)'''
+    with open(train_list) as listfile:
+        files = [line.split()[1] for line in listfile if len(line.split()) >= 2]
+    random.Random(seed).shuffle(files)
+    return files[:n_files]
+
+
+def measure_latency(model, n_crops=10, n_samples=8120, n_runs=20):
+    '''Mean time (ms) of forward_crops on a (n_crops, n_samples) batch'''
+    inp = torch.randn(n_crops, n_samples) * 0.1
+    model.forward_crops(inp)
+    t0 = time.perf_counter()
+    for _ in range(n_runs):
+        model.forward_crops(inp)
+    return (time.perf_counter() - t0) / n_runs * 1000
+
+
+def evaluation_crops(model, eval_frames=100):
+    '''(num_eval, n_samples) of the crops evaluateFromList extracts per file: the max_frames, num_eval and
+    sample_rate of the model settings (eval_frames for whole files, max_frames 0)'''
+    max_frames = model.kwargs.get('max_frames', 0) or eval_frames
+    sample_rate = model.kwargs.get('sample_rate', 8000)
+    return model.kwargs.get('num_eval', 10), int(max_frames * 10e-3 * sample_rate + 15e-3 * sample_rate)
+
+
+def evaluate_errors(model, eval_list, p_target=0.05, c_miss=1, c_fa=1, **kwargs):
+    '''EER (%) and minDCF of the model on an eval list (label ref com per line), crops of evaluation_crops'''
+    sc, lab, _ = model.evaluateFromList(eval_list, cohorts_path=None, **kwargs)
+    curve = error_rates(sc, lab)
+    return eer(*curve)[0], min_dcf(*curve, p_target, c_miss, c_fa)[0]
+
+
+def quantize_checkpoint(args):
+    """Quantize the chosen checkpoint, report latency and EER/minDCF against fp32 and save
+    the int8 checkpoint only if the EER does not regress by more than `quantize_eer_tolerance`"""
+    from model import SpeakerNet
+
+    model_save_path = os.path.join(args.save_path, f"{args.model}/{args.criterion}/model")
+    chosen_model_state = args.initial_model_infer or os.path.join(model_save_path, 'best_state.pt')
+    output_path = args.quantize_output or chosen_model_state.replace('.pt', '_int8.pt')
+
+    model = SpeakerNet(**dict(vars(args), device='cpu'))
+    model.loadParameters(chosen_model_state)
+    model.eval()
+
+    calibration_files = sample_calibration_files(args.train_list, n_files=args.quantize_calibration_files)
+    load_kwargs = {'sample_rate': args.sample_rate} if hasattr(args, 'sample_rate') else {}
+    qmodel, config = quantize_model(model, calibration_files, eval_frames=args.eval_frames,
+                                    num_eval=args.num_eval, **load_kwargs)
+
+    eval_kwargs = dict(scoring_mode='cosine', p_target=args.dcf_p_target, c_miss=args.dcf_c_miss, c_fa=args.dcf_c_fa)
+    # latency on the crops the EER run extracts
+    n_crops, n_samples = evaluation_crops(model, args.eval_frames)
+    print(f"Evaluation crops: {n_crops} x {n_samples} samples")
+    report = {}
+    for name, m in (('fp32', model), ('int8', qmodel)):
+        latency = measure_latency(m, n_crops=n_crops, n_samples=n_samples)
+        eer, mindcf = evaluate_errors(m, args.eval_list, **eval_kwargs)
+        report[name] = (latency, eer, mindcf)
+
+    print(f"\n{'':<6}{'latency (ms)':>14}{'EER (%)':>10}{'minDCF':>10}")
+    for name, (latency, eer, mindcf) in report.items():
+        print(f"{name:<6}{latency:>14.1f}{eer:>10.3f}{mindcf:>10.4f}")
+    speedup = report['fp32'][0] / report['int8'][0]
+    eer_delta = report['int8'][1] - report['fp32'][1]
+    print(f"Speedup x{speedup:.2f}, EER delta {eer_delta:+.3f}, minDCF delta {report['int8'][2] - report['fp32'][2]:+.4f}")
+
+    if eer_delta > args.quantize_eer_tolerance:
+        cprint(f"EER regressed by {eer_delta:.3f} > {args.quantize_eer_tolerance}, quantized model not saved", 'r')
+        return None
+    save_quantized(qmodel, config, output_path)
+    cprint(f"Saved quantized model to {output_path}", 'g')
+    return output_path
@@ -0,0 +1,163 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class EmbeddingMatrix(object):
+    """All embeddings of an evaluation in one contiguous tensor with a file -> row index
+
+    Args:
+        feats (dict): file -> embedding of shape (num_eval, nOut), all of the same shape
+        normalize (bool, optional): L2-normalize every crop embedding. Defaults to False.
+        device (str, optional): device to keep the matrix on. Defaults to 'cpu'.
+    """
+    def __init__(self, feats, normalize=False, device='cpu'):
+        self.files = list(feats.keys())
+        self.index = {filename: row for row, filename in enumerate(self.files)}
+
+        self.embeds = torch.stack([torch.as_tensor(feats[filename]) for filename in self.files], dim=0).to(device)
+        if normalize:
+            self.embeds = F.normalize(self.embeds, p=2, dim=-1)
+
+        # cached crop-averaged embeddings and cohort statistics, (id(cohorts), top) -> (mean, std) of every row
+        self._mean_embeds = None
+        self._cohort_stats = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def rows(self, files):
+        return torch.LongTensor([self.index[filename] for filename in files]).to(self.embeds.device)
+
+    def mean_embeds(self):
+        if self._mean_embeds is None:
+            self._mean_embeds = self.embeds.mean(dim=1)
+        return self._mean_embeds
+
+    def cohort_stats(self, cohorts, top=200):
+        '''Top-`top` cohort score mean/std of every row, computed once per cohort set'''
+        key = (id(cohorts), top)
+        if key not in self._cohort_stats:
+            mean, std = cohort_statistics(self.mean_embeds().cpu().numpy(), cohorts, top=top)
+            self._cohort_stats[key] = (torch.from_numpy(mean).to(self.embeds.device),
+                                       torch.from_numpy(std).to(self.embeds.device))
+        return self._cohort_stats[key]
+
+
+def cohort_statistics(mean_embeds, cohorts, top=200, max_elements=2 ** 24):
+    """Mean/std of the `top` highest cohort scores of each embedding, as in utils.ZT_norm_similarity
+
+    The cohort score of an utterance is the mean over its crops of the inner product with
+    a cohort, i.e. the inner product with the crop-averaged embedding. The top scores are
+    selected with np.argpartition instead of a full sort, `max_elements` bounds the size
+    of the (embeddings, cohorts) score block.
+
+    Args:
+        mean_embeds (np.ndarray): crop-averaged embeddings (n_files, nOut)
+        cohorts (np.ndarray): cohort embeddings (n_cohorts, nOut)
+        top (int, optional): number of top cohort scores, same slicing as [:top]. Defaults to 200.
+
+    Returns:
+        tuple: mean and std of shape (n_files,)
+    """
+    cohorts = np.asarray(cohorts, dtype=mean_embeds.dtype)
+    n_top = len(range(cohorts.shape[0])[:top])
+    chunk_size = max(1, max_elements // cohorts.shape[0])
+
+    means = []
+    stds = []
+    for start in range(0, mean_embeds.shape[0], chunk_size):
+        S = np.inner(mean_embeds[start:start + chunk_size], cohorts)
+        if n_top < S.shape[1]:
+            idx = np.argpartition(-S, n_top - 1, axis=1)[:, :n_top]
+            S = np.take_along_axis(S, idx, axis=1)
+        means.append(np.mean(S, axis=1))
+        stds.append(np.std(S, axis=1))
+
+    return np.concatenate(means), np.concatenate(stds)
+
+
+def _cosine_scores(ref, com):
+    # same as utils.cosine_similarity for every trial of the chunk
+    return torch.mean(torch.abs(F.cosine_similarity(ref, com, dim=-1, eps=1e-05)), dim=1)
+
+
+def _pnorm_scores(ref, com, p=2):
+    # same as utils.pnorm_similarity for every trial of the chunk
+    return torch.mean(F.pairwise_distance(ref, com, p=p, eps=1e-06), dim=1)
+
+
+def _distance_scores(ref, com):
+    # cohort-free scoring of evaluateFromList: distance between every crop of ref and all crops of com
+    dist = F.pairwise_distance(ref.unsqueeze(-1), com.unsqueeze(-1).transpose(1, 3))
+    return -1 * torch.mean(dist, dim=(1, 2))
+
+
+def _snorm_scores(ref, com, ref_stats, com_stats):
+    # adaptive symmetric normalization of the score between crop-averaged embeddings (same as utils.ZT_norm_similarity)
+    score = torch.sum(ref * com, dim=-1)
+    return ((score - ref_stats[0]) / ref_stats[1] + (score - com_stats[0]) / com_stats[1]) / 2
+
+
+SCORING_FUNCTIONS = {
+    'cosine': _cosine_scores,
+    'pnorm': _pnorm_scores,
+    'distance': _distance_scores,
+    'norm': _snorm_scores
+}
+
+
+def score_trials(matrix, ref_files, com_files, scoring_mode='cosine', chunk_size=None, max_elements=2 ** 24,
+                 cohorts=None, top=200):
+    """Score all trials with batched gathers, `chunk_size` trials at a time
+
+    Args:
+        matrix (EmbeddingMatrix): embeddings of all files of the trials
+        ref_files (list): first file of each trial
+        com_files (list): second file of each trial
+        scoring_mode (str, optional): cosine, pnorm, norm (S-norm with cohorts) or distance (no cohorts). Defaults to 'cosine'.
+        chunk_size (int, optional): trials per chunk, by default derived from `max_elements`
+        max_elements (int, optional): bound of the intermediate tensor size of a chunk. Defaults to 2**24.
+        cohorts (np.ndarray, optional): cohort embeddings, required for 'norm'. Defaults to None.
+        top (int, optional): number of top cohort scores for 'norm'. Defaults to 200.
+
+    Returns:
+        np.ndarray: score of each trial
+    """
+    if scoring_mode not in SCORING_FUNCTIONS:
+        raise ValueError(f"Invalid scoring mode {scoring_mode}, available: {list(SCORING_FUNCTIONS.keys())}")
+    score_fn = SCORING_FUNCTIONS[scoring_mode]
+
+    if scoring_mode == 'norm':
+        if cohorts is None:
+            raise ValueError("Cohorts are required for 'norm' scoring")
+        # only crop-averaged embeddings and their cached cohort statistics are needed
+        embeds = matrix.mean_embeds()
+        mean, std = matrix.cohort_stats(cohorts, top=top)
+    else:
+        embeds = matrix.embeds
+
+    if chunk_size is None:
+        trial_elements = int(np.prod(embeds.shape[1:])) * (embeds.shape[1] if scoring_mode == 'distance' else 1)
+        chunk_size = max(1, max_elements // trial_elements)
+
+    ref_rows = matrix.rows(ref_files)
+    com_rows = matrix.rows(com_files)
+
+    scores = []
+    with torch.no_grad():
+        for start in range(0, len(ref_rows), chunk_size):
+            ref_chunk = ref_rows[start:start + chunk_size]
+            com_chunk = com_rows[start:start + chunk_size]
+            ref = embeds.index_select(0, ref_chunk)
+            com = embeds.index_select(0, com_chunk)
+            if scoring_mode == 'norm':
+                scores.append(score_fn(ref, com,
+                                       (mean[ref_chunk], std[ref_chunk]),
+                                       (mean[com_chunk], std[com_chunk])).cpu())
+            else:
+                scores.append(score_fn(ref, com).cpu())
+
+    if not scores:
+        return np.zeros(0, dtype=np.float32)
+    return torch.cat(scores).numpy()
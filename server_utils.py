@@ -1,15 +1,25 @@
 import base64
+import hashlib
+import io
+import json
 import os
+import struct
+import threading
 import time
 from argparse import Namespace
+from collections import OrderedDict
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+import soundfile as sf
 from pydub import AudioSegment
 
+from micro_batcher import MicroBatcher
 from model import SpeakerNet
-from utils import similarity_measure
+from processing.audio_loader import loadWAV
 from processing.wav_conversion import (normalize_audio_amp, np_to_segment, segment_to_np)
 from processing.augment import gain_target_amplitude
 
@@ -46,6 +56,218 @@ def decode_audio(audio_data, sr, dtype_np=np.int16):
     audio_data_np = np.frombuffer(audio_data_b64, dtype=dtype_np) #b 64 to np
     return audio_data_np
 
+class AudioDecodeError(ValueError):
+    '''Invalid audio in a binary request'''
+    pass
+
+
+WAV_DTYPES = {(1, 16): '<i2', (1, 32): '<i4', (3, 32): '<f4', (3, 64): '<f8'}
+
+
+def to_float32(samples):
+    '''Samples in [-1, 1] as float32, in one pass for integer PCM and without copy for float32'''
+    if np.issubdtype(samples.dtype, np.integer):
+        intinfo = np.iinfo(samples.dtype)
+        return np.multiply(samples, 1 / max(intinfo.max, -intinfo.min), dtype=np.float32)
+    return samples.astype(np.float32, copy=False)
+
+
+def parse_wav(buf):
+    """Sample rate and samples of a WAV file held in memory
+
+    The samples are a numpy view on `buf` for PCM 16/32 bit and float WAV (no copy),
+    other formats go through soundfile.
+
+    Returns:
+        tuple: sample rate, samples (n_samples,) of the first channel
+    """
+    view = memoryview(buf)
+    if len(view) < 12 or bytes(view[:4]) != b'RIFF' or bytes(view[8:12]) != b'WAVE':
+        raise AudioDecodeError("Not a RIFF/WAVE file")
+
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(view):
+        chunk_id = bytes(view[pos:pos + 4])
+        size = int.from_bytes(view[pos + 4:pos + 8], 'little')
+        body = pos + 8
+        if chunk_id == b'fmt ':
+            audio_format, channels, sample_rate = struct.unpack_from('<HHI', view, body)
+            bits = struct.unpack_from('<H', view, body + 14)[0]
+            if audio_format == 0xFFFE and size >= 26:
+                # WAVE_FORMAT_EXTENSIBLE, the format is the start of the sub format GUID
+                audio_format = struct.unpack_from('<H', view, body + 24)[0]
+            fmt = (audio_format, channels, sample_rate, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                break
+            audio_format, channels, sample_rate, bits = fmt
+            if (audio_format, bits) not in WAV_DTYPES:
+                break
+            dtype = np.dtype(WAV_DTYPES[(audio_format, bits)])
+            # streaming writers leave the data size at 0 or 0xFFFFFFFF
+            size = len(view) - body if size in (0, 0xFFFFFFFF) else min(size, len(view) - body)
+            size -= size % (dtype.itemsize * channels)
+            samples = np.frombuffer(view, dtype=dtype, count=size // dtype.itemsize, offset=body)
+            if channels > 1:
+                samples = samples[::channels]
+            return sample_rate, samples
+        pos = body + size + (size & 1)
+
+    try:
+        samples, sample_rate = sf.read(io.BytesIO(bytes(buf)), dtype='float32', always_2d=True)
+    except Exception as e:
+        raise AudioDecodeError(f"Unsupported WAV file: {e}")
+    return sample_rate, samples[:, 0]
+
+
+def decode_audio_bytes(buf, sr, content_type=None):
+    """Audio of a binary request body or multipart part as float32 in [-1, 1]
+
+    WAV bodies are detected by their RIFF header, anything else is raw little-endian
+    PCM int16 (audio/L16, application/octet-stream) or float32 (audio/x-float32).
+
+    Args:
+        buf (bytes): body
+        sr (int): expected sample rate
+        content_type (str, optional): content type of the body. Defaults to None.
+
+    Returns:
+        np.ndarray: float32 samples
+    """
+    if len(buf) >= 12 and buf[:4] == b'RIFF':
+        sample_rate, samples = parse_wav(buf)
+        if sample_rate != sr:
+            raise AudioDecodeError(f"Sample rate {sample_rate} does not match the service {sr}")
+    elif content_type and 'float32' in content_type:
+        samples = np.frombuffer(buf, dtype='<f4', count=len(buf) // 4)
+    else:
+        samples = np.frombuffer(buf, dtype='<i2', count=len(buf) // 2)
+    if samples.size == 0:
+        raise AudioDecodeError("Empty audio")
+    return to_float32(samples)
+
+
+def forward_crops_batch(model, crops_list):
+    """Process function of the embedding batcher: one forward for the crops of many utterances
+
+    Args:
+        model (SpeakerNet): model
+        crops_list (list): evaluation crops (num_eval, n_samples) of each utterance
+
+    Returns:
+        list: embedding (num_eval, nOut) of each utterance, not normalized
+    """
+    embeds = [None] * len(crops_list)
+    # crops of different length (whole utterances) can not be stacked together
+    groups = {}
+    for i, crops in enumerate(crops_list):
+        groups.setdefault(crops.shape[1:], []).append(i)
+    for indexes in groups.values():
+        batch = model.forward_crops(torch.FloatTensor(np.concatenate([crops_list[i] for i in indexes], axis=0)))
+        for i, embed in zip(indexes, torch.split(batch, [crops_list[i].shape[0] for i in indexes], dim=0)):
+            embeds[i] = embed
+    return embeds
+
+
+def create_embedding_batcher(model, max_batch_size=32, max_wait_ms=5, max_queue_size=256):
+    '''Shared batcher of the server, utterances of concurrent requests are embedded together'''
+    return MicroBatcher(partial(forward_crops_batch, model),
+                        max_batch_size=max_batch_size,
+                        max_wait_ms=max_wait_ms,
+                        max_queue_size=max_queue_size)
+
+
+def embed_utterances(model, sources, eval_frames=100, num_eval=20, normalize=True, sr=8000, batcher=None, timeout=None):
+    """Embeddings of audio arrays, the crops of all utterances in one forward (or through the shared batcher)
+
+    Returns:
+        torch.Tensor: embeddings (n_sources, num_eval, nOut)
+    """
+    crops_list = [np.atleast_2d(loadWAV(audio_data_np, eval_frames, evalmode=True, num_eval=num_eval, sr=sr))
+                  for audio_data_np in sources]
+    if batcher is not None:
+        embeds = batcher.map(crops_list, timeout=timeout)
+    else:
+        embeds = forward_crops_batch(model, crops_list)
+    embeds = torch.stack(embeds, dim=0)
+    return F.normalize(embeds, p=2, dim=-1) if normalize else embeds
+
+
+def audio_digest(sources, **params):
+    '''Hash of audio arrays and extraction parameters'''
+    sha = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for audio_data_np in sources:
+        audio_data_np = np.ascontiguousarray(audio_data_np)
+        sha.update(str((audio_data_np.dtype, audio_data_np.shape)).encode('utf-8'))
+        sha.update(audio_data_np.tobytes())
+    return sha.hexdigest()
+
+
+class RefEmbeddingCache(object):
+    """Least-recently-used cache of the reference embeddings of callers
+
+    Keys are (caller, digest of the reference audio and extraction parameters), a caller
+    sending new reference audio gets a new entry. Shared by the request threads.
+
+    Args:
+        max_entries (int, optional): number of cached references. Defaults to 1024.
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, embeds):
+        with self.lock:
+            self.entries[key] = embeds
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def embed_request(model, ref_source, com_source, eval_frames=100, num_eval=20, sr=8000,
+                  batcher=None, timeout=None, ref_cache=None, ref_key=None):
+    """Embed every ref and com utterance of a verification request once, in one batch
+
+    The ref embeddings are looked up in `ref_cache` under the caller `ref_key` (phone / callId)
+    and the digest of the ref audio, only the com utterances are embedded on a hit.
+
+    Returns:
+        tuple: not normalized ref (n_ref, num_eval, nOut) and com (n_com, num_eval, nOut) embeddings
+    """
+    key = None
+    ref_embeds = None
+    if ref_cache is not None and ref_key:
+        key = (ref_key, audio_digest(ref_source, eval_frames=eval_frames, num_eval=num_eval, sr=sr))
+        ref_embeds = ref_cache.get(key)
+
+    sources = list(com_source) if ref_embeds is not None else list(ref_source) + list(com_source)
+    embeds = embed_utterances(model, sources, eval_frames=eval_frames, num_eval=num_eval,
+                              normalize=False, sr=sr, batcher=batcher, timeout=timeout)
+    if ref_embeds is not None:
+        return ref_embeds, embeds
+
+    ref_embeds, com_embeds = embeds[:len(ref_source)], embeds[len(ref_source):]
+    if key is not None:
+        ref_cache.put(key, ref_embeds)
+    return ref_embeds, com_embeds
+
+
 def preprocess_audio(audio_data_np, target_volume=-10):
     # np to segment -> norm volume -> convert sang np -> norm biên độ
     audio_data_seg = np_to_segment(audio_data_np)
@@ -54,86 +276,85 @@ def preprocess_audio(audio_data_np, target_volume=-10):
     audio_out = normalize_audio_amp(audio_data_np_new)
     return audio_out
 
+def normalize_scores(scores, threshold, base_threshold=0.5, mode='linear'):
+    '''normalize_score of every element of an array'''
+    scores = np.asarray(scores)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if mode == 'magic':
+            ratio = threshold / base_threshold
+            sign = -1 if ratio <= 1 else 1
+            scores_norm = np.where(scores > threshold, scores * (ratio ** sign), scores / (ratio ** sign))
+        elif mode == 'linear':
+            ratio = threshold / base_threshold
+            scores_norm = scores / ratio
+        elif mode == 'uniform':
+            scores_norm = np.where(scores > threshold,
+                                   base_threshold * (1 + (scores - threshold) / (1 - threshold)),
+                                   base_threshold * (1 + (threshold - scores) / (0 - threshold)))
+        else:
+            scores_norm = scores
+    return np.minimum(scores_norm, 1) # limit score
+
+
+def crop_cosine_matrix(ref_embeds, com_embeds):
+    """utils.cosine_similarity of every (ref, com) pair: mean over crops of |cos| between aligned crops
+
+    Args:
+        ref_embeds (torch.Tensor): (n_ref, num_eval, nOut)
+        com_embeds (torch.Tensor): (n_com, num_eval, nOut)
+
+    Returns:
+        np.ndarray: scores (n_ref, n_com)
+    """
+    ref = F.normalize(ref_embeds, p=2, dim=-1, eps=1e-05)
+    com = F.normalize(com_embeds, p=2, dim=-1, eps=1e-05)
+    return torch.einsum('rkd,ckd->rck', ref, com).abs().mean(dim=-1).cpu().numpy()
+
+
+def score_by_pair(ref_embeds, com_embeds, threshold=0.5, base_threshold=0.5, norm_mode='magic'):
+    '''
+    score of every (ref, com) pair
+    '''
+    scores = crop_cosine_matrix(ref_embeds, com_embeds)
+    norm_scores = normalize_scores(scores, threshold=threshold, base_threshold=base_threshold, mode=norm_mode)
+    return norm_scores.squeeze(), scores.squeeze()
+
+
+def score_by_mean_ref(ref_embeds, com_embeds, threshold=0.5, base_threshold=0.5, norm_mode='magic', test_normalize=True):
+    """
+    score of every com against the mean of the refs, same as model.prepare(source=ref_source, prepare_type='embed')
+    """
+    if test_normalize:
+        ref_embeds = F.normalize(ref_embeds, p=2, dim=-1)
+    ref_emb = torch.mean(ref_embeds, dim=0, keepdim=True)
+    scores = crop_cosine_matrix(ref_emb, com_embeds)[0]
+    norm_scores = normalize_scores(scores, threshold=threshold, base_threshold=base_threshold, mode=norm_mode)
+    return norm_scores.squeeze(), scores.squeeze()
+
+
 def compute_score_by_mean_ref(model, ref_source, com_source, 
                               threshold=0.5, base_threshold=0.5,
                               eval_frames=100, num_eval=20,normalize=True, sr=8000, 
-                              norm_mode='magic',**kwargs):
+                              norm_mode='magic', batcher=None, timeout=None, **kwargs):
     """
     Predict new utterance based on distance between samples of com and ref.
-    """   
-    mean_scores = []
-    ref_emb = model.prepare(source=ref_source, save_path=None, prepare_type='embed', num_eval=num_eval, eval_frames=eval_frames).detach().cpu().numpy()
-    
-    for data_np_com in com_source:
-        com_emb = model.embed_utterance(data_np_com, num_eval=num_eval, eval_frames=eval_frames, normalize=normalize).detach().cpu().numpy()
-        
-        # dist = F.pairwise_distance(com_emb, ref_emb).detach().cpu().numpy()
-        # mean_dist = np.mean(dist, axis=0)
-        # mean_score = 1 - np.min(dist) ** 2 / 2
-
-        # indexes = np.argsort(dist)[:top]
-        # for idx in indexes:
-        #     score = 1 - dist[idx] ** 2 / 2
-        #     top_scores.append(score)
-        mean_scores.append(similarity_measure('cosine', torch.from_numpy(ref_emb), torch.from_numpy(com_emb)))
-    
-    norm_mean_scores = [normalize_score(mean_score, threshold=threshold, base_threshold=base_threshold, mode=norm_mode) for mean_score in mean_scores]    
-    
-    return np.asanyarray(norm_mean_scores).squeeze(), np.asanyarray(mean_scores).squeeze()
+    """
+    ref_embeds, com_embeds = embed_request(model, ref_source, com_source, eval_frames=eval_frames,
+                                           num_eval=num_eval, sr=sr, batcher=batcher, timeout=timeout)
+    return score_by_mean_ref(ref_embeds, com_embeds, threshold=threshold, base_threshold=base_threshold,
+                             norm_mode=norm_mode, test_normalize=model.__L__.test_normalize)
 
-def score_of_pair(ref_emb, com_emb, threshold=0.5, base_threshold=0.5, norm_mode='magic'):
-    score = similarity_measure('cosine', torch.from_numpy(ref_emb), torch.from_numpy(com_emb))
-    score_norm = normalize_score(score, 
-                                 threshold=threshold, 
-                                 base_threshold=base_threshold,
-                                 mode=norm_mode)
-    return score_norm, score
 
 def compute_score_by_pair(model, com_source, ref_source, 
                           threshold=0.5, base_threshold=0.5,
                           eval_frames=100, num_eval=20,normalize=True, sr=8000, 
-                          norm_mode='magic', **kwargs):
+                          norm_mode='magic', batcher=None, timeout=None, **kwargs):
     '''
     return max score of all pair test
     '''
-    # print("Getting embedings...")
-    embedding_ref = []
-    for audio_data_np in ref_source:
-        # get embedding
-        # t0 = time.time()
-        emb = np.asarray(model.embed_utterance(audio_data_np, 
-                                               eval_frames=eval_frames, 
-                                               num_eval=num_eval, 
-                                               normalize=normalize, sr=sr))
-        # print("Embedding time:", time.time() - t0)
-        embedding_ref.append(emb)
-
-    embedding_com = []
-    for audio_data_np in com_source:
-        # get embedding
-        # t0 = time.time()
-        emb = np.asarray(model.embed_utterance(audio_data_np, 
-                                               eval_frames=eval_frames, 
-                                               num_eval=num_eval, 
-                                               normalize=normalize, sr=sr))
-        # print("Embedding time:", time.time() - t0)
-        embedding_com.append(emb)
-
-    # compare embeding
-    confidence_scores = []
-    nom_confidence_scores = []
-    for i, ref_emb in enumerate(embedding_ref):
-        confidence_scores.append([])
-        nom_confidence_scores.append([])
-        for j, com_emb in enumerate(embedding_com):
-            norm_confidence_score, confidence_score = score_of_pair(ref_emb, com_emb, 
-                                                                    threshold, 
-                                                                    base_threshold=base_threshold,
-                                                                    norm_mode=norm_mode)
-            confidence_scores[i].append(confidence_score)
-            nom_confidence_scores[i].append(norm_confidence_score)
-    
-    return np.asanyarray(nom_confidence_scores).squeeze(), np.asanyarray(confidence_scores).squeeze()
+    ref_embeds, com_embeds = embed_request(model, ref_source, com_source, eval_frames=eval_frames,
+                                           num_eval=num_eval, sr=sr, batcher=batcher, timeout=timeout)
+    return score_by_pair(ref_embeds, com_embeds, threshold=threshold, base_threshold=base_threshold, norm_mode=norm_mode)
 
 
 if __name__ == '__main__':
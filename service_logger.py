@@ -0,0 +1,151 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+import soundfile as sf
+
+
+class AsyncServiceLogger(object):
+    """Write the audio and results logs of the service in a background thread
+
+    Request handlers only queue records, a writer thread takes up to `batch_size` records
+    at a time and writes them under `root/<YYYYMMDD>/` of the day the record was queued,
+    so the logs rotate daily. Text appended to the same file in one batch is written at once.
+
+    Args:
+        root (str): log folder
+        max_queue_size (int, optional): max number of records waiting. Defaults to 1024.
+        policy (str, optional): when the queue is full, 'drop' the record or 'block' the caller
+            (up to `block_timeout` seconds, then drop). Defaults to 'drop'.
+        block_timeout (float, optional): max wait of the 'block' policy, None waits forever. Defaults to None.
+        batch_size (int, optional): max number of records written per batch. Defaults to 64.
+    """
+    def __init__(self, root, max_queue_size=1024, policy='drop', block_timeout=None, batch_size=64):
+        if policy not in ('drop', 'block'):
+            raise ValueError(f"Invalid queue policy {policy}, available: drop, block")
+        self.root = root
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_errors = 0
+        # folders already created / ref call ids already saved, per folder
+        self._dirs = set()
+        self._ref_calls = {}
+
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='AsyncServiceLogger', daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    # ------------------------------------------------------------------ request side
+    def _put(self, record):
+        if self._closed:
+            return False
+        record = (time.strftime('%Y%m%d', time.gmtime()),) + record
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+
+    def log_audio(self, folder, filename, audio, sr, alt_filename=None):
+        '''Save audio to <day>/<folder>/<filename>, to `alt_filename` if the file exists'''
+        return self._put(('audio', folder, filename, audio, sr, alt_filename))
+
+    def log_ref_audio(self, folder, call_id, audios, sr):
+        '''Save the ref audios of a call as <call_id>_ref_<i>.wav, unless the call already saved its refs'''
+        return self._put(('ref_audio', folder, call_id, audios, sr))
+
+    def log_text(self, folder, filename, text):
+        '''Append text to <day>/<folder>/<filename>'''
+        return self._put(('text', folder, filename, text))
+
+    # ------------------------------------------------------------------ writer side
+    def _folder(self, day, folder):
+        path = os.path.join(self.root, day, folder)
+        if path not in self._dirs:
+            os.makedirs(path, exist_ok=True)
+            self._dirs.add(path)
+        return path
+
+    def _write_batch(self, batch):
+        texts = {}
+        for record in batch:
+            day, kind = record[:2]
+            try:
+                if kind == 'audio':
+                    folder, filename, audio, sr, alt_filename = record[2:]
+                    path = os.path.join(self._folder(day, folder), filename)
+                    if alt_filename is not None and os.path.isfile(path):
+                        path = os.path.join(self._folder(day, folder), alt_filename)
+                    sf.write(path, audio, sr)
+                elif kind == 'ref_audio':
+                    folder, call_id, audios, sr = record[2:]
+                    path = self._folder(day, folder)
+                    if path not in self._ref_calls:
+                        self._ref_calls[path] = {fname.split('_ref_')[0] for fname in os.listdir(path)}
+                    if str(call_id) in self._ref_calls[path]:
+                        continue
+                    for i, audio in enumerate(audios):
+                        sf.write(os.path.join(path, f'{call_id}_ref_{i}.wav'), audio, sr)
+                    self._ref_calls[path].add(str(call_id))
+                elif kind == 'text':
+                    folder, filename, text = record[2:]
+                    texts.setdefault(os.path.join(self._folder(day, folder), filename), []).append(text)
+                self.n_written += 1
+            except Exception as e:
+                self.n_errors += 1
+                print(f"Logging error: {e}")
+
+        for path, lines in texts.items():
+            try:
+                with open(path, 'a') as wf:
+                    wf.write(''.join(lines))
+            except Exception as e:
+                self.n_errors += 1
+                print(f"Logging error: {e}")
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is None for record in batch)
+            self._write_batch([record for record in batch if record is not None])
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                break
+
+    def flush(self):
+        '''Wait until every queued record is written'''
+        if self._worker.is_alive():
+            self.queue.join()
+
+    def close(self):
+        '''Write the remaining records and stop the writer'''
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._worker.join()
+
+    def stats(self):
+        return {'written': self.n_written,
+                'dropped': self.n_dropped,
+                'errors': self.n_errors,
+                'queued': self.queue.qsize()}
@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from streaming import StreamingEmbedder
+
+
+def crop_starts(n_samples, max_audio, num_eval):
+    '''Start samples of the evaluation crops of loadWAV(evalmode=True)'''
+    return np.linspace(0, n_samples - max_audio, num=num_eval).astype(np.int64)
+
+
+class SharedCropEmbedder(object):
+    """Evaluation crops of an utterance pooled from one frame-level pass
+
+    loadWAV(evalmode=True) cuts `num_eval` overlapping crops of `max_audio` samples and
+    the model runs its front-end and convolutions on each of them. Here the frame-level
+    encoder runs once over the span covered by the crops, and each crop is the attentive
+    pooling of its own frames, followed by the embedding layer.
+
+    Exact when the crops are the same window. For an utterance not longer than a crop,
+    loadWAV shifts some crops by one sample, they get the frames of the first one. Otherwise
+    an approximation:
+        - the statistics a model takes over its input (log-mel mean normalization,
+          SE / AFMS excitation, global context of the ECAPA pooling) are those of the
+          span instead of the crop
+        - the frames of a crop are those of the span grid closest to the crop start
+          (up to half a frame hop away)
+        - frames at the crop edges see the neighbouring audio instead of padding
+    The pooling itself is computed over the crop frames as in the model.
+
+    Args:
+        model (SpeakerNet): ECAPA_TDNN (mel features), RawNet2v2 (raw) or Raw_ECAPA (raw),
+            raises NotImplementedError for the other models
+    """
+    def __init__(self, model):
+        self.model = model
+        # the frame-level encoders with the running means of the streaming embedder
+        StreamingEmbedder(model)
+
+    def __call__(self, audio, max_audio, num_eval=10):
+        """Embeddings of the evaluation crops of an utterance
+
+        Args:
+            audio (np.ndarray): samples of the whole utterance, as loaded by loadWAV(max_frames=0)
+            max_audio (int): samples per crop
+            num_eval (int, optional): number of crops. Defaults to 10.
+
+        Returns:
+            torch.Tensor: (num_eval, nOut), as forward_crops on the crops of loadWAV
+        """
+        audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+        if audio.shape[0] <= max_audio:
+            audio = np.pad(audio, (0, max_audio - audio.shape[0] + 1), 'wrap')
+        starts = crop_starts(audio.shape[0], max_audio, num_eval)
+        # frames are computed over the span of the crops only
+        span = audio[starts[0]:starts[-1] + max_audio]
+        starts = starts - starts[0]
+
+        embeds = []
+        with torch.no_grad():
+            inp = torch.from_numpy(span).unsqueeze(0).to(self.model.device)
+            for branch in StreamingEmbedder(self.model).branches:
+                # every frame committed: the running means are the means of the span
+                x, attn, _, _ = branch.frames(inp, 0, span.shape[0])
+                n_frames = min(branch.crop_frames(max_audio), x.shape[-1])
+                first = np.clip(np.round(starts / branch.base).astype(np.int64), 0, x.shape[-1] - n_frames)
+                # (T, num_eval) membership of the frames in the crops
+                frames = np.arange(x.shape[-1])[:, None]
+                member = torch.from_numpy((frames >= first) & (frames < first + n_frames)).to(x.device).double()
+                # softmax over the frames of each crop: exp relative to the max of the span, sums as matmuls
+                x, attn = x[0].double(), attn[0].double()
+                w = torch.exp(attn - attn.max(-1, keepdim=True).values)
+                z = w @ member
+                mean, sq_mean = (w * x) @ member / z, (w * x ** 2) @ member / z
+                embeds.append(branch.head(mean.t(), sq_mean.t()).cpu())
+        return torch.cat(embeds, dim=-1)
+
+
+if __name__ == '__main__':
+    # shared-frame vs per-crop embeddings of freshly initialized models: agreement and speedup
+    import argparse
+    import tempfile
+    import time
+    import warnings
+
+    from model import SpeakerNet
+
+    parser = argparse.ArgumentParser(description="SharedCrops")
+    parser.add_argument('--models', type=str, nargs='+', default=['ECAPA_TDNN:melspectrogram', 'RawNet2v2', 'Raw_ECAPA'])
+    parser.add_argument('--durations', type=float, nargs='+', default=[1.5, 3, 6], help='seconds per utterance')
+    parser.add_argument('--eval_frames', type=int, default=200)
+    parser.add_argument('--num_eval', type=int, default=20)
+    parser.add_argument('--eval_list', type=str, default=None, help='EER with and without shared frames on this list')
+    parser.add_argument('--initial_model', type=str, default=None, help='weights of the --eval_list run')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    sr = 8000
+    max_audio = int(args.eval_frames * 10e-3 * sr + 15e-3 * sr)
+    rng = np.random.RandomState(0)
+
+    def utterance(seconds):
+        t = np.arange(int(seconds * sr)) / sr
+        pitch = 120 + 20 * np.sin(2 * np.pi * 0.3 * t)
+        voiced = sum(np.sin(k * 2 * np.pi * np.cumsum(pitch) / sr) / k for k in range(1, 15))
+        return (0.3 * (0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2) * voiced + 0.02 * rng.randn(len(t))).astype(np.float32)
+
+    print(f"{'model':<26}{'seconds':>8}{'crops (ms)':>12}{'shared (ms)':>13}{'speedup':>9}{'min cos':>9}{'max diff':>10}")
+    for name in args.models:
+        model_name, _, features = name.partition(':')
+        model = SpeakerNet(save_path=tempfile.mkdtemp(), model=model_name, features=features or 'raw',
+                           criterion='ARmSoftmax', device='cpu', nOut=512, nClasses=2, sample_rate=sr,
+                           n_mels=80, max_frames=100, lr=0.001, weight_decay=0, step_size=5, lr_decay=0.95,
+                           margin=0.1, scale=30, augment=False, augment_chain=None)
+        model.eval()
+        shared = SharedCropEmbedder(model)
+        for seconds in args.durations:
+            audio = utterance(seconds)
+            padded = np.pad(audio, (0, max(0, max_audio - len(audio) + 1)), 'wrap')
+            crops = np.stack([padded[s:s + max_audio] for s in crop_starts(len(padded), max_audio, args.num_eval)])
+
+            t0 = time.perf_counter()
+            ref = model.forward_crops(torch.from_numpy(crops))
+            t1 = time.perf_counter()
+            out = shared(audio, max_audio, args.num_eval)
+            t2 = time.perf_counter()
+            cosine = F.cosine_similarity(out, ref, dim=1).min().item()
+            print(f"{name:<26}{seconds:>8.1f}{(t1 - t0) * 1000:>12.0f}{(t2 - t1) * 1000:>13.0f}"
+                  f"{(t1 - t0) / (t2 - t1):>9.2f}{cosine:>9.4f}{(out - ref).abs().max().item():>10.1e}")
+
+        if args.eval_list:
+            from quantization import evaluate_errors
+
+            if args.initial_model:
+                model.loadParameters(args.initial_model)
+            model.kwargs.update(max_frames=args.eval_frames, num_eval=args.num_eval)
+            for enabled in (False, True):
+                model.kwargs['shared_crop_frames'] = enabled
+                model.shared_crop_embedder = None
+                t0 = time.perf_counter()
+                eer, mindcf = evaluate_errors(model, args.eval_list, scoring_mode='cosine')
+                print(f"{name} shared frames {enabled}: EER {eer:.3f}%, minDCF {mindcf:.4f}, "
+                      f"{time.perf_counter() - t0:.0f}s")
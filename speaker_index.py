@@ -0,0 +1,383 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from enrollment import EnrollmentDB
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class _Buffer(object):
+    '''Rows appended in amortized constant time: the capacity doubles when full, `view` is the filled part'''
+    def __init__(self, rows):
+        rows = np.asarray(rows)
+        self.data = np.zeros((max(16, len(rows)),) + rows.shape[1:], dtype=rows.dtype)
+        self.data[:len(rows)] = rows
+        self.size = len(rows)
+
+    @property
+    def view(self):
+        return self.data[:self.size]
+
+    def extend(self, rows):
+        if self.size + len(rows) > len(self.data):
+            data = np.zeros((max(2 * len(self.data), self.size + len(rows)),) + self.data.shape[1:], dtype=self.data.dtype)
+            data[:self.size] = self.view
+            self.data = data
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+
+def _top_k(scores, k):
+    # indexes of the k highest scores of each row, sorted by decreasing score
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=1), axis=1)
+    idx = np.take_along_axis(idx, order, axis=1)
+    return np.take_along_axis(scores, idx, axis=1), idx
+
+
+class BruteForceIndex(object):
+    """Exact top-k search of the cosine similarity against every voiceprint
+
+    Vectors are appended to a buffer of doubling capacity, adding speakers one at a time
+    costs the same as adding them at once.
+
+    Args:
+        dim (int): embedding dimension
+    """
+    index_type = 'flat'
+
+    def __init__(self, dim, **kwargs):
+        self.dim = dim
+        self.ids = []
+        self._vectors = _Buffer(np.zeros((0, dim), dtype=np.float32))
+        # version of the EnrollmentDB the index was built from (index_from_enrollment)
+        self.enrollment_version = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def vectors(self):
+        return self._vectors.view
+
+    @vectors.setter
+    def vectors(self, vectors):
+        self._vectors = _Buffer(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+
+    def params(self):
+        return {'dim': self.dim}
+
+    def add(self, ids, vectors):
+        vectors = _normalize(vectors)
+        assert len(ids) == vectors.shape[0], "Number of ids and vectors must match"
+        self.ids.extend(str(i) for i in ids)
+        self._vectors.extend(vectors)
+
+    def search(self, queries, k=1):
+        """Top-k speakers of each query
+
+        Args:
+            queries (np.ndarray): query embeddings (n_queries, dim) or (dim,)
+            k (int, optional): number of neighbours. Defaults to 1.
+
+        Returns:
+            tuple: cosine scores (n_queries, k) and speaker ids (n_queries lists of k)
+        """
+        scores, idx = _top_k(_normalize(queries) @ self.vectors.T, k)
+        return scores, [[self.ids[i] for i in row] for row in idx]
+
+    def save_arrays(self, path):
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+
+    def load_arrays(self, path):
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'))
+
+
+class IVFIndex(BruteForceIndex):
+    """Inverted file index: voiceprints are clustered by spherical k-means, a query only
+    scores the voiceprints of its `nprobe` closest clusters
+
+    Without an explicit `train`, the clusters are trained on the added vectors with one
+    cluster per `train_points` vectors (up to nlist), and trained again on all the vectors
+    each time that number doubles: an enrollment that starts small reaches nlist clusters.
+    Between two trainings, additions are assigned to the existing clusters.
+
+    Args:
+        dim (int): embedding dimension
+        nlist (int, optional): number of clusters. Defaults to 256.
+        nprobe (int, optional): number of clusters searched per query. Defaults to 8.
+        n_iter (int, optional): k-means iterations. Defaults to 20.
+        train_points (int, optional): vectors per cluster to train on. Defaults to 39.
+    """
+    index_type = 'ivf'
+
+    def __init__(self, dim, nlist=256, nprobe=8, n_iter=20, train_points=39, **kwargs):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.train_points = train_points
+        self.centroids = None
+        self.assignments = _Buffer(np.zeros(0, dtype=np.int64))
+        # vector indexes of each cluster
+        self.lists = []
+
+    def params(self):
+        return {'dim': self.dim, 'nlist': self.nlist, 'nprobe': self.nprobe, 'n_iter': self.n_iter,
+                'train_points': self.train_points}
+
+    def train(self, vectors, nlist=None, seed=0):
+        vectors = _normalize(vectors)
+        nlist = min(nlist or self.nlist, vectors.shape[0])
+        rng = np.random.RandomState(seed)
+        centroids = vectors[rng.choice(vectors.shape[0], nlist, replace=False)]
+        for _ in range(self.n_iter):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            counts = np.bincount(assignments, minlength=nlist)
+            # empty clusters keep their centroid
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self._build_lists()
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _build_lists(self):
+        assignments = self._assign(self.vectors) if len(self.vectors) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(assignments, kind='stable')
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self.assignments = _Buffer(assignments)
+        self.lists = [_Buffer(order[bounds[c]:bounds[c + 1]]) for c in range(len(self.centroids))]
+
+    def add(self, ids, vectors):
+        start = len(self.ids)
+        super().add(ids, vectors)
+        nlist = int(np.clip(len(self.vectors) // self.train_points, 1, self.nlist))
+        if self.centroids is None or nlist >= min(2 * len(self.centroids), self.nlist) > len(self.centroids):
+            self.train(self.vectors, nlist)
+            return
+        assignments = self._assign(self.vectors[start:])
+        self.assignments.extend(assignments)
+        for c in np.unique(assignments):
+            self.lists[c].extend(start + np.flatnonzero(assignments == c))
+
+    def search(self, queries, k=1):
+        queries = _normalize(queries)
+        if self.centroids is None:
+            return np.zeros((queries.shape[0], 0), dtype=np.float32), [[] for _ in range(queries.shape[0])]
+
+        _, probes = _top_k(queries @ self.centroids.T, self.nprobe)
+        all_scores = []
+        all_ids = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self.lists[c].view for c in probe])
+            scores, idx = _top_k((self.vectors[candidates] @ query)[None, :], k)
+            all_scores.append(scores[0])
+            all_ids.append([self.ids[i] for i in candidates[idx[0]]])
+
+        # pad queries with less than k candidates
+        n = max(len(s) for s in all_scores)
+        scores = np.full((len(all_scores), n), -np.inf, dtype=np.float32)
+        for i, s in enumerate(all_scores):
+            scores[i, :len(s)] = s
+        return scores, all_ids
+
+    def save_arrays(self, path):
+        super().save_arrays(path)
+        if self.centroids is not None:
+            np.save(os.path.join(path, 'centroids.npy'), self.centroids)
+
+    def load_arrays(self, path):
+        super().load_arrays(path)
+        if os.path.isfile(os.path.join(path, 'centroids.npy')):
+            self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self._build_lists()
+
+
+class FaissIndex(BruteForceIndex):
+    """Faiss backed index through the vendored FaissKNN wrapper, requires the faiss package
+
+    Args:
+        dim (int): embedding dimension
+        faiss_index (str, optional): 'flat' (exact inner product) or 'hnsw'. Defaults to 'hnsw'.
+        hnsw_m (int, optional): HNSW graph degree. Defaults to 32.
+        ef_search (int, optional): HNSW search depth. Defaults to 64.
+    """
+    index_type = 'faiss'
+
+    def __init__(self, dim, faiss_index='hnsw', hnsw_m=32, ef_search=64, **kwargs):
+        super().__init__(dim)
+        try:
+            import faiss
+            from losses.pytorch_metric_learning.utils.inference import FaissKNN
+        except ImportError:
+            raise ImportError("The 'faiss' index requires the faiss package (faiss-cpu or faiss-gpu)")
+        self.faiss = faiss
+        self.faiss_index = faiss_index
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.knn = FaissKNN(reset_before=False, reset_after=False, index_init_fn=self._init_index)
+        self.knn.index = self._init_index(dim)
+
+    def _init_index(self, dim):
+        if self.faiss_index == 'hnsw':
+            index = self.faiss.IndexHNSWFlat(dim, self.hnsw_m, self.faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = self.ef_search
+            return index
+        return self.faiss.IndexFlatIP(dim)
+
+    def params(self):
+        return {'dim': self.dim, 'faiss_index': self.faiss_index, 'hnsw_m': self.hnsw_m, 'ef_search': self.ef_search}
+
+    def add(self, ids, vectors):
+        vectors = _normalize(vectors)
+        self.ids.extend(str(i) for i in ids)
+        self.knn.add(vectors)
+
+    def search(self, queries, k=1):
+        scores, idx = self.knn.index.search(_normalize(queries), min(k, len(self.ids)))
+        return scores, [[self.ids[i] for i in row if i >= 0] for row in idx]
+
+    def save_arrays(self, path):
+        self.knn.save(os.path.join(path, 'index.faiss'))
+
+    def load_arrays(self, path):
+        self.knn.load(os.path.join(path, 'index.faiss'))
+
+
+INDEX_TYPES = {
+    'flat': BruteForceIndex,
+    'ivf': IVFIndex,
+    'faiss': FaissIndex
+}
+
+
+def create_index(index_type='flat', dim=512, **kwargs):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Invalid index type {index_type}, available: {list(INDEX_TYPES.keys())}")
+    return INDEX_TYPES[index_type](dim, **kwargs)
+
+
+def save_index(index, path):
+    """Save the index in a folder: meta.json (type, params, speaker ids) and its arrays"""
+    os.makedirs(path, exist_ok=True)
+    index.save_arrays(path)
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'type': index.index_type, 'params': index.params(), 'ids': index.ids,
+                   'enrollment': index.enrollment_version}, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def load_index(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    index = create_index(meta['type'], **meta['params'])
+    index.ids = meta['ids']
+    index.enrollment_version = meta.get('enrollment')
+    index.load_arrays(path)
+    return index
+
+
+def index_from_enrollment(db, index_type='flat', **kwargs):
+    """Build an index over all voiceprints of an EnrollmentDB, recording the version of the store"""
+    version = db.version()
+    speakers, vectors = db.matrix()
+    index = create_index(index_type, dim=db.dim, **kwargs)
+    if speakers:
+        index.add(speakers, vectors)
+    index.enrollment_version = version
+    return index
+
+
+def benchmark_index(index, exact, queries, k=10):
+    """Recall@k of `index` against the exact search and the latency of both, one query at a time
+
+    Returns:
+        dict: recall, mean and p99 latency (ms) of the index and of the exact search
+    """
+    queries = _normalize(queries)
+    latencies = {'index': [], 'exact': []}
+    hits = 0
+    for query in queries:
+        t0 = time.perf_counter()
+        _, ids = index.search(query, k)
+        latencies['index'].append((time.perf_counter() - t0) * 1000)
+        t0 = time.perf_counter()
+        _, exact_ids = exact.search(query, k)
+        latencies['exact'].append((time.perf_counter() - t0) * 1000)
+        hits += len(set(ids[0]) & set(exact_ids[0]))
+
+    result = {'recall': hits / max(1, sum(min(k, len(exact)) for _ in queries))}
+    for name, values in latencies.items():
+        result[f'{name}_mean_ms'] = float(np.mean(values))
+        result[f'{name}_p99_ms'] = float(np.percentile(values, 99))
+    return result
+
+
+def build_speaker_index(args):
+    """CLI mode: index the enrolled speakers, optionally benchmark the index against brute force"""
+    enrollment_path = args.enrollment_path or os.path.join(args.save_path, 'enrollment')
+    index_path = args.index_path or os.path.join(args.save_path, 'speaker_index')
+    db = EnrollmentDB(enrollment_path)
+    print(f"Indexing {len(db)} speakers from {enrollment_path} with '{args.index_type}' index")
+
+    t0 = time.time()
+    index = index_from_enrollment(db, args.index_type, nlist=args.index_nlist, nprobe=args.index_nprobe)
+    print(f"Built in {time.time() - t0:.2f}s")
+    save_index(index, index_path)
+    print(f"Saved to {index_path}")
+
+    if args.benchmark_index:
+        speakers, vectors = db.matrix()
+        rng = np.random.RandomState(0)
+        queries = vectors[rng.choice(len(speakers), min(1000, len(speakers)), replace=False)]
+        # perturbed voiceprints as queries
+        queries = _normalize(queries) + rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+        exact = index_from_enrollment(db, 'flat')
+        for nprobe in sorted({1, 4, 16, 64, args.index_nprobe}) if args.index_type == 'ivf' else [None]:
+            if nprobe is not None:
+                index.nprobe = nprobe
+            result = benchmark_index(index, exact, queries, k=10)
+            print(f"nprobe={nprobe} recall@10 {result['recall']:.4f}",
+                  f"latency {result['index_mean_ms']:.3f}ms (p99 {result['index_p99_ms']:.3f}ms)",
+                  f"vs exact {result['exact_mean_ms']:.3f}ms (p99 {result['exact_p99_ms']:.3f}ms)")
+
+
+if __name__ == '__main__':
+    # synthetic recall-vs-latency benchmark
+    rng = np.random.RandomState(0)
+    n_speakers, dim = 100000, 192
+    centers = rng.normal(size=(256, dim)).astype(np.float32)
+    vectors = centers[rng.randint(0, 256, n_speakers)] + rng.normal(scale=0.8, size=(n_speakers, dim)).astype(np.float32)
+    ids = [f'spk{i}' for i in range(n_speakers)]
+    queries = vectors[rng.choice(n_speakers, 500, replace=False)] + rng.normal(scale=0.2, size=(500, dim)).astype(np.float32)
+
+    exact = create_index('flat', dim)
+    exact.add(ids, vectors)
+    t0 = time.time()
+    ivf = create_index('ivf', dim, nlist=512)
+    ivf.add(ids, vectors)
+    print(f"IVF trained in {time.time() - t0:.2f}s")
+    for nprobe in [1, 4, 16, 64]:
+        ivf.nprobe = nprobe
+        result = benchmark_index(ivf, exact, queries, k=10)
+        print(f"nprobe={nprobe:<3} recall@10 {result['recall']:.4f} ",
+              f"ivf {result['index_mean_ms']:.3f}ms (p99 {result['index_p99_ms']:.3f}ms) ",
+              f"exact {result['exact_mean_ms']:.3f}ms (p99 {result['exact_p99_ms']:.3f}ms)")
@@ -0,0 +1,367 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.ECAPA_TDNN import ECAPA_TDNN
+from models.Raw_ECAPA import Raw_ECAPA
+from models.RawNet2v2 import RawNet2 as RawNet2v2
+
+
+class RunningMean(object):
+    """Running per-channel mean (and std) of frame features over the frames seen so far
+
+    Stands in for the utterance-level means of the models (mean normalization of the
+    log-mel, SE blocks, AFMS, global context of the attentive pooling), which are not
+    known before the end of the call. Frames are counted once, when they are committed.
+    """
+    def __init__(self):
+        self.sum = 0
+        self.sq_sum = 0
+        self.count = 0
+        self.committed = 0 # absolute index of the first frame not counted yet
+
+    def estimate(self, x, first_frame, with_std=False, eps=1e-12):
+        '''Mean (std) over the committed frames and the frames of x (1, C, T) past them'''
+        new = x[..., max(0, self.committed - first_frame):].double()
+        count = self.count + new.shape[-1]
+        mean = (self.sum + new.sum(-1)) / count
+        if not with_std:
+            return mean.unsqueeze(-1).to(x.dtype)
+        var = (self.sq_sum + (new ** 2).sum(-1)) / count - mean ** 2
+        std = torch.sqrt(var.clamp(eps))
+        return mean.unsqueeze(-1).to(x.dtype), std.unsqueeze(-1).to(x.dtype)
+
+    def commit(self, x, first_frame, upto):
+        '''Count the frames of x up to the absolute index `upto`'''
+        new = x[..., max(0, self.committed - first_frame):max(0, upto - first_frame)].double()
+        self.sum = self.sum + new.sum(-1)
+        self.sq_sum = self.sq_sum + (new ** 2).sum(-1)
+        self.count += new.shape[-1]
+        self.committed = max(self.committed, upto)
+
+
+class PoolingAccumulator(object):
+    """Attentive statistics pooling as sufficient statistics
+
+    With w = softmax_t(a), the pooled mean and std only need sum(exp(a) x), sum(exp(a) x^2)
+    and sum(exp(a)) over time. They are kept per channel relative to the running max of
+    the logits (log-sum-exp), so frames can be added chunk by chunk.
+    """
+    def __init__(self):
+        self.state = (None, 0, 0, 0) # max, sum w, sum w x, sum w x^2
+        self.committed = 0
+
+    @staticmethod
+    def _add(state, x, a):
+        max_, z, s1, s2 = state
+        x, a = x.double(), a.double()
+        new_max = a.max(-1).values if max_ is None else torch.maximum(max_, a.max(-1).values)
+        scale = 0 if max_ is None else torch.exp(max_ - new_max)
+        w = torch.exp(a - new_max.unsqueeze(-1))
+        return new_max, z * scale + w.sum(-1), s1 * scale + (w * x).sum(-1), s2 * scale + (w * x ** 2).sum(-1)
+
+    def commit(self, x, a, first_frame, upto):
+        start, stop = max(0, self.committed - first_frame), max(0, upto - first_frame)
+        if stop > start:
+            self.state = self._add(self.state, x[..., start:stop], a[..., start:stop])
+        self.committed = max(self.committed, upto)
+
+    def moments(self, x, a, first_frame):
+        '''Weighted mean and E[x^2] of the committed frames plus the pending frames of x'''
+        state = self.state
+        start = max(0, self.committed - first_frame)
+        if start < x.shape[-1]:
+            state = self._add(state, x[..., start:], a[..., start:])
+        _, z, s1, s2 = state
+        return s1 / z, s2 / z
+
+
+def _front_end_params(features):
+    '''hop and n_fft of a mel / mfcc front-end (nnAudio or torchaudio)'''
+    hop, n_fft = None, None
+    for module in features.modules():
+        stride = getattr(module, 'stride', None)
+        hop = hop or (stride if isinstance(stride, int) else None) or getattr(module, 'hop_length', None)
+        n_fft = n_fft or getattr(module, 'n_fft', None)
+    return hop, n_fft
+
+
+class ECAPAStream(object):
+    """ECAPA_TDNN over a window of audio with the utterance means replaced by running
+    means and the attentive pooling accumulated frame by frame
+
+    Args:
+        model (ECAPA_TDNN): embedding network
+        features (nn.Module): waveform -> mel front-end of the network
+    """
+    def __init__(self, model, features):
+        self.model = model
+        self.features = features
+        self.base, n_fft = _front_end_params(features)
+        # receptive field of the frame-level part in frames on each side, res2net chains included
+        frames = sum((m.kernel_size[0] - 1) * m.dilation[0] // 2
+                     for m in list(model.blocks.modules()) + list(model.mfa.modules()) if isinstance(m, nn.Conv1d))
+        self.context = frames * self.base + n_fft // 2 + self.base
+        self.lookahead = self.context
+        self.min_samples = n_fft // 2 + 1 # reflect padding of the front-end
+        self.cmn = RunningMean()
+        self.se = [RunningMean() for _ in model.blocks[1:]]
+        self.asp_context = RunningMean()
+        self.pool = PoolingAccumulator()
+
+    def frames(self, audio, first_sample, commit_sample):
+        '''Frame features (1, C, T) and attention logits of a window, absolute index of its
+        first frame and of the first frame not committed'''
+        model = self.model
+        first_frame = first_sample // self.base
+        # frames centered before commit_sample
+        upto = -(-commit_sample // self.base)
+
+        x = (self.features(audio) + 1e-6).log()
+        mean = self.cmn.estimate(x, first_frame)
+        self.cmn.commit(x, first_frame, upto)
+        x = x - mean
+
+        x = model.blocks[0](x)
+        xl = []
+        for block, running in zip(model.blocks[1:], self.se):
+            residual = block.shortcut(x) if block.shortcut else x
+            h = block.tdnn2(block.res2net_block(block.tdnn1(x)))
+            s = running.estimate(h, first_frame)
+            running.commit(h, first_frame, upto)
+            s = block.se_block.sigmoid(block.se_block.conv2(block.se_block.relu(block.se_block.conv1(s))))
+            x = s * h + residual
+            xl.append(x)
+        x = model.mfa(torch.cat(xl, dim=1))
+
+        asp = model.asp
+        attn = x
+        if asp.global_context:
+            mean, std = self.asp_context.estimate(x, first_frame, with_std=True, eps=asp.eps)
+            self.asp_context.commit(x, first_frame, upto)
+            attn = torch.cat([x, mean.expand_as(x), std.expand_as(x)], dim=1)
+        return x, asp.conv(asp.tanh(asp.tdnn(attn))), first_frame, upto
+
+    def head(self, mean, sq_mean):
+        '''Embeddings (n, nOut) of the attention weighted mean and E[x^2] (n, C)'''
+        std = torch.sqrt((sq_mean - mean ** 2).clamp(self.model.asp.eps))
+        pooled = torch.cat([mean, std], dim=1).float().unsqueeze(2)
+        return self.model.fc(self.model.asp_bn(pooled)).reshape(mean.shape[0], -1)
+
+    def crop_frames(self, length):
+        '''Number of frames of a crop of `length` samples'''
+        return length // self.base + 1
+
+    def step(self, audio, first_sample, commit_sample):
+        x, attn, first_frame, upto = self.frames(audio, first_sample, commit_sample)
+        self.pool.commit(x, attn, first_frame, upto)
+        return self.head(*self.pool.moments(x, attn, first_frame)).reshape(-1)
+
+
+class RawNetStream(object):
+    """RawNet2v2 over a window of audio with the AFMS means replaced by running means
+    and the attentive pooling accumulated frame by frame
+
+    Args:
+        model (RawNet2v2.RawNet2): embedding network
+    """
+    def __init__(self, model):
+        self.model = model
+        self.blocks = [block for layer in (model.layer1, model.layer2, model.layer3,
+                                           model.layer4, model.layer5, model.layer6) for block in layer]
+        # samples per frame and receptive field (samples) of every block
+        hop = model.conv1.stride[0]
+        field = model.conv1.kernel_size[0]
+        self.hops = []
+        for block in self.blocks:
+            field += sum((m.kernel_size[0] - 1) * m.dilation[0] * hop for m in (block.conv1, block.conv2))
+            if block.downsample:
+                field += (block.mp.kernel_size - 1) * hop
+                hop *= block.mp.stride
+            self.hops.append(hop)
+        self.base = hop
+        self.context = -(-field // hop) * hop + hop
+        self.lookahead = self.context
+        self.min_samples = hop
+        self.afms = [RunningMean() for _ in self.blocks]
+        self.pool = PoolingAccumulator()
+
+    def frames(self, audio, first_sample, commit_sample):
+        '''Frame features (1, C, T) and attention logits of a window, absolute index of its
+        first frame and of the first frame not committed'''
+        model = self.model
+        x = model.conv1(audio.unsqueeze(1))
+        for block, hop, running in zip(self.blocks, self.hops, self.afms):
+            out = block.lrelu(block.bn1(x))
+            shortcut = block.shortcut(out) if hasattr(block, "shortcut") else x
+            out = block.conv2(block.lrelu(block.bn2(block.conv1(out))))
+            out = out + shortcut
+            if block.downsample:
+                out = block.mp(out)
+            y = running.estimate(out, first_sample // hop)
+            running.commit(out, first_sample // hop, commit_sample // hop)
+            y = block.afms.sig(block.afms.fc(y.squeeze(-1))).unsqueeze(-1)
+            x = (out + block.afms.alpha) * y
+
+        x = model.lrelu(model.bn_before_agg(x))
+        attn = model.attention[:-1](x) # logits, the softmax is in the accumulator
+        return x, attn, first_sample // self.base, commit_sample // self.base
+
+    def head(self, mean, sq_mean):
+        '''Embeddings (n, nOut) of the attention weighted mean and E[x^2] (n, C)'''
+        std = torch.sqrt((sq_mean - mean ** 2).clamp(min=1e-5))
+        return self.model.fc(torch.cat([mean, std], dim=1).float())
+
+    def crop_frames(self, length):
+        '''Number of frames of a crop of `length` samples'''
+        return length // self.base
+
+    def step(self, audio, first_sample, commit_sample):
+        x, attn, first_frame, upto = self.frames(audio, first_sample, commit_sample)
+        self.pool.commit(x, attn, first_frame, upto)
+        return self.head(*self.pool.moments(x, attn, first_frame)).reshape(-1)
+
+
+class StreamingEmbedder(object):
+    """Speaker embedding of a live call, updated after each audio chunk
+
+    Each `push` runs the network on the new chunk plus a fixed left context and keeps
+    the last `lookahead` samples pending (receptive field of the convolutions), so the
+    cost of a chunk does not grow with the call. Frames are pooled into running
+    attentive-statistics accumulators.
+
+    Exactness: the convolutions, the pooling and the end of the call match the offline
+    forward. The utterance-level means of the models (log-mel mean normalization,
+    SE / AFMS excitation, global context of the ECAPA pooling) are only known at the end
+    of the call; a frame uses the running means over the audio seen when it was committed.
+    The final embedding is therefore an approximation that gets closer to the offline one
+    as the running means settle (see `python streaming.py`).
+
+    Args:
+        model (SpeakerNet): ECAPA_TDNN (mel features), RawNet2v2 (raw) or Raw_ECAPA (raw)
+        normalize (bool, optional): L2 normalize the embeddings. Defaults to False.
+        warmup (int, optional): samples buffered before the first frames are committed, so
+            they use the means of `warmup` samples rather than of a few frames. Defaults to 0.
+    """
+    def __init__(self, model, normalize=False, warmup=0):
+        self.model = model.eval()
+        self.warmup = warmup
+        self.normalize = normalize
+        self.reset()
+
+    def reset(self):
+        '''Start a new call'''
+        S = self.model.__S__
+        if isinstance(S, Raw_ECAPA):
+            self.branches = [ECAPAStream(S.ECAPA_TDNN, S.compute_features), RawNetStream(S.rawnet2v2)]
+        elif isinstance(S, ECAPA_TDNN) and self.model.compute_features is not None:
+            self.branches = [ECAPAStream(S, self.model.compute_features)]
+        elif isinstance(S, RawNet2v2) and self.model.compute_features is None:
+            self.branches = [RawNetStream(S)]
+        else:
+            raise NotImplementedError(f"No streaming support for {type(S).__name__} with {self.model.features} features")
+        self.committed = [0] * len(self.branches)
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.offset = 0 # absolute index of self.audio[0]
+        self.embedding = None
+
+    def _window_start(self, branch, committed):
+        return max(0, (committed - branch.context) // branch.base * branch.base)
+
+    def push(self, chunk, final=False):
+        """Add an audio chunk of the call
+
+        Args:
+            chunk (np.ndarray): float samples, same sample rate and scale as the offline input
+            final (bool, optional): last chunk of the call, every frame is committed. Defaults to False.
+
+        Returns:
+            torch.Tensor: embedding (nOut,) of the audio so far, None while it is too short
+        """
+        self.audio = np.concatenate([self.audio, np.asarray(chunk, dtype=np.float32).reshape(-1)])
+        end = self.offset + len(self.audio)
+
+        starts = [self._window_start(branch, committed) for branch, committed in zip(self.branches, self.committed)]
+        if any(end - start < branch.min_samples for branch, start in zip(self.branches, starts)):
+            return self.embedding
+
+        embeds = []
+        with torch.no_grad():
+            for i, (branch, start) in enumerate(zip(self.branches, starts)):
+                if final:
+                    commit = end
+                elif end < self.warmup:
+                    commit = self.committed[i]
+                else:
+                    commit = max(self.committed[i], (end - branch.lookahead) // branch.base * branch.base)
+                audio = torch.from_numpy(self.audio[start - self.offset:]).unsqueeze(0).to(self.model.device)
+                embeds.append(branch.step(audio, start, commit).cpu())
+                self.committed[i] = commit
+
+        # drop the audio before the next windows
+        keep = min(self._window_start(branch, committed) for branch, committed in zip(self.branches, self.committed))
+        self.audio = self.audio[keep - self.offset:]
+        self.offset = keep
+
+        embed = torch.cat(embeds, dim=-1)
+        self.embedding = F.normalize(embed, p=2, dim=0) if self.normalize else embed
+        return self.embedding
+
+    def finalize(self):
+        '''End of the call: commit the pending frames, returns the final embedding'''
+        return self.push(np.zeros(0, dtype=np.float32), final=True)
+
+
+if __name__ == '__main__':
+    # final streamed embedding vs offline embedding of the whole call, and cost per chunk
+    import argparse
+    import tempfile
+    import time
+    import warnings
+
+    from model import SpeakerNet
+
+    parser = argparse.ArgumentParser(description="StreamingEmbedding")
+    parser.add_argument('--models', type=str, nargs='+', default=['ECAPA_TDNN:melspectrogram', 'RawNet2v2', 'Raw_ECAPA'])
+    parser.add_argument('--duration', type=float, default=12, help='seconds of the synthetic call')
+    parser.add_argument('--chunk', type=float, default=0.5, help='seconds per chunk')
+    parser.add_argument('--tolerance', type=float, default=0.98, help='min cosine similarity with the offline embedding')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    sr = 8000
+    rng = np.random.RandomState(0)
+    t = np.arange(int(args.duration * sr)) / sr
+    # voiced harmonics with a moving pitch, syllable-rate envelope and background noise
+    pitch = 120 + 20 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sr
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 15))
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2
+    audio = (0.3 * envelope * voiced + 0.02 * rng.randn(len(t))).astype(np.float32)
+    chunk = int(args.chunk * sr)
+
+    for name in args.models:
+        model_name, _, features = name.partition(':')
+        model = SpeakerNet(save_path=tempfile.mkdtemp(), model=model_name, features=features or 'raw',
+                           criterion='ARmSoftmax', device='cpu', nOut=512, nClasses=2, sample_rate=sr,
+                           n_mels=80, max_frames=100, lr=0.001, weight_decay=0, step_size=5, lr_decay=0.95,
+                           margin=0.1, scale=30, augment=False, augment_chain=None)
+        model.eval()
+        offline = model.forward_crops(torch.from_numpy(audio).unsqueeze(0)).reshape(-1)
+
+        stream = StreamingEmbedder(model)
+        times = []
+        for i in range(0, len(audio), chunk):
+            t0 = time.perf_counter()
+            stream.push(audio[i:i + chunk])
+            times.append(time.perf_counter() - t0)
+        final = stream.finalize()
+        # one window holding the whole call: the carried state alone must not change the output
+        single = StreamingEmbedder(model).push(audio, final=True)
+
+        cosine = F.cosine_similarity(final, offline, dim=0).item()
+        print(f"{name:<26} cosine {cosine:.5f} max abs diff {(final - offline).abs().max().item():.2e} "
+              f"(single window {(single - offline).abs().max().item():.1e}) | ms per chunk: "
+              f"first {times[1] * 1000:.0f}, last {times[-1] * 1000:.0f} | "
+              f"{'OK' if cosine >= args.tolerance else 'FAIL'}")
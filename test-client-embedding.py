@@ -37,16 +37,22 @@ def encode_audio(path):
     return audio_signal_str, sr
 
 
-def get_response(path):
+def get_response(path, binary=False):
     t = time.time()
-    signal, sr = encode_audio(path)
-    data = {'callId': '366524143-20211229-100000',
-            'phone': '366524143',
-            'base64Speech': signal}
-    
-    data_json = json.dumps(data)
-
-    r = requests.post(URL, json=data_json)
+    if binary:
+        # wav file as raw body, no base64/json encoding
+        with open(path, 'rb') as f:
+            r = requests.post(URL + '/binary', data=f.read(), headers={'Content-Type': 'audio/wav'},
+                              params={'callId': '366524143-20211229-100000', 'phone': '366524143'})
+    else:
+        signal, sr = encode_audio(path)
+        data = {'callId': '366524143-20211229-100000',
+                'phone': '366524143',
+                'base64Speech': signal}
+        
+        data_json = json.dumps(data)
+
+        r = requests.post(URL, json=data_json)
     
     print("Success: ", end='')
     color_text = 'g' if int(r.status_code) == 200 else 'r'
@@ -86,14 +92,17 @@ if __name__ == '__main__':
                         type=str,
                         default=default_path2,
                         help='path to file 2')
+    parser.add_argument('--binary',
+                        action='store_true',
+                        help='send the wav files as raw body to /embedding/binary')
     args = parser.parse_args()
 
     t = time.time()
     print(f"<[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]>")
 
     print("Getting response...")
-    emb_ref, threshold = get_response(args.ref)
-    emb_com, threshold = get_response(args.com)
+    emb_ref, threshold = get_response(args.ref, binary=args.binary)
+    emb_com, threshold = get_response(args.com, binary=args.binary)
 
 #     print(type(emb_ref), emb_ref.shape)
 #     print(type(emb_com), emb_com.shape)
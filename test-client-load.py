@@ -0,0 +1,79 @@
+# load test client: throughput and latency percentiles of the service under concurrent requests
+import argparse
+import base64
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import soundfile as sf
+
+URL = "http://0.0.0.0:8111"
+
+
+def encode_audio(path, dtype=np.float64):
+    audio, sr = sf.read(path)
+    audio_signal_bytes = base64.b64encode(audio.astype(dtype))
+    return audio_signal_bytes.decode('utf-8')
+
+
+def make_payload(endpoint, audio_str, n_ref=1, n_com=1):
+    if endpoint == 'embedding':
+        data = {'callId': 'load_test',
+                'phone': 'load_test',
+                'base64Speech': audio_str}
+    else:
+        data = {'callId': 'load_test',
+                'phone': 'load_test',
+                'refSpeech': [audio_str] * n_ref,
+                'comSpeech': [audio_str] * n_com}
+    return json.dumps(data)
+
+
+def send(url, payload):
+    t0 = time.time()
+    try:
+        r = requests.post(url, json=payload)
+        status = r.status_code
+    except Exception:
+        status = -1
+    return time.time() - t0, status
+
+
+def run_load_test(url, payload, n_requests=200, concurrency=16):
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: send(url, payload), range(n_requests)))
+    total_time = time.time() - t0
+
+    latencies = np.array([latency for latency, status in results if status == 200]) * 1000
+    n_ok = len(latencies)
+    print(f"Concurrency {concurrency}: {n_ok}/{n_requests} OK,",
+          f"{sum(status == 503 for _, status in results)} rejected (503),",
+          f"{sum(status not in (200, 503) for _, status in results)} failed")
+    if n_ok:
+        print(f"> Throughput: {n_ok / total_time:.2f} req/s",
+              f"|| Latency p50 {np.percentile(latencies, 50):.1f}ms",
+              f"p90 {np.percentile(latencies, 90):.1f}ms",
+              f"p99 {np.percentile(latencies, 99):.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="LoadTestService")
+    parser.add_argument('--url', type=str, default=URL)
+    parser.add_argument('--endpoint', type=str, default='embedding', help='embedding / isMatched')
+    parser.add_argument('--audio', '-a', type=str, required=True, help='path to the audio file sent by every request')
+    parser.add_argument('--requests', '-n', type=int, default=200)
+    parser.add_argument('--concurrency', '-c', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--n_ref', type=int, default=1, help='ref utterances per isMatched request')
+    parser.add_argument('--n_com', type=int, default=1, help='com utterances per isMatched request')
+    args = parser.parse_args()
+
+    # run against the server with serving_mode = 'single' then 'batched' to compare
+    payload = make_payload(args.endpoint, encode_audio(args.audio), n_ref=args.n_ref, n_com=args.n_com)
+    url = f"{args.url}/{args.endpoint}"
+    print(f"<[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]> Load test on {url}")
+    send(url, payload)  # warm up
+    for concurrency in args.concurrency:
+        run_load_test(url, payload, n_requests=args.requests, concurrency=concurrency)
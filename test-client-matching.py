@@ -68,19 +68,34 @@ def encode_audio(path):
     audio_signal_str = audio_signal_bytes.decode('utf-8')
     return audio_signal_str, sr
 
-def get_response(refs, coms):
-    t = time.time()
-    signal_refs = [encode_audio(path)[0] for path in refs]
-    signal_coms = [encode_audio(path)[0] for path in coms]
-    
-    data = {'callId': 'test_audio',
-            'phone': '',
-            'refSpeech': signal_refs,
-            'comSpeech': signal_coms}
+def read_audio_part(path):
+    # wav files are sent as they are, other formats as raw PCM int16 (8kHz mono)
+    if path.endswith('.wav'):
+        with open(path, 'rb') as f:
+            return (Path(path).name, f.read(), 'audio/wav')
+    audio_seg = AudioSegment.from_file(path).set_frame_rate(8000).set_channels(1).set_sample_width(2)
+    return (Path(path).name, audio_seg.raw_data, 'audio/L16')
 
-    data_json = json.dumps(data)
+
+def get_response(refs, coms, binary=False):
+    t = time.time()
     try:
-        r = requests.post(URL, json=data_json)
+        if binary:
+            # multipart parts, no base64/json encoding
+            files = [('refSpeech', read_audio_part(path)) for path in refs] + \
+                    [('comSpeech', read_audio_part(path)) for path in coms]
+            r = requests.post(URL + '/binary', data={'callId': 'test_audio', 'phone': ''}, files=files)
+        else:
+            signal_refs = [encode_audio(path)[0] for path in refs]
+            signal_coms = [encode_audio(path)[0] for path in coms]
+            
+            data = {'callId': 'test_audio',
+                    'phone': '',
+                    'refSpeech': signal_refs,
+                    'comSpeech': signal_coms}
+
+            data_json = json.dumps(data)
+            r = requests.post(URL, json=data_json)
         # print with color state of response
         print("Connection: ", end='')
         state = "Success" if int(r.status_code) == 200 else "Failed"
@@ -114,6 +129,9 @@ if __name__ == '__main__':
                         type=str,
                         default=None,
                         help='path to file 2')
+    parser.add_argument('--binary',
+                        action='store_true',
+                        help='send audio as multipart parts to /isMatched/binary')
     args = parser.parse_args()
 
     t = time.time()
@@ -139,7 +157,7 @@ if __name__ == '__main__':
             'log_service/unknown/Master Huyen Trang.wav', 
             'log_service/unknown/Master Thuy Linh.wav'] 
     for c in  coms:
-        get_response(['log_service/unknown/1_Khanh_An.wav'], [c])
+        get_response(['log_service/unknown/1_Khanh_An.wav'], [c], binary=args.binary)
     print('')
 #     get_response(refs, coms)
 ######################################################################
\ No newline at end of file
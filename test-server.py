@@ -17,9 +17,11 @@ from pydub import AudioSegment
 from werkzeug.utils import secure_filename
 import soundfile as sf
 
+from micro_batcher import QueueFullError
 from model import SpeakerNet
 from utils import (read_config, cprint)
 from server_utils import *
+from service_logger import AsyncServiceLogger
 
 # check log folder exists
 log_service_root = str(Path('log_service/'))
@@ -36,6 +38,29 @@ threshold = 0.5
 base_threshold = 0.5
 compare_threshold = 0.7
 
+# 'batched': utterances of concurrent requests share one forward, flushed at max_batch_size or after max_wait_ms
+# 'single': one forward per utterance
+# None: batched on GPU, single on CPU where the forward cost per crop does not drop with the batch size
+serving_mode = None
+max_batch_size = 32
+max_wait_ms = 5
+max_queue_size = 256
+queue_timeout = 1.0 # seconds a request waits for a place in a full queue before 503
+ref_cache_size = 1024 # reference embeddings kept per caller (phone / callId)
+
+# audio/results logs are written in the background, 'drop' or 'block' requests when the log queue is full
+log_queue_size = 1024
+log_policy = 'drop'
+log_block_timeout = 0.5
+
+# 'torch' or 'onnx' (graph exported by export.py, sessions built once and pooled), overridden by the env
+inference_backend = os.environ.get('SPEAKER_INFERENCE_BACKEND', 'torch')
+onnx_path = os.environ.get('SPEAKER_ONNX_PATH', None) # None: <save_path>/<model>/model/model_eval_<model>.onnx
+onnx_session_pool = 2
+onnx_intra_op_threads = 0
+onnx_inter_op_threads = 0
+deploy = False # fuse conv+bn, re-parameterize and freeze the torch model to TorchScript (checked on odd lengths up to 8 crops)
+
 model_path = str(Path('backup/1001/Raw_ECAPA/ARmSoftmax/model/best_state_top4.pt'))
 config_path = str(Path('backup/1001/Raw_ECAPA/ARmSoftmax/config/config_eval.yaml'))
 print("\n<<>> Loaded from:", model_path, "with threshold:", threshold)
@@ -44,11 +69,28 @@ print("\n<<>> Loaded from:", model_path, "with threshold:", threshold)
 args = read_config(config_path)
 
 t0 = time.time()
-model = SpeakerNet(**vars(args))
+model = SpeakerNet(**dict(vars(args),
+                          inference_backend=inference_backend,
+                          onnx_path=onnx_path,
+                          onnx_session_pool=onnx_session_pool,
+                          onnx_intra_op_threads=onnx_intra_op_threads,
+                          onnx_inter_op_threads=onnx_inter_op_threads))
 model.loadParameters(model_path, show_error=False)
 model.eval()
+if deploy and inference_backend == 'torch':
+    model.deploy()
+model.get_inference_backend()
 print("Model Loaded time: ", time.time() - t0)
 
+if serving_mode is None:
+    serving_mode = 'batched' if str(model.device).startswith('cuda') else 'single'
+batcher = create_embedding_batcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms,
+                                   max_queue_size=max_queue_size) if serving_mode == 'batched' else None
+print("Serving mode:", serving_mode)
+ref_cache = RefEmbeddingCache(max_entries=ref_cache_size)
+service_logger = AsyncServiceLogger(log_service_root, max_queue_size=log_queue_size,
+                                    policy=log_policy, block_timeout=log_block_timeout)
+
 # ================================================Flask API=============================================
 # Set up env for flask
 app = Flask(__name__, template_folder='templates')
@@ -60,20 +102,23 @@ app.config['DEBUG'] = True
 
 api = Api(app)
 
+
+@app.errorhandler(QueueFullError)
+def handle_queue_full(e):
+    # backpressure: the client should retry later
+    return jsonify({"error": str(e)}), 503
+
+
+@app.errorhandler(AudioDecodeError)
+def handle_bad_audio(e):
+    return jsonify({"error": str(e)}), 400
+
+
 # for matching call
 @app.route('/isMatched', methods=['POST'])
 def check_matching():
     audio_data = None
     
-    current_day = str(time.strftime('%Y-%m-%d', time.gmtime())).replace('-', '').replace(' ', '_').replace(':', '')
-    # create log dir
-    log_audio_path = str(Path(f'log_service/{current_day}/audio'))
-    os.makedirs(log_audio_path, exist_ok=True)
-    log_results_path = str(Path(f'log_service/{current_day}/results'))
-    os.makedirs(log_results_path, exist_ok=True)
-    log_audio_path_id = os.path.join(log_audio_path, "unknown_number")
-    os.makedirs(log_audio_path_id, exist_ok=True)
-    #
     cprint(text=f"\n[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]", fg='k', bg='g')
     ####################
     # Get request
@@ -88,24 +133,40 @@ def check_matching():
         ref_audio_data = data_json["refSpeech"]
         com_audio_data = data_json["comSpeech"]
         print("Got audio signal in", time.time() - t0, 'sec', end=' || ')
-        
-        # create dir to save
-        phone = "unknown_number" if (len(phone)==0) else phone
-        log_audio_path_id = os.path.join(log_audio_path, phone)
-        log_result_id =  os.path.join(log_results_path, phone)
-        
-        os.makedirs(log_audio_path_id, exist_ok = True)
-        os.makedirs(log_result_id, exist_ok = True)
     else:
         raise "Error: no data provide"
-        
-    print("Phone number:", phone, end=' || ')
-    print("Number of samples: Ref", len(ref_audio_data), "Com", len(com_audio_data))
     
     # convertstring of base64 to np array
     dtype = np.float64
     ref_audio_data_np = [decode_audio(audio_data, sr, dtype) for audio_data in ref_audio_data]
     com_audio_data_np = [decode_audio(audio_data, sr, dtype) for audio_data in com_audio_data]
+    return jsonify(verify_call(call_id, phone, ref_audio_data_np, com_audio_data_np))
+
+
+# for matching call, audio as multipart parts (WAV or raw PCM int16), no base64/JSON encoding
+@app.route('/isMatched/binary', methods=['POST'])
+def check_matching_binary():
+    cprint(text=f"\n[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]", fg='k', bg='g')
+    t0 = time.time()
+    call_id = request.form.get('callId', '')
+    phone = request.form.get('phone', '')
+    ref_audio_data_np = [decode_audio_bytes(part.read(), sr, part.mimetype) for part in request.files.getlist('refSpeech')]
+    com_audio_data_np = [decode_audio_bytes(part.read(), sr, part.mimetype) for part in request.files.getlist('comSpeech')]
+    if not ref_audio_data_np or not com_audio_data_np:
+        raise AudioDecodeError("refSpeech and comSpeech parts are required")
+    print("Got audio signal in", time.time() - t0, 'sec', end=' || ')
+    return jsonify(verify_call(call_id, phone, ref_audio_data_np, com_audio_data_np))
+
+
+def verify_call(call_id, phone, ref_audio_data_np, com_audio_data_np):
+    current_day = str(time.strftime('%Y-%m-%d', time.gmtime())).replace('-', '').replace(' ', '_').replace(':', '')
+    # log folders, relative to log_service/<day>/
+    phone = "unknown_number" if (len(phone)==0) else phone
+    log_audio_path_id = os.path.join('audio', phone)
+    log_result_id = os.path.join('results', phone)
+        
+    print("Phone number:", phone, end=' || ')
+    print("Number of samples: Ref", len(ref_audio_data_np), "Com", len(com_audio_data_np))
     
     # preprcess audio
 #     target_db = -10
@@ -113,47 +174,38 @@ def check_matching():
 #     com_audio_data_np = [preprocess_audio(audio_data_np, target_db) for audio_data_np in com_audio_data_np]   
     
     ####################
-    # save log audio 
-    print("Saving audio files...")   
-    print(f"> Ref files:")
-    log_audio_path_id_ref = os.path.join(log_audio_path_id, 'ref')
-    os.makedirs(log_audio_path_id_ref, exist_ok=True)
-    
-    if not any(str(call_id) in fname for fname in os.listdir(log_audio_path_id_ref)):
-        for i, audio_data_np in enumerate(ref_audio_data_np):
-            # check whether ref audio is exists
-            print(len(audio_data_np)/sr, 's', end=' ')
-            save_path = os.path.join(log_audio_path_id_ref, f'{call_id}_ref_{i}.wav')
-            sf.write(save_path, audio_data_np, sr)
-            print(f"> Speaker footprint {i + 1}th saved info:", phone, call_id)
-    
-    print(f"> Com files:", end=' ')
-    log_audio_path_id_com = os.path.join(log_audio_path_id, 'com')
-    os.makedirs(log_audio_path_id_com, exist_ok=True)
+    # save log audio (background writer, refs saved once per call)
+    print(f"> Ref files:", ' '.join(f'{len(audio_data_np)/sr}s' for audio_data_np in ref_audio_data_np))
+    service_logger.log_ref_audio(os.path.join(log_audio_path_id, 'ref'), call_id, ref_audio_data_np, sr)
+    
+    print(f"> Com files:", ' '.join(f'{len(audio_data_np)/sr}s' for audio_data_np in com_audio_data_np))
     for i, audio_data_np in enumerate(com_audio_data_np):
-        print(len(audio_data_np)/sr, 's', end=' ')
-        save_path = os.path.join(log_audio_path_id_com, f'{call_id}_com_{i}.wav')
-        sf.write(save_path, audio_data_np, sr)
+        service_logger.log_audio(os.path.join(log_audio_path_id, 'com'), f'{call_id}_com_{i}.wav', audio_data_np, sr)
         
     ####################
-    #  get embeddings each
+    #  get embeddings each, once for all scorings (ref embeddings cached per caller)
     t = time.time()
     print("\n\nInference results:")
+    ref_embeds, com_embeds = embed_request(model, ref_audio_data_np, com_audio_data_np,
+                                           eval_frames=eval_frames, num_eval=num_eval, sr=sr,
+                                           batcher=batcher, timeout=queue_timeout,
+                                           ref_cache=ref_cache, ref_key=phone if phone != "unknown_number" else call_id)
+    print(f"Embedding time: {round(time.time()-t, 4)}s || Ref cache: {ref_cache.hits} hits, {ref_cache.misses} misses")
+
+    t = time.time()
     print(f"Compare by pair: ", end='')
-    nom_confidence_scores, confidence_scores = compute_score_by_pair(model, ref_audio_data_np, com_audio_data_np,  
-                                                                     threshold=threshold, base_threshold=base_threshold, 
-                                                                     eval_frames=eval_frames, num_eval=num_eval,
-                                                                     normalize=normalize, sr=sr, norm_mode=norm_mode)
+    nom_confidence_scores, confidence_scores = score_by_pair(ref_embeds, com_embeds,
+                                                             threshold=threshold, base_threshold=base_threshold,
+                                                             norm_mode=norm_mode)
     print(f"\\Score: {confidence_scores} -> {nom_confidence_scores} \\Total time: {round(time.time()-t, 4)}s")
     
     ######################
-    # embed all and compare
+    # compare to the mean of refs
     t = time.time()
     print(f"Compare by mean ref: ", end='')
-    norm_mean_emb_scores, mean_emb_scores = compute_score_by_mean_ref(model, ref_audio_data_np, com_audio_data_np, 
-                                                              threshold=threshold, base_threshold=base_threshold, 
-                                                              eval_frames=eval_frames, num_eval=num_eval,
-                                                              normalize=normalize, sr=sr, norm_mode=norm_mode)
+    norm_mean_emb_scores, mean_emb_scores = score_by_mean_ref(ref_embeds, com_embeds,
+                                                              threshold=threshold, base_threshold=base_threshold,
+                                                              norm_mode=norm_mode, test_normalize=model.__L__.test_normalize)
     
     print(f"\\Score: {mean_emb_scores} -> {norm_mean_emb_scores} \\Total time: {round(time.time()-t, 4)}s")
     
@@ -179,22 +231,20 @@ def check_matching():
     cprint(text=str(bool(final_score >= compare_threshold)), fg=color)
     
     # write log results
-    with open(os.path.join(log_result_id, f"{call_id}.txt"), 'a') as wf:
-        text = f">{current_day}<\nRef: \n" + ','.join([f'{call_id}_ref_{i}.wav' for i in range(len(ref_audio_data))]) + '\n'
-        text += ("Com: \n" + ', '.join([f'{call_id}_com_{i}.wav' for i in range(len(com_audio_data))]) + '\n')
-        text += (str(bool(final_score >= compare_threshold)) + f"with score: {final_score}" + '\n>-------------------------------------------------<\n')
-        wf.write(text)
+    text = f">{current_day}<\nRef: \n" + ','.join([f'{call_id}_ref_{i}.wav' for i in range(len(ref_audio_data_np))]) + '\n'
+    text += ("Com: \n" + ', '.join([f'{call_id}_com_{i}.wav' for i in range(len(com_audio_data_np))]) + '\n')
+    text += (str(bool(final_score >= compare_threshold)) + f"with score: {final_score}" + '\n>-------------------------------------------------<\n')
+    service_logger.log_text(log_result_id, f"{call_id}.txt", text)
         
-    return jsonify({"isMatch": str(bool(final_score >= compare_threshold)), 
-                    "confidence": str(final_score), 
-                    "Threshold": threshold})
+    return {"isMatch": str(bool(final_score >= compare_threshold)), 
+            "confidence": str(final_score), 
+            "Threshold": threshold}
 
 
 @app.route('/embedding', methods=['POST'])
 def get_embeding():
     audio_data = None    
     
-    current_time = str(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())).replace('-', '').replace(' ', '_').replace(':', '')
     cprint(text=f"\n[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]", fg='k', bg='g')
 
     t0 = time.time()
@@ -208,29 +258,47 @@ def get_embeding():
         phone = data_json['phone']
         
         print("Got audio signal in", time.time() - t0, 'sec', end=' || ')
-        #  create dir to save
-        log_audio_path_id_emb = os.path.join(log_audio_path, phone, 'emb')
-        os.makedirs(log_audio_path_id_emb, exist_ok=True)
     else:
         raise "Error: no data provide"
     # convertstring of base64 to np array
     audio_data_np = decode_audio(audio_data, sr)
-    
+    return jsonify(embed_call(call_id, phone, audio_data_np))
+
+
+# embedding of a raw body (WAV, PCM int16 audio/L16 or float32 audio/x-float32) or a 'speech' multipart part,
+# callId and phone as query/form parameters
+@app.route('/embedding/binary', methods=['POST'])
+def get_embeding_binary():
+    cprint(text=f"\n[{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}]", fg='k', bg='g')
     t0 = time.time()
-    save_path = os.path.join(log_audio_path_id_emb, f'{call_id}_{current_time}_ref.wav')
+    call_id = request.values.get('callId', '')
+    phone = request.values.get('phone', '')
+    if 'speech' in request.files:
+        part = request.files['speech']
+        audio_data_np = decode_audio_bytes(part.read(), sr, part.mimetype)
+    else:
+        audio_data_np = decode_audio_bytes(request.get_data(), sr, request.mimetype)
+    print("Got audio signal in", time.time() - t0, 'sec', end=' || ')
+    return jsonify(embed_call(call_id, phone, audio_data_np))
 
-    if os.path.isfile(save_path):
-        save_path = save_path.replace('ref', 'com')
 
-    sf.write(save_path, audio_data_np, sr)
-    print("Save audio signal to file:", save_path, round(time.time() - t0, 2), 's')
+def embed_call(call_id, phone, audio_data_np):
+    current_time = str(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())).replace('-', '').replace(' ', '_').replace(':', '')
+    # log folder, relative to log_service/<day>/
+    log_audio_path_id_emb = os.path.join('audio', phone, 'emb')
+    
+    save_name = f'{call_id}_{current_time}_ref.wav'
+    service_logger.log_audio(log_audio_path_id_emb, save_name, audio_data_np, sr,
+                             alt_filename=save_name.replace('ref', 'com'))
+    print("Save audio signal to file:", os.path.join(log_audio_path_id_emb, save_name))
 
     t0 = time.time()
-    emb = np.asarray(model.embed_utterance(audio_data_np, eval_frames=eval_frames, num_eval=num_eval, normalize=normalize, sr=sr))
+    emb = np.asarray(embed_utterances(model, [audio_data_np], eval_frames=eval_frames, num_eval=num_eval,
+                                      normalize=normalize, sr=sr, batcher=batcher, timeout=queue_timeout)[0])
     emb_json = json.dumps(emb.tolist())
     print("Inference time:", f"{time.time() - t0} sec", "|| Embeding size:", emb.shape)
 
-    return jsonify({"Embedding": emb_json, "Inference_time": time.time() - t0, "Threshold": threshold})
+    return {"Embedding": emb_json, "Inference_time": time.time() - t0, "Threshold": threshold}
 
 
 @app.route('/', methods=['GET'])
@@ -241,4 +309,4 @@ def get_something():
 
 if __name__ == '__main__':
     #     app.run(debug=True)
-    app.run(debug=True, host='0.0.0.0', port=8111)
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=8111, threaded=True)
\ No newline at end of file
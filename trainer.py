@@ -60,7 +60,7 @@ def train(gpu, ngpus_per_node, args):
         
     # Initialise data loader
     train_loader = get_data_loader(args.train_list, **vars(args))
-    max_iter_size = len(train_loader) // args.nPerSpeaker
+    max_iter_size = len(train_loader)
     
     # Load models
     s = SpeakerNet(**dict(vars(args), T_max = max_iter_size))
@@ -23,8 +23,7 @@ import yaml
 from matplotlib import pyplot as plt
 from matplotlib import cm, colors
 
-from sklearn import metrics
-from sklearn.metrics import precision_recall_curve
+from eval_metrics import auc as roc_auc, eer as compute_eer, error_rates, min_dcf, tune_thresholds
 
 from scipy import signal
 from scipy import spatial
@@ -32,7 +31,6 @@ from scipy.io import wavfile
 import scipy.signal as sps
 
 import pdb
-from operator import itemgetter
 
 
 ## model utils
@@ -74,48 +72,39 @@ class PreEmphasis(torch.nn.Module):
         return F.conv1d(input, self.flipped_filter).squeeze(1)
 
 
-def tuneThresholdfromScore(scores, labels, target_fa, target_fr=None):
+def tuneThresholdfromScore(scores, labels, target_fa, target_fr=None, curve=None):
+    '''ROC, G-mean and precision / recall results of a trial list, `curve` is the output of
+    eval_metrics.error_rates when already computed'''
     results = {}
     
-    labels = np.nan_to_num(labels)
-    scores = np.nan_to_num(scores)
-    
-    fpr, tpr, thresholds = metrics.roc_curve(labels, scores, pos_label=1)
+    labels = np.nan_to_num(np.asarray(labels, dtype=np.float64)) > 0
+    fnr, fpr, thresholds = curve if curve is not None else error_rates(scores, labels)
+    tpr = 1 - fnr
     # G-mean
     gmean = np.sqrt(tpr * (1 - fpr))
     idxG = np.argmax(gmean)
     G_mean_result = [idxG, gmean[idxG], thresholds[idxG]]
     
     # ROC
-    fnr = 1 - tpr
-
-    fnr = fnr * 100
-    fpr = fpr * 100
-
-    tunedThreshold = []
-    if target_fr:
-        for tfr in target_fr:
-            idx = np.nanargmin(np.absolute((tfr - fnr)))
-            tunedThreshold.append([thresholds[idx], fpr[idx], fnr[idx]])
-
-    for tfa in target_fa:
-        idx = np.nanargmin(np.absolute((tfa - fpr)))
-        tunedThreshold.append([thresholds[idx], fpr[idx], fnr[idx]])
-
-    idxE = np.nanargmin(np.absolute((fnr - fpr)))  # index of min fpr - fnr = fpr + tpr - 1
-    eer = np.mean([fpr[idxE], fnr[idxE]])  # EER in % = (fpr + fnr) /2
-    optimal_threshold = thresholds[idxE]
+    tunedThreshold = tune_thresholds(fnr, fpr, thresholds, target_fa, target_fr or ())
+    eer, optimal_threshold = compute_eer(fnr, fpr, thresholds)  # EER in % = (fpr + fnr) /2 where they are the closest
     
-    # precision recall
-    precision, recall, thresholds_ = precision_recall_curve(labels, scores, pos_label=1)
-    # convert to f score
-    fscore = (2 * precision * recall) / (precision + recall)
+    # precision recall, thresholds accepting no trial excluded
+    n_target = labels.sum()
+    true_accepts = n_target * tpr[:-1]
+    false_accepts = (len(labels) - n_target) * fpr[:-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.nan_to_num(true_accepts / (true_accepts + false_accepts), nan=1.0)
+        recall = tpr[:-1]
+        thresholds_ = thresholds[:-1]
+        # convert to f score
+        fscore = np.nan_to_num((2 * precision * recall) / (precision + recall))
 
     # locate the index of the largest f score
     ixPR = np.argmax(fscore)
     # 
     results['gmean'] = G_mean_result
-    results['roc'] = [tunedThreshold, eer, metrics.auc(fpr, tpr), optimal_threshold]
+    results['roc'] = [tunedThreshold, eer, roc_auc(fnr, fpr) * 100, optimal_threshold]
     results['prec_recall'] = [precision, recall, fscore[ixPR], thresholds_[ixPR]]
     return results
 
@@ -191,57 +180,34 @@ def worker_init_fn(worker_id):
 # and a list of decision thresholds that give those error-rates.
 def ComputeErrorRates(scores, labels):
 
-      # Sort the scores from smallest to largest, and also get the corresponding
-      # indexes of the sorted scores.  We will treat the sorted scores as the
-      # thresholds at which the the error-rates are evaluated.
-    sorted_indexes, thresholds = zip(*sorted(
-          [(index, threshold) for index, threshold in enumerate(scores)],
-          key=itemgetter(1)))
-    sorted_labels = []
-    labels = [labels[i] for i in sorted_indexes]
-    fnrs = []
-    fprs = []
-
-    # At the end of this loop, fnrs[i] is the number of errors made by
-    # incorrectly rejecting scores less than thresholds[i]. And, fprs[i]
-    # is the total number of times that we have correctly accepted scores
-    # greater than thresholds[i].
-    for i in range(0, len(labels)):
-        if i == 0:
-            fnrs.append(labels[i])
-            fprs.append(1 - labels[i])
-        else:
-            fnrs.append(fnrs[i-1] + labels[i])
-            fprs.append(fprs[i-1] + 1 - labels[i])
-    fnrs_norm = sum(labels)
+    # Sort the scores from smallest to largest (stable, as sorted() was), the sorted
+    # scores are the thresholds at which the error-rates are evaluated.
+    scores = np.asarray(scores, dtype=np.float64)
+    sorted_indexes = np.argsort(scores, kind='stable')
+    thresholds = scores[sorted_indexes]
+    labels = np.asarray(labels, dtype=np.float64)[sorted_indexes]
+
+    # fnrs[i] is the number of errors made by incorrectly rejecting scores less
+    # than or equal to thresholds[i], fprs[i] the number of correctly rejected ones.
+    fnrs = np.cumsum(labels)
+    fprs = np.cumsum(1 - labels)
+    fnrs_norm = fnrs[-1]
     fprs_norm = len(labels) - fnrs_norm
 
-    # Now divide by the total number of false negative errors to
-    # obtain the false positive rates across all thresholds
-    fnrs = [x / float(fnrs_norm) for x in fnrs]
-
-    # Divide by the total number of corret positives to get the
-    # true positive rate.  Subtract these quantities from 1 to
-    # get the false positive rates.
-    fprs = [1 - x / float(fprs_norm) for x in fprs]
-    return fnrs, fprs, thresholds
+    # Divide by the totals to get the rates, one value per trial as lists
+    # (eval_metrics.error_rates gives the curve at the distinct scores only).
+    fnrs = (fnrs / float(fnrs_norm)).tolist()
+    fprs = (1 - fprs / float(fprs_norm)).tolist()
+    return fnrs, fprs, tuple(thresholds.tolist())
 
 # Computes the minimum of the detection cost function.  The comments refer to
 # equations in Section 3 of the NIST 2016 Speaker Recognition Evaluation Plan.
 def ComputeMinDcf(fnrs, fprs, thresholds, p_target, c_miss, c_fa):
-    min_c_det = float("inf")
-    min_c_det_threshold = thresholds[0]
-    for i in range(0, len(fnrs)):
-        # See Equation (2).  it is a weighted sum of false negative
-        # and false positive errors.
-        c_det = c_miss * fnrs[i] * p_target + c_fa * fprs[i] * (1 - p_target)
-        if c_det < min_c_det:
-            min_c_det = c_det
-            min_c_det_threshold = thresholds[i]
-    # See Equations (3) and (4).  Now we normalize the cost.
-    c_def = min(c_miss * p_target, c_fa * (1 - p_target))
-    min_dcf = min_c_det / c_def
-    return min_dcf, min_c_det_threshold
+    # Equation (2), a weighted sum of false negative and false positive errors,
+    # normalized by Equations (3) and (4), evaluated at every threshold at once
+    min_dcf_value, min_c_det_threshold = min_dcf(np.asarray(fnrs), np.asarray(fprs), np.asarray(thresholds),
+                                                 p_target, c_miss, c_fa)
+    return float(min_dcf_value), float(min_c_det_threshold)
 
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 # plot loss graph along with training process